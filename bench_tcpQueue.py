@@ -0,0 +1,388 @@
+#!/usr/bin/python3
+"""Throughput and latency benchmark for tcpQueue.
+
+Starts a local ``MyQueue`` server for each case and drives it with
+``--producers`` client threads (or processes, with ``--processes``) that
+PUT messages and ``--consumers`` clients that GET them back. The cases
+are every combination of ``--sizes`` (payload bytes) and ``--hmac``
+(on, off or both). Each case reports:
+
+- ``msgs_per_s`` and ``mb_per_s``: messages (and payload megabytes)
+  that made the full trip, over the wall time from the moment every
+  client starts to the moment the last one finishes;
+- ``put_latency_ms`` / ``get_latency_ms``: p50, p99 and p999 of the
+  per-request round trip seen by producers and consumers.
+
+Payloads are fixed pseudo-random bytes from ``--seed`` sent with the
+``raw`` codec, so runs differ only in what the code does with them.
+With ``--repeat N`` every case runs N times and the median run (by
+throughput) is kept.
+
+Results are printed as JSON (or written with ``--output``). To catch
+regressions, save a run and compare later runs against it:
+
+    python3 bench_tcpQueue.py -o baseline.json
+    ... change tcpQueue.py ...
+    python3 bench_tcpQueue.py --baseline baseline.json --threshold 0.10
+
+Compare mode flags every case whose throughput dropped, or whose p99
+PUT or GET latency rose, by more than ``--threshold`` (a fraction), and
+exits 1 if any did. Only compare runs made on the same machine with the
+same arguments; the numbers mean nothing across hosts.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import secrets
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from queue import Empty
+from random import Random
+from typing import Any
+
+from tcpQueue import MyQueue
+
+log = logging.getLogger("bench_tcpQueue")
+
+# Seconds between submitting the clients and the moment they all start,
+# so connecting (and spawning processes) is not part of the measurement.
+START_DELAY: float = 0.5
+START_DELAY_PROCESSES: float = 2.0
+
+# How long a consumer waits for a message before deciding the run is stuck.
+STALL_SECONDS: float = 30.0
+
+# The percentiles every latency summary reports, as (label, fraction).
+PERCENTILES: tuple[tuple[str, float], ...] = (
+    ("p50", 0.50),
+    ("p99", 0.99),
+    ("p999", 0.999),
+)
+
+
+def _free_port() -> int:
+    """A TCP port nothing on this host is listening on right now."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _split(total: int, parts: int) -> list[int]:
+    """``total`` as ``parts`` near-equal non-negative integers."""
+    base, extra = divmod(total, parts)
+    return [base + (i < extra) for i in range(parts)]
+
+
+def _wait_until(start_at: float) -> None:
+    delay = start_at - time.time()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def _producer(
+    port: int,
+    secret_key: bytes | None,
+    payload: bytes,
+    count: int,
+    start_at: float,
+) -> tuple[list[float], float]:
+    """PUT ``count`` copies of ``payload``. Returns the latency of each
+    PUT in seconds and the wall-clock time the last one finished."""
+    client = MyQueue("127.0.0.1", port, secret_key=secret_key, codec="raw")
+    client.start_client()
+    latencies: list[float] = []
+    try:
+        client.ping()  # connect before the clock starts
+        _wait_until(start_at)
+        for _ in range(count):
+            t0 = time.perf_counter()
+            client.send_to_producer(payload)
+            latencies.append(time.perf_counter() - t0)
+        return latencies, time.time()
+    finally:
+        client.close()
+
+
+def _consumer(
+    port: int,
+    secret_key: bytes | None,
+    count: int,
+    start_at: float,
+) -> tuple[list[float], float]:
+    """GET ``count`` messages, long-polling while the queue is empty.
+    Returns the latency of each GET that returned a message and the
+    wall-clock time the last one arrived."""
+    client = MyQueue("127.0.0.1", port, secret_key=secret_key, codec="raw")
+    client.start_client()
+    latencies: list[float] = []
+    try:
+        client.ping()
+        _wait_until(start_at)
+        while len(latencies) < count:
+            t0 = time.perf_counter()
+            try:
+                client.get_producer(timeout=STALL_SECONDS)
+            except Empty:
+                raise RuntimeError(
+                    "consumer got %d of %d messages, then nothing for %.0fs"
+                    % (len(latencies), count, STALL_SECONDS)
+                ) from None
+            latencies.append(time.perf_counter() - t0)
+        return latencies, time.time()
+    finally:
+        client.close()
+
+
+def _summarize(latencies: list[float]) -> dict[str, float]:
+    """Nearest-rank percentiles of ``latencies``, in milliseconds."""
+    if not latencies:
+        return {label: 0.0 for label, _ in PERCENTILES}
+    ordered = sorted(latencies)
+    last = len(ordered) - 1
+    return {
+        label: round(ordered[min(last, int(fraction * len(ordered)))] * 1000, 4)
+        for label, fraction in PERCENTILES
+    }
+
+
+def run_case(
+    args: argparse.Namespace, size: int, hmac_on: bool, executor: Executor
+) -> dict[str, Any]:
+    """Run one case against a fresh server and DB; return its result."""
+    payload = Random(args.seed).randbytes(size)
+    secret_key = secrets.token_bytes(32) if hmac_on else None
+    total = args.producers * args.messages
+    port = _free_port()
+    workdir = tempfile.mkdtemp(prefix="bench_tcpqueue_")
+    server = MyQueue(
+        "127.0.0.1",
+        port,
+        db_path=os.path.join(workdir, "bench.db"),
+        secret_key=secret_key,
+        max_queue_size=total,
+        engine=args.engine,
+        group_commit=args.group_commit,
+        codec="raw",
+    )
+    server.start_server()
+    try:
+        delay = START_DELAY_PROCESSES if args.processes else START_DELAY
+        start_at = time.time() + delay
+        consumers = [
+            executor.submit(_consumer, port, secret_key, n, start_at)
+            for n in _split(total, args.consumers)
+        ]
+        producers = [
+            executor.submit(
+                _producer, port, secret_key, payload, args.messages, start_at
+            )
+            for _ in range(args.producers)
+        ]
+        put: list[float] = []
+        get: list[float] = []
+        finished = start_at
+        for future in producers:
+            latencies, end = future.result()
+            put.extend(latencies)
+            finished = max(finished, end)
+        for future in consumers:
+            latencies, end = future.result()
+            get.extend(latencies)
+            finished = max(finished, end)
+    finally:
+        server.stop_server()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    seconds = max(finished - start_at, 1e-9)
+    return {
+        "name": "size=%d hmac=%s" % (size, "on" if hmac_on else "off"),
+        "payload_bytes": size,
+        "hmac": hmac_on,
+        "messages": total,
+        "seconds": round(seconds, 4),
+        "msgs_per_s": round(total / seconds, 1),
+        "mb_per_s": round(total * size / seconds / 1e6, 3),
+        "put_latency_ms": _summarize(put),
+        "get_latency_ms": _summarize(get),
+    }
+
+
+def run(args: argparse.Namespace) -> dict[str, Any]:
+    hmac_modes = {"on": (True,), "off": (False,), "both": (False, True)}[args.hmac]
+    workers = args.producers + args.consumers
+    pool: type[Executor] = ProcessPoolExecutor if args.processes else ThreadPoolExecutor
+    results: list[dict[str, Any]] = []
+    with pool(max_workers=workers) as executor:
+        for size in args.sizes:
+            for hmac_on in hmac_modes:
+                runs = [
+                    run_case(args, size, hmac_on, executor) for _ in range(args.repeat)
+                ]
+                runs.sort(key=lambda r: r["msgs_per_s"])
+                result = runs[len(runs) // 2]
+                log.info(
+                    "%s: %.0f msgs/s, %.2f MB/s, put p99 %.3fms, get p99 %.3fms",
+                    result["name"],
+                    result["msgs_per_s"],
+                    result["mb_per_s"],
+                    result["put_latency_ms"]["p99"],
+                    result["get_latency_ms"]["p99"],
+                )
+                results.append(result)
+    return {
+        "config": {
+            "producers": args.producers,
+            "consumers": args.consumers,
+            "processes": args.processes,
+            "messages_per_producer": args.messages,
+            "engine": args.engine,
+            "group_commit": args.group_commit,
+            "repeat": args.repeat,
+            "seed": args.seed,
+        },
+        "host": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }
+
+
+def compare(
+    report: dict[str, Any], baseline: dict[str, Any], threshold: float
+) -> list[str]:
+    """Describe every case in ``report`` that is more than ``threshold``
+    (a fraction) worse than the same case in ``baseline``."""
+    before = {r["name"]: r for r in baseline.get("results", [])}
+    regressions: list[str] = []
+    for result in report["results"]:
+        old = before.get(result["name"])
+        if old is None:
+            continue
+        drop = 1 - result["msgs_per_s"] / old["msgs_per_s"]
+        if drop > threshold:
+            regressions.append(
+                "%s: throughput %.0f -> %.0f msgs/s (-%.0f%%)"
+                % (result["name"], old["msgs_per_s"], result["msgs_per_s"], drop * 100)
+            )
+        for key in ("put_latency_ms", "get_latency_ms"):
+            was, now = old[key]["p99"], result[key]["p99"]
+            if was > 0 and now / was - 1 > threshold:
+                regressions.append(
+                    "%s: %s p99 %.3f -> %.3fms (+%.0f%%)"
+                    % (result["name"], key[:3], was, now, (now / was - 1) * 100)
+                )
+    return regressions
+
+
+def _parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="bench_tcpQueue",
+        description="Measure tcpQueue throughput and latency on this host.",
+    )
+    parser.add_argument(
+        "-p", "--producers", type=int, default=1, help="Producer clients (default: 1)"
+    )
+    parser.add_argument(
+        "-c", "--consumers", type=int, default=1, help="Consumer clients (default: 1)"
+    )
+    parser.add_argument(
+        "-n",
+        "--messages",
+        type=int,
+        default=2000,
+        help="Messages each producer sends per case (default: 2000)",
+    )
+    parser.add_argument(
+        "-s",
+        "--sizes",
+        type=lambda text: [int(size) for size in text.split(",")],
+        default=[64, 1024, 16384],
+        help="Comma-separated payload sizes in bytes (default: 64,1024,16384)",
+    )
+    parser.add_argument(
+        "--hmac",
+        choices=("on", "off", "both"),
+        default="both",
+        help="Run with a secret_key, without, or both (default: both)",
+    )
+    parser.add_argument(
+        "--processes",
+        action="store_true",
+        help="Run each client in a process of its own instead of a thread",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=("threads", "selectors"),
+        default="threads",
+        help="Server engine (default: threads)",
+    )
+    parser.add_argument(
+        "--group-commit", action="store_true", help="Enable server group commit"
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=1,
+        help="Runs per case; the median one is reported (default: 1)",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed for the payload bytes (default: 0)"
+    )
+    parser.add_argument("-o", "--output", help="Write the JSON report here")
+    parser.add_argument("-b", "--baseline", help="JSON report to compare against")
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        type=float,
+        default=0.10,
+        help="Worst tolerated change vs. the baseline, as a fraction (default: 0.10)",
+    )
+    args = parser.parse_args(argv)
+    for name in ("producers", "consumers", "messages", "repeat"):
+        if getattr(args, name) < 1:
+            parser.error("--%s must be at least 1" % name)
+    if any(size < 0 for size in args.sizes):
+        parser.error("--sizes must not be negative")
+    return args
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = _parse_args(argv)
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+    # The server warns about running without a secret_key once per case.
+    logging.getLogger("pyTCPQueue").setLevel(logging.ERROR)
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as out:
+            out.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        for line in regressions:
+            log.error("REGRESSION %s", line)
+        if regressions:
+            return 1
+        log.info(
+            "No regressions beyond %.0f%% vs. %s", args.threshold * 100, args.baseline
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,39 +18,284 @@ encoded as ASCII digits. `<opcode_byte>` is one byte identifying the frame
 type (see ``_OP_*`` below). `<payload_bytes>` is the (optional) message
 payload. `<hmac_bytes>` is a 32-byte HMAC-SHA256 over
 `<opcode_byte><payload_bytes>`, present only when the queue was constructed
-with a ``secret_key``.
+with a ``secret_key``. On protocol 3 it is a session MAC instead (see
+Protocol versions).
+
+Frames are sent as separate header, opcode, payload and MAC buffers in a
+single ``sendmsg()`` (writev) call, and the MAC is computed incrementally,
+so a large payload is never copied on its way out. Responses to requests
+that arrived together are coalesced into one ``sendmsg()``.
 
 Opcodes are byte values >= 0x10, which guarantees they cannot collide with
 the first byte of a zlib stream (always 0x78) or with any printable ASCII
 character.
 
-Every request frame gets exactly one response frame, so the protocol is
-strictly request/response and never pipelined:
+Every request frame gets exactly one response frame:
 
 * ``_OP_GET_*``     -> ``_OP_ITEM`` or ``_OP_EMPTY``
+* ``_OP_GET_*_BATCH`` -> ``_OP_ITEMS`` or ``_OP_EMPTY``
+* ``_OP_WAIT_*``    -> ``_OP_ITEM``, or ``_OP_EMPTY`` once the wait expires
+* ``_OP_PING``      -> ``_OP_ACK`` (connection health check; touches no data)
+* ``_OP_HELLO``     -> ``_OP_ACK`` (protocol negotiation; see below)
 * ``_OP_PUT_PRODUCER`` -> ``_OP_ACK`` (sent only after the row is committed)
+* ``_OP_PUT_PRODUCER_BATCH`` -> ``_OP_ACK`` (after the whole batch commits)
+* ``_OP_Q*``        -> as the matching request above, or ``_OP_ERROR``
+* ``_OP_QPUT_OPTIONS`` -> ``_OP_ACK`` with the item count, or ``_OP_ERROR``
+  (see Priorities and delays below)
+* Any PUT           -> ``_OP_NACK`` if the queue is full and refuses it
+  (see Backpressure below)
+* ``_OP_QLEASE``    -> ``_OP_ITEMS`` or ``_OP_EMPTY`` (see Leases below)
+* ``_OP_QACK``      -> ``_OP_ACK`` with the number of rows deleted
+* ``_OP_QSTREAM_*`` -> ``_OP_ACK``, ``_OP_ITEM`` or ``_OP_ERROR`` (see
+  Streams below)
+
+A batch GET carries the maximum number of items wanted as a 4-byte
+big-endian unsigned integer. The server pops up to that many rows in a
+single transaction and returns them in one ``_OP_ITEMS`` frame whose
+payload is a sequence of ``<4-byte big-endian length><item bytes>``
+records, oldest first. The server stops adding rows once the response
+would no longer fit in ``_MAX_FRAME_BYTES``, so a batch can come back
+shorter than requested even when more rows are queued.
+
+A batch PUT uses the same record encoding for its payload. All of its
+rows are inserted in one transaction, and the single ``_OP_ACK`` that
+follows echoes the batch's item count as a 4-byte big-endian
+integer. A batch is all-or-nothing: either every row is committed and
+acknowledged, or none is.
+
+A wait GET (long poll) carries the longest time the client is willing
+to wait, in milliseconds, as a 4-byte big-endian integer (capped at
+``_MAX_WAIT_MS``). If the queue is empty the server parks the request
+instead of answering at once, and wakes it as soon as an enqueue to that
+table commits. There is no polling traffic, and an idle queue delivers
+a new message to a waiting consumer within a fraction of a millisecond.
+
+Besides the built-in consumer and producer queues, a server hosts any
+number of named queues (see Persistence). ``_OP_QGET``,
+``_OP_QGET_BATCH``, ``_OP_QPUT`` and ``_OP_QPUT_BATCH`` work like the
+wait GET, batch GET, PUT and batch PUT above, with the queue's name in
+front of the usual payload as ``<1-byte length><ASCII name>``. A
+``_OP_QGET`` with a wait of 0 returns at once. A request for a queue
+that does not exist is answered with ``_OP_ERROR`` and a UTF-8 reason,
+and the connection stays open.
+
+Priorities and delays
+~~~~~~~~~~~~~~~~~~~~~
+
+Every row has an integer priority, 0 unless the PUT asked for another.
+GETs and leases hand out the highest-priority rows first and, among rows
+of equal priority, the oldest first. A PUT can also hold its items back
+for a delay: they stay invisible to every GET, peek and lease until the
+delay is over, and then wake consumers waiting on the queue like a fresh
+enqueue would.
+
+``_OP_QPUT_OPTIONS`` is a batch PUT to a named (or built-in) queue whose
+records follow ``<queue name><4-byte big-endian signed priority><4-byte
+big-endian delay in milliseconds>``; every item of the batch gets that
+priority and delay. The plain PUT opcodes store priority 0 and no
+delay. The delay is relative so that client and server clocks need not
+agree.
+
+Leases
+~~~~~~
+
+A GET deletes the row in the transaction that hands it out, so a
+consumer that crashes before it is done loses the message. ``_OP_QLEASE``
+(``<queue name><u32 max_items><u32 lease_ms>``) instead leases up to
+``max_items`` of the oldest visible rows: each is marked in flight until
+``lease_ms`` milliseconds from now and left in the table. The response
+is an ``_OP_ITEMS`` frame whose records each start with a 12-byte
+receipt (``<u64 row id><u32 delivery count>``) in front of the item.
+Leased rows are invisible to every GET and lease until the lease runs
+out.
+
+``_OP_QACK`` (``<queue name><receipt>...``) deletes the leased rows for
+good and answers ``_OP_ACK`` with the number it deleted as a 4-byte
+big-endian integer. A receipt only matches the delivery it came from, so
+once a lease has run out and the row was leased again, the old receipt
+deletes nothing. The maintenance thread returns rows whose lease ran out
+to the queue (see Persistence), where they are redelivered with a higher
+delivery count. A consumer can therefore lease hundreds of messages at
+once, work through them in parallel, and lose none if it dies halfway.
+
+Streams
+~~~~~~~
+
+A message is otherwise built, framed and stored in one piece, so a big
+one costs several copies of itself in memory on both sides. A streamed
+message travels as frames of at most ``_STREAM_CHUNK`` bytes instead,
+and the server writes each into the message's row with SQLite's
+incremental BLOB I/O, so neither side ever holds all of it:
+
+* ``_OP_QSTREAM_PUT`` (``<queue name><u64 size>``) inserts a hidden row
+  of ``size`` zero bytes and answers ``_OP_ACK`` with a u64 stream ID.
+* ``_OP_QSTREAM_WRITE`` (``<queue name><u64 stream id><u64 offset>
+  <data>``) writes one chunk into it.
+* ``_OP_QSTREAM_END`` (``<queue name><u64 stream id>``) makes the row
+  visible, in the place in the queue it took when the upload began.
+* ``_OP_QSTREAM_OPEN`` (``<queue name><u32 lease_ms>``) leases the
+  oldest message like ``_OP_QLEASE`` and answers ``_OP_ITEM`` with its
+  receipt and its u64 size, or ``_OP_EMPTY``.
+* ``_OP_QSTREAM_READ`` (``<queue name><receipt><u64 offset><u32 len>``)
+  answers ``_OP_ITEM`` with up to ``len`` bytes of a leased message.
+
+The server keeps no state between these requests, so the requests of an
+upload may travel over several connections. A streamed message is
+stored as ``raw`` bytes (see Serialization) and can be read whole with
+``get()`` as well; only ``raw`` messages can be opened as streams. An
+upload that sits idle for ``_STREAM_IDLE_SECONDS`` is deleted by the
+maintenance thread. Until then it counts toward its queue's depth and
+``max_queue_size``. Streams need ``storage="sqlite"``.
 
 Because the client retries a put whose ACK never arrives, delivery is
 at-least-once: a message can be stored twice if the ACK is lost after the
 commit. Make consumers idempotent if that matters to you.
 
+Backpressure
+~~~~~~~~~~~~
+
+By default a queue at ``max_queue_size`` makes room for a PUT by
+deleting its oldest rows, and only the server's log says so. A queue's
+``overflow`` policy can change that:
+
+* ``"drop_oldest"`` (the default) evicts as above.
+* ``"reject"`` refuses the PUT with ``_OP_NACK``, whose payload is a
+  4-byte big-endian retry-after hint in milliseconds followed by a
+  UTF-8 reason. Nothing of the PUT is stored.
+* ``"block"`` holds the PUT until consumers have made room for it, for
+  up to ``_BLOCK_PUT_SECONDS``, and then NACKs it. The PUT is retried
+  each time a GET, lease ACK, TTL reap or clear takes rows out of the
+  queue. A held PUT holds up the requests after it on its connection;
+  under ``engine="selectors"`` it is parked like a long-poll GET and
+  occupies no engine worker.
+
+``send_to_producer()`` and the other PUTs that retry wait out a NACK for
+at least its hint, backing off further with every NACK in a row, and
+give up once ``timeout`` seconds have passed. A producer that outruns
+its consumers is thereby slowed down to their pace instead of losing
+their backlog. Server-side puts and pipelined puts raise ``QueueFull``
+instead. A batch bigger than ``max_queue_size`` can never fit, so under
+``reject`` or ``block`` it is refused with ``_OP_ERROR``.
+
+Protocol versions
+-----------------
+
+A connection starts out speaking protocol 1: the client waits for each
+response before sending its next request, so one connection completes
+at most one request per network round trip.
+
+A client that wants more sends ``_OP_HELLO`` as the very first frame on
+a connection, carrying the highest protocol version it speaks as a
+single byte. The server answers ``_OP_ACK`` with the version it picked
+(the lower of the two) as a single byte, and from the next frame on
+both sides speak that version. A client that never sends HELLO stays on
+protocol 1, so old clients keep working unchanged. An old server closes
+the connection on the unknown opcode, and a new client then falls back
+to protocol 1.
+
+Protocol 2 puts a 4-byte big-endian request ID between the opcode and
+the payload of every frame, covered by the HMAC like the rest::
+
+    <ascii_length>:<opcode_byte><request_id><payload_bytes>[<hmac_bytes>]
+
+The server copies each request's ID into its response, so a client can
+have many requests outstanding on one socket and match each response
+to its request as it arrives (see the ``*_async`` methods). The server
+still executes one connection's requests in order, so a wait GET holds
+up everything sent after it on the same connection.
+
+Protocol 3 frames look like protocol 2 ones but are authenticated per
+connection. Its HELLO carries ``<version><16-byte client nonce>`` and
+then the IDs of the session MACs the client accepts, most preferred
+first (1 = HMAC-SHA256, 2 = keyed BLAKE2b). The server's ``_OP_ACK``
+answers ``<version><16-byte server nonce><chosen MAC ID>``. Both frames
+are still signed with HMAC-SHA256 under ``secret_key``, so neither nonce
+can be forged. Each side then derives two session keys from
+``secret_key`` and both nonces, one per direction. Every later frame
+carries ``<mac>(session key, <sequence number><opcode><request ID>
+<payload>)`` in place of the HMAC. The 8-byte sequence number counts
+that direction's frames from 0 and is never sent. A frame replayed,
+dropped or reordered on its connection therefore fails verification,
+and so does one replayed onto another connection or reflected back to
+its sender, and the connection is closed. The MAC objects are keyed once
+per connection and copied for each frame rather than built from
+scratch. Keyed BLAKE2b (the default ``session_mac``) is roughly twice as
+fast as HMAC-SHA256 on small frames. On CPUs with SHA instructions,
+HMAC-SHA256 wins for frames of tens of kilobytes, so pick
+``session_mac="hmac-sha256"`` for workloads of large messages.
+
+With a ``secret_key`` set, the blocking client API negotiates protocol 3
+as well, at the cost of one extra round trip per connection. A
+protocol-2 server closes the connection on a protocol-3 HELLO, so the
+client reconnects and offers a one-byte protocol-2 HELLO; a protocol-1
+server closes on that too, and the client reconnects without one. The
+client offers the older version for ``_RENEGOTIATE_SECONDS`` and then
+tries protocol 3 again, so an upgraded server is picked up without a
+restart.
+
+Falling back means losing the session MAC, which a man in the middle can
+force by resetting the first connection. ``require_session=True``
+(which needs a ``secret_key``) forbids it: the client refuses to talk to
+a server that will not agree to protocol 3, and the server closes any
+connection that does not open with a protocol-3 HELLO.
+
 Serialization
 -------------
 
-Messages are serialized with ``json`` (UTF-8) and zlib-compressed. JSON
-was chosen over pickle to eliminate the remote-code-execution risk of
-deserializing untrusted input. The trade-off is that not every Python
-object survives a round-trip:
-
-* ``tuple`` → becomes ``list``
-* ``bytes`` → not supported; raises ``TypeError`` on send
-* ``set`` / ``frozenset`` → not supported
-* integer dict keys → become strings
-* custom classes → not supported (provide a ``json.JSONEncoder`` if needed)
-* ``datetime`` and similar → not supported (encode as ISO strings)
-
-If you need to ship binary payloads, base64-encode them yourself before
-sending and decode after receiving.
+Messages are encoded by a codec, chosen per ``MyQueue`` with the
+``codec`` argument. The first byte of every encoded message names the
+codec that wrote it and decoding always goes by that byte, so messages
+written with different codecs can share a queue and every client reads
+all of them. ``codec`` only decides how a client encodes what it sends.
+
+``codec="json"`` (the default)
+    ``json`` (UTF-8), compressed according to its size. A message
+    shorter than ``_COMPRESS_MIN_BYTES`` is stored as plain JSON behind
+    a 0x04 tag, because zlib's header and checksum would only make it
+    bigger. Longer ones are zlib-compressed, at a higher level the
+    shorter they are (short messages are cheap to compress hard; long
+    ones get level 1), and kept uncompressed if that is no smaller.
+    Compressed messages are plain zlib streams whose first byte (always
+    0x78) doubles as the tag: exactly what earlier versions of this
+    module wrote and read.
+
+    With ``zdict=...`` (a zlib preset dictionary of up to 32 KB) every
+    message of ``_ZDICT_MIN_BYTES`` or more is instead compressed against
+    the dictionary and stored behind a 0x06 tag and the first 8 bytes of
+    the dictionary's BLAKE2b digest (messages written before that carry
+    a 0x05 tag and its Adler-32). Small, repetitive messages shrink far
+    more that way. Only a client constructed with the same ``zdict``
+    decodes them; the dictionary is bound to that client's codec, never
+    shared process-wide. ``build_zdict()`` derives one from the rows
+    already in a queue.
+
+    JSON was chosen over pickle to eliminate the remote-code-execution
+    risk of deserializing untrusted input. The trade-off is that not
+    every Python object survives a round-trip:
+
+    * ``tuple`` → becomes ``list``
+    * ``bytes`` → not supported; raises ``TypeError`` on send
+    * ``set`` / ``frozenset`` → not supported
+    * integer dict keys → become strings
+    * custom classes → not supported (provide a ``json.JSONEncoder`` if
+      needed)
+    * ``datetime`` and similar → not supported (encode as ISO strings)
+
+``codec="raw"``
+    Bytes in, bytes out: a 0x02 tag followed by the message, untouched.
+    For payloads that are already compressed or encoded, which the JSON
+    codec would only spend CPU on (and could not carry without base64).
+    Sending anything but a bytes-like object raises ``TypeError``.
+
+``codec="binary"``
+    A 0x03 tag followed by a compact tag-length-value encoding of
+    ``None``, ``bool``, ``int`` (any size), ``float``, ``str``,
+    ``bytes``, ``list``, ``tuple`` and ``dict``. Tuples, bytes and
+    non-string dict keys round-trip exactly. Not compressed. Anything
+    else (sets, custom classes) raises ``TypeError`` on send.
+
+Clients that predate codecs can only decode zlib-compressed ``json``
+messages (tag 0x78).
 
 Persistence
 -----------
@@ -58,21 +303,64 @@ Persistence
 The server-side queues are SQLite tables. Each row holds:
 
 * ``id`` — auto-increment primary key, used for FIFO ordering
-* ``payload`` — the compressed JSON blob
+* ``payload`` — the encoded message, starting with its codec tag
 * ``created_at`` — UTC seconds since the epoch (``time.time()``), float
-
-A background maintenance thread runs every ``reaper_interval`` seconds
-and:
+* ``visible_at`` — when the row's lease or delay runs out
+  (``time.time()`` scale), or NULL if it can be handed out now
+* ``deliveries`` — how many times the row has been leased
+* ``priority`` — signed integer, higher is delivered first (default 0)
+
+Named queues work the same way, each in a table of its own called
+``q_<name>``, so one process and one listener can serve hundreds of
+them. A named queue is created with ``declare_queue()``, which records
+its name, ``max_queue_size``, ``ttl_seconds`` and ``overflow`` policy in
+the ``queues`` table; the built-in queues take theirs from the
+constructor. Queue
+names are up to 64 lowercase letters, digits and single underscores,
+starting with a letter.
+
+GETs and leases find the next row through a partial index on
+``(priority DESC, id)`` that holds only visible rows, so the
+highest-priority row is one index lookup away however many bulk rows
+are queued behind it, leased out or scheduled for later. Capacity
+eviction still drops the oldest rows by ``id``, whatever their priority.
+
+Queue depths live in a small ``queue_depth`` table (one row per queue)
+kept current by ``AFTER INSERT`` / ``AFTER DELETE`` triggers, so the
+capacity check in every enqueue and ``consumer_size()`` /
+``producer_size()`` are a single primary-key lookup instead of a
+``COUNT(*)`` scan over the whole backlog. Because the triggers run inside
+the statement that changed the rows, the counter can never drift from
+the table, even when rows are changed by hand with the ``sqlite3`` CLI.
+
+A background maintenance thread makes rows whose lease or delay has run
+out visible again. It finds them through a partial index on
+``visible_at`` that holds only hidden rows, so a sweep over queues with
+nothing hidden costs one index probe each. The thread sleeps until the
+earliest ``visible_at`` of any queue, or at most ``_SWEEP_INTERVAL``
+seconds, and a PUT of a row due sooner than that wakes it early. Every
+``reaper_interval`` seconds it also:
 
 1. Reaps finished worker threads from the in-memory tracking list.
-2. If ``ttl_seconds`` is set, deletes rows whose ``created_at`` is older
-   than ``time.time() - ttl_seconds``.
+2. For every queue with a ``ttl_seconds``, deletes rows whose
+   ``created_at`` is older than ``time.time() - ttl_seconds``. It goes
+   oldest first in batches of a few thousand rows, one transaction
+   each, sized to hold the writer lock for about
+   ``_REAP_HOLD_SECONDS``, and pauses between batches for as long as
+   the last one held the lock. A pass stops after
+   ``_REAP_PASS_SECONDS``, so after an outage a backlog of millions is
+   worked off over many passes while GETs and PUTs keep flowing.
+   The thread returns to it right away, with a visibility sweep in
+   between, and ``metrics()`` reports what is left as
+   ``ttl_reap_backlog``.
 3. Compacts the DB: returns free pages to the OS via
    ``incremental_vacuum`` (up to 1000 pages per pass) and truncates the
    WAL file via ``wal_checkpoint(TRUNCATE)``. Without this step, the
    ``.db`` file would grow to the high-water mark of every burst it ever
    saw, even after rows are deleted; SQLite reuses freed pages but
    doesn't shrink the file on its own.
+4. Discards the in-memory queue heads, if ``cache_size`` is set (see
+   Concurrency).
 
 For compaction to work, fresh DBs are initialized with
 ``auto_vacuum=INCREMENTAL``. This setting can ONLY be enabled before any
@@ -86,11 +374,51 @@ multi-GB queue file can take seconds. Plan accordingly.)
 
 The schema version is tracked via ``PRAGMA user_version``. If a future
 version of this module bumps the schema, an old binary opening a newer
-DB refuses to start rather than risk corruption.
+DB refuses to start rather than risk corruption. Older DBs are migrated
+in place on open (version 2 added the depth counters; the migration
+seeds them with one ``COUNT(*)`` per table. Version 3 added the
+``queues`` registry of named queues, version 4 the ``visible_at`` and
+``deliveries`` columns of leases, version 5 the ``priority`` column and
+version 6 the ``overflow`` column of ``queues``).
 
 Timestamps are always UTC (``time.time()``), never local time. This avoids
 DST-related ambiguities in the reaper's cutoff comparison.
 
+Segment-log storage
+~~~~~~~~~~~~~~~~~~~
+
+SQLite is the default storage, and the only one with priorities, delays,
+leases, group commit and the head cache. ``storage="segments"`` trades
+all of those for plain FIFO queues with much cheaper writes: each queue
+is a directory under ``<db_path>.segments`` holding append-only segment
+files and an ``offset`` file. A PUT appends its records, each carrying
+its ``created_at`` and a CRC-32, to the newest segment in one
+``write()``; a GET reads from the offset and moves it on. A new segment
+is started once the newest one has reached ``_SEGMENT_BYTES``, and a
+segment is deleted whole once the offset has left it behind, so
+compaction never has anything to do. TTL reaping and capacity eviction
+move the offset past the oldest records. The DB file still holds the
+registry of named queues. Unlike the DB, the segment directory serves one
+``MyQueue`` at a time: it is ``flock()``-ed while open, and a second
+process (or instance) opening it gets ``RuntimeError``.
+
+``segment_fsync`` sets when appends reach the disk:
+
+* ``"interval"`` (the default) — fsync on the maintenance thread's next
+  pass, at most ``_SWEEP_INTERVAL`` seconds later. A process crash loses
+  nothing, but power loss can lose the last second of acknowledged PUTs:
+  the same promise as SQLite's WAL mode with ``synchronous=NORMAL``.
+* ``"always"`` — fsync before the PUT is acknowledged, so an
+  acknowledged message survives power loss too, at the price of a disk
+  flush per PUT.
+* ``"never"`` — leave it to the OS, except when the server stops.
+
+The read offset is written on every GET but only synced by the
+maintenance thread, so power loss can redeliver up to a second's worth
+of messages (delivery is at-least-once either way). On open, whatever
+follows the last whole record of the newest segment, the remains of an
+append cut short by a crash, is discarded.
+
 Concurrency
 -----------
 
@@ -106,16 +434,99 @@ over TCP, so all access is serialized through the server's worker
 threads. The consumer queue is also accessed only via the server. The
 SQLite layer plus WAL plus per-row PK serialize correctly under load.
 
+With ``group_commit=True`` the server stops giving every enqueue and
+dequeue its own transaction. Worker threads instead hand their writes
+to a single ``tcpQueue-writer`` thread, which gathers whatever arrives
+within ``group_commit_window`` seconds (or ``group_commit_max_ops``
+operations, whichever comes first) and runs them all in one
+``BEGIN IMMEDIATE`` ... ``COMMIT``. Each operation runs under its own
+SAVEPOINT, so one failing operation is rolled back alone without
+spoiling the rest of the group. A worker gets its result, and sends its
+ACK or ITEM response, only after the shared commit returns, so
+durability is exactly what it is without grouping. Under many
+concurrent producers this replaces a commit (and its WAL sync) per
+message, plus the busy-wait on SQLite's writer lock, with one commit
+per group.
+
+With ``cache_size=N`` the server keeps a write-through copy of the
+head of each queue in memory: the next ``N`` rows it will deliver, with
+their ids (rows over ``_CACHE_MAX_PAYLOAD`` bytes are never cached).
+Rows this process enqueues are added to it after they commit. A GET
+then takes its payload from memory and only sends SQLite a ``DELETE`` by
+primary key, and a peek doesn't touch SQLite at all. The disk stays the
+source of truth: the ``DELETE`` only matches a row that is still there
+and visible, and a row it does not match is never handed out. Leases,
+expired delays, evictions, TTL reaping and clears discard the copy,
+and the next GET rebuilds it from disk. So does every maintenance pass,
+which bounds how long rows written by another process sharing the DB
+can sit behind this process's own. Leave the cache off if another
+process writes to the same queues at a steady rate.
+
+SQLite lets one writer at a time into a file, however many cores and
+disks there are. With ``shards=N`` (up to ``_MAX_SHARDS``) ``db_path``
+names a directory of N SQLite files, ``shard-00.db`` and up, each holding
+a table for every queue, and writes to different shards run in parallel;
+with ``group_commit`` each shard gets a writer thread of its own. PUTs go
+to the shards in turn, a batch to a single shard in one transaction.
+GETs, peeks and leases look at the next rows of every shard and deliver
+them by priority and then ``created_at``: FIFO across shards, except
+between rows enqueued within the clock's resolution of each other. A
+batch GET or lease is then one transaction per shard it draws from. Each
+shard holds at most its share of a queue's ``max_queue_size``, and lease
+receipts name the shard of their row. Shards can be added later but not
+taken away: opening a directory with fewer shards than it holds is
+refused. The head cache and ``storage="segments"`` need a single shard.
+
+Server engines
+--------------
+
+``engine="threads"`` (the default) runs one thread per accepted
+connection. Each thread blocks reading frames from its socket and runs
+its requests inline. This is simple and fast for a few dozen busy
+connections.
+
+``engine="selectors"`` instead multiplexes the listening socket and
+every client connection on the listener thread using ``selectors``.
+Frames are parsed incrementally as bytes arrive, and each complete
+request runs on a bounded pool of ``engine_workers`` threads (the only
+threads that touch SQLite). Thousands of mostly idle connections then
+cost a few kilobytes of buffer each instead of a thread stack each.
+Requests on one connection still run strictly in order, one at a time.
+The wire protocol and ``start_server()`` / ``stop_server()`` behave the
+same under either engine.
+
 Multiple ``MyQueue`` server instances pointing at the same ``db_path``
 will compete for the writer lock — workable but rarely what you want.
 Don't put the DB on a network filesystem; SQLite is unhappy there.
 
+Metrics
+-------
+
+Every server keeps counters and latency histograms on its hot paths,
+so a slow p99 can be pinned on the right stage: request count and
+execution time per opcode, reading a frame off the socket (from its
+first byte to its last), verifying its HMAC, waiting in ``BEGIN
+IMMEDIATE`` for SQLite's writer lock, running ``COMMIT`` (where the
+fsyncs happen), and writing responses back. Alongside them are the
+pages compaction handed back to the OS and the rows the TTL reaper
+deleted per queue and the expired rows it has yet to get to, plus
+gauges read on demand: queue depths, the size of the WAL file(s) and
+open connections.
+
+``metrics()`` returns all of it as a dict. With ``metrics_port`` set,
+``start_server()`` also serves it in the Prometheus text format at
+``http://<host>:<metrics_port>/metrics``, with every name prefixed
+``tcpqueue_``. That endpoint is plain unauthenticated HTTP, so bind the
+server to a trusted interface or keep the port firewalled.
+
 Security
 --------
 
 Always construct with ``secret_key=secrets.token_bytes(32)`` (or longer).
-With a key set, every frame is HMAC-SHA256 signed on send and verified on
-receive. Without a key, anyone who can connect can inject arbitrary
+With a key set, every frame is signed on send and verified on receive:
+with HMAC-SHA256 on protocols 1 and 2, and with per-connection session
+keys and sequence numbers on protocol 3, which also rejects replayed
+frames. Without a key, anyone who can connect can inject arbitrary
 messages; a loud warning is logged.
 
 Frames are also bounded: the ASCII length prefix may not exceed
@@ -138,6 +549,18 @@ Public API
 
 ``MyQueue(host, port, *, db_path=None, secret_key=None, ...)``
     Construct a queue. Server-side methods require ``db_path``.
+    ``codec`` picks how sent messages are encoded (see Serialization).
+    ``group_commit=True`` enables the shared writer thread and
+    ``cache_size`` the in-memory queue heads (see Concurrency);
+    ``engine="selectors"`` picks the event-loop server (see Server
+    engines); ``storage="segments"`` and ``segment_fsync`` store messages
+    in append-only segment files instead of SQLite (see Persistence),
+    ``shards=N`` spreads them over N SQLite files (see Concurrency),
+    ``metrics_port`` serves Prometheus metrics over HTTP (see Metrics),
+    ``session_mac`` picks the MAC a client prefers on protocol 3 and
+    ``require_session`` forbids falling back to protocols 1 and 2
+    (see Protocol versions), and ``overflow`` what the built-in queues
+    do with a PUT once full (see Backpressure).
 
 ``start_server()`` / ``stop_server()`` / ``install_signal_handlers()``
 ``wait_for_shutdown(timeout=None)``
@@ -146,19 +569,88 @@ Public API
 ``start_client()`` / ``close()``
     Client lifecycle.
 
-``get_consumer()`` / ``get_producer()``
-    Pop the next item. Raises ``queue.Empty`` if empty,
+``get_consumer(timeout=None)`` / ``get_producer(timeout=None)``
+    Pop the next item. With ``timeout`` set, the server holds the request
+    for up to that many seconds waiting for an item to arrive. Raises
+    ``queue.Empty`` if empty (after the timeout, if any),
     ``ConnectionError`` on socket / protocol failure.
 
-``send_to_consumer(blob)`` / ``send_to_producer(blob)``
+``get_consumer_batch(max_items)`` / ``get_producer_batch(max_items)``
+    Pop up to ``max_items`` items in one round trip. Returns a non-empty
+    list, oldest first. Raises like ``get_consumer()``.
+
+``send_to_consumer(blob, priority=0, delay_seconds=0.0)`` /
+``send_to_producer(blob, priority=0, delay_seconds=0.0)``
     Push an item. ``send_to_consumer`` is server-side and writes
     directly to the DB; ``send_to_producer`` is client-side, goes over
-    the wire and waits for the server's ACK.
+    the wire and waits for the server's ACK. Higher-``priority`` items
+    are delivered before lower ones; with ``delay_seconds`` the item is
+    only delivered once that many seconds have passed.
+
+``send_to_producer_many(blobs, priority=0, delay_seconds=0.0)``
+    Push several items over the wire with one frame, one commit and one
+    ACK per ``_BATCH_BUDGET`` bytes of serialized payload.
+
+``get(queue, timeout=None)`` / ``get_batch(queue, max_items)`` /
+``send(queue, blob, priority=0, delay_seconds=0.0)`` /
+``send_many(queue, blobs, priority=0, delay_seconds=0.0)``
+    The same operations on a named queue. Raise ``ValueError`` if the
+    server has no such queue.
+
+``declare_queue(name, *, max_queue_size=10_000, ttl_seconds=None, ...)`` /
+``drop_queue(name)`` / ``queue_names()`` / ``queue_size(name)``
+    Server-side management of named queues. ``overflow="reject"`` or
+    ``"block"`` makes a full queue push back on PUTs instead of dropping
+    its oldest items (see Backpressure).
+
+``lease(queue, max_items=1, lease_seconds=30.0)`` / ``ack(queue, receipts)``
+    Lease up to ``max_items`` items of any queue as ``(receipt, item)``
+    pairs, and delete them by receipt once processed (see Leases).
+    Unacknowledged items are redelivered once their lease runs out.
+
+``send_stream(queue, data, size=None)`` / ``open_stream(queue, lease_seconds=30.0)``
+    Send the contents of a binary file object as one message a chunk at
+    a time, and lease the oldest message of a queue as a ``MessageStream``
+    (a seekable, read-only file object with ``ack()``) that reads it the
+    same way (see Streams).
+
+``QueueFull``
+    The ``ValueError`` raised for a PUT refused by a full queue, with
+    the server's hint in ``retry_after`` (seconds).
+
+``ping()``
+    Round-trip a no-op frame. Returns ``True`` if the server answered.
+
+``get_consumer_async()`` / ``get_producer_async()`` /
+``get_consumer_batch_async(max_items)`` /
+``get_producer_batch_async(max_items)`` / ``send_to_producer_async(blob)``
+    Pipelined variants over a protocol-2 connection of their own: send
+    the request and return a ``concurrent.futures.Future`` at once. The
+    future raises whatever the blocking method would. Async puts are not
+    retried. Against a protocol-1 server they run synchronously and
+    return a finished future.
 
 ``consumer_size()`` / ``producer_size()`` / ``consumer_empty()`` /
 ``producer_empty()`` / ``clear_queues()``
     Server-side introspection.
 
+``metrics()``
+    Server side. Counters, latency histograms and gauges as a dict (see
+    Metrics).
+
+``build_zdict(size=4096, sample_rows=1000)``
+    Server side. Build a preset compression dictionary for the ``json``
+    codec from the newest rows of both queues (see Serialization).
+
+``MyQueuePool(host, port, *, size=4, secret_key=None, ...)``
+    ``size`` independent client connections behind the same
+    ``send*`` / ``get*`` / ``lease`` / ``ack`` / ``*_stream`` API. Each call checks one
+    connection out, so up to ``size`` threads have requests in flight
+    at once instead of queueing on a single socket. Connections idle for
+    longer than ``health_check_interval`` are pinged on checkout; broken
+    ones are dropped and transparently reconnected. A stream from
+    ``open_stream()`` keeps its connection checked out until it is closed.
+
 Standard invocation
 -------------------
 q = MyQueue("0.0.0.0", 49152, db_path="/var/lib/queue.db", secret_key=KEY)
@@ -171,24 +663,44 @@ from __future__ import annotations
 
 import hashlib
 import hmac
+import io
 import json
 import logging
+import math
+import os
+import re
+import selectors
+import shutil
 import signal
 import socket
 import sqlite3
+import struct
 import threading
 import time
 import zlib
-from collections.abc import Iterator
-from contextlib import contextmanager
+from bisect import bisect_left
+from collections import Counter, deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import accumulate, count, islice
 from pathlib import Path
-from queue import Empty
+from queue import Empty, LifoQueue, SimpleQueue
 from random import random
 from time import sleep
-from typing import Any
+from typing import Any, BinaryIO, TypeVar
+
+try:
+    import fcntl
+except ImportError:  # Windows; storage="segments" needs it and is refused
+    fcntl = None
 
 log = logging.getLogger("pyTCPQueue")
 
+_T = TypeVar("_T")
+
 
 # Wire-protocol opcodes. Each opcode is a single byte. Using bytes >= 0x10
 # guarantees these will never collide with the first byte of a zlib stream
@@ -196,24 +708,273 @@ log = logging.getLogger("pyTCPQueue")
 _OP_GET_CONSUMER: bytes = b"\x10"  # client -> server: give me a consumer item
 _OP_GET_PRODUCER: bytes = b"\x11"  # client -> server: give me a producer item
 _OP_PUT_PRODUCER: bytes = b"\x12"  # client -> server: enqueue payload to producer queue
+_OP_GET_CONSUMER_BATCH: bytes = b"\x13"  # client -> server: up to N consumer items
+_OP_GET_PRODUCER_BATCH: bytes = b"\x14"  # client -> server: up to N producer items
+_OP_PUT_PRODUCER_BATCH: bytes = b"\x15"  # client -> server: enqueue several payloads
+_OP_WAIT_CONSUMER: bytes = b"\x16"  # client -> server: consumer item, wait if empty
+_OP_WAIT_PRODUCER: bytes = b"\x17"  # client -> server: producer item, wait if empty
+_OP_PING: bytes = b"\x18"  # client -> server: liveness check, answered with ACK
+_OP_HELLO: bytes = b"\x19"  # client -> server: negotiate the protocol version
+_OP_QGET: bytes = b"\x1a"  # client -> server: item from a named queue, may wait
+_OP_QGET_BATCH: bytes = b"\x1b"  # client -> server: up to N items from a named queue
+_OP_QPUT: bytes = b"\x1c"  # client -> server: enqueue payload to a named queue
+_OP_QPUT_BATCH: bytes = b"\x1d"  # client -> server: enqueue several to a named queue
+_OP_QLEASE: bytes = b"\x1e"  # client -> server: lease up to N items of a named queue
+_OP_QACK: bytes = b"\x1f"  # client -> server: delete leased items by receipt
+# 0x10-0x1f is full: further requests start a second request block at 0x30,
+# leaving 0x2_ to the responses. These are ASCII digits, which is harmless:
+# the opcode is read after the ":" that ends the frame's length prefix.
+_OP_QPUT_OPTIONS: bytes = b"\x30"  # client -> server: batch PUT, priority and delay
+_OP_QSTREAM_PUT: bytes = b"\x31"  # client -> server: start a streamed PUT of N bytes
+_OP_QSTREAM_WRITE: bytes = b"\x32"  # client -> server: one chunk of a streamed PUT
+_OP_QSTREAM_END: bytes = b"\x33"  # client -> server: publish a streamed PUT
+_OP_QSTREAM_OPEN: bytes = b"\x34"  # client -> server: lease a message to stream
+_OP_QSTREAM_READ: bytes = b"\x35"  # client -> server: one chunk of a leased message
+# Responses: 0x20-0x2f.
 _OP_ITEM: bytes = b"\x20"  # server -> client: here is an item (payload follows)
 _OP_EMPTY: bytes = b"\x21"  # server -> client: queue was empty (no payload)
 _OP_ACK: bytes = b"\x22"  # server -> client: put committed to disk
-
-_HMAC_SIZE: int = 32  # HMAC-SHA256 digest length, in bytes
+_OP_ITEMS: bytes = b"\x23"  # server -> client: length-prefixed items follow
+_OP_ERROR: bytes = b"\x24"  # server -> client: request refused, UTF-8 reason follows
+_OP_NACK: bytes = b"\x25"  # server -> client: queue full, retry-after and reason follow
+
+# Opcode -> the name metrics label it with. Every opcode above must be listed.
+_OPCODE_NAMES: dict[bytes, str] = {
+    _OP_GET_CONSUMER: "get_consumer",
+    _OP_GET_PRODUCER: "get_producer",
+    _OP_PUT_PRODUCER: "put_producer",
+    _OP_GET_CONSUMER_BATCH: "get_consumer_batch",
+    _OP_GET_PRODUCER_BATCH: "get_producer_batch",
+    _OP_PUT_PRODUCER_BATCH: "put_producer_batch",
+    _OP_WAIT_CONSUMER: "wait_consumer",
+    _OP_WAIT_PRODUCER: "wait_producer",
+    _OP_PING: "ping",
+    _OP_HELLO: "hello",
+    _OP_QGET: "qget",
+    _OP_QGET_BATCH: "qget_batch",
+    _OP_QPUT: "qput",
+    _OP_QPUT_BATCH: "qput_batch",
+    _OP_QLEASE: "qlease",
+    _OP_QACK: "qack",
+    _OP_QPUT_OPTIONS: "qput_options",
+    _OP_QSTREAM_PUT: "qstream_put",
+    _OP_QSTREAM_WRITE: "qstream_write",
+    _OP_QSTREAM_END: "qstream_end",
+    _OP_QSTREAM_OPEN: "qstream_open",
+    _OP_QSTREAM_READ: "qstream_read",
+    _OP_ITEM: "item",
+    _OP_EMPTY: "empty",
+    _OP_ACK: "ack",
+    _OP_ITEMS: "items",
+    _OP_ERROR: "error",
+    _OP_NACK: "nack",
+}
+
+_HMAC_SIZE: int = 32  # MAC length in bytes, for every scheme below
 _MAX_HEADER_BYTES: int = 16  # generous cap on the ASCII length prefix
 _MAX_FRAME_BYTES: int = 64 * 1024 * 1024  # hard cap on a single frame body
 _RECV_CHUNK: int = 65536  # max bytes requested per recv() call
-
-# Whitelist of valid table names. We do interpolate table names into SQL
-# strings (sqlite3 placeholders don't work for table names), so the names
-# come exclusively from this set.
+_MAX_PENDING_FRAMES: int = 64  # selectors engine: parsed-but-unserved requests
+_LOOP_READ_BUFFER: int = 16 * 1024  # selectors engine: per-connection read buffer
+
+# Frames are written as separate header / opcode / payload / MAC buffers
+# with sendmsg() (writev), so large payloads are never concatenated. Not
+# every platform has sendmsg (Windows doesn't); there we send one buffer
+# per call instead. _IOV_MAX stays under every platform's iovec limit.
+_HAVE_SENDMSG: bool = hasattr(socket.socket, "sendmsg")
+_IOV_MAX: int = 512
+
+_ENGINES = ("threads", "selectors")
+
+# Highest wire-protocol version this module speaks. Version 2 adds a request
+# ID to every frame so requests can be pipelined, version 3 per-connection
+# session keys and sequence numbers; see "Protocol versions".
+_PROTOCOL_VERSION: int = 3
+
+# Protocol-3 handshake: each side contributes a random nonce, and the client
+# lists the session MACs it accepts (by ID, most preferred first).
+_NONCE_SIZE: int = 16
+_SESSION_MACS: dict[str, int] = {"hmac-sha256": 1, "blake2b": 2}
+
+# How long a client keeps offering an older protocol version after the
+# server hung up on a newer one's HELLO, before it tries the newest again.
+_RENEGOTIATE_SECONDS: float = 60.0
+
+# Batch framing. Counts and per-item lengths are 4-byte big-endian unsigned
+# integers. A batch response must fit in a single frame, so the server caps
+# the summed item bytes at _BATCH_BUDGET (leaving room for the opcode and
+# HMAC) no matter how many items were asked for.
+_U32 = struct.Struct(">I")
+_I32 = struct.Struct(">i")
+_U64 = struct.Struct(">Q")
+_MAX_BATCH_ITEMS: int = 10_000
+_BATCH_BUDGET: int = _MAX_FRAME_BYTES - 1024
+
+# Codec tags: the first byte of every stored message. JSON messages are
+# plain zlib streams, whose first byte is always 0x78, so they need no tag
+# of their own and stay readable by clients that predate codecs.
+_TAG_JSON: bytes = b"\x78"
+_TAG_RAW: bytes = b"\x02"
+_TAG_BINARY: bytes = b"\x03"
+_TAG_JSON_PLAIN: bytes = b"\x04"  # uncompressed JSON
+_TAG_JSON_ZDICT_ADLER: bytes = b"\x05"  # u32 dictionary Adler-32, deflate (old)
+_TAG_JSON_ZDICT: bytes = b"\x06"  # 8-byte dictionary id, raw deflate stream
+
+# Size-adaptive compression of JSON messages. Below _COMPRESS_MIN_BYTES the
+# zlib header and checksum cost more than compression saves. Above it,
+# each (size limit, level) pair applies to messages up to that many bytes,
+# and anything bigger gets level 1. With a preset dictionary, compression
+# pays off for much shorter messages.
+_COMPRESS_MIN_BYTES: int = 128
+_COMPRESS_LEVELS: tuple[tuple[int, int], ...] = ((4 * 1024, 6), (64 * 1024, 3))
+_ZDICT_MIN_BYTES: int = 16
+_ZDICT_MAX_BYTES: int = 32 * 1024  # zlib's window; more is never used
+_ZDICT_ID_SIZE: int = 8  # bytes of the dictionary's BLAKE2b digest
+
+# JSON tokens considered by build_zdict: strings (with the colon if they
+# are keys) and literals.
+_ZDICT_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*":?|true|false|null')
+
+# Type markers of the binary codec, one byte each.
+(
+    _B_NONE,
+    _B_TRUE,
+    _B_FALSE,
+    _B_INT,  # zigzag varint
+    _B_FLOAT,  # IEEE 754 double, big-endian
+    _B_STR,  # varint byte length, UTF-8
+    _B_BYTES,  # varint byte length, raw
+    _B_LIST,  # varint count, items
+    _B_TUPLE,  # varint count, items
+    _B_DICT,  # varint count, key/value pairs
+) = b"NTFidsbltm"
+_F64 = struct.Struct(">d")
+_BINARY_MAX_DEPTH: int = 256
+
+# Leases. A receipt names one delivery of one row: its id and how many times
+# it had been leased, so a receipt from an expired lease cannot delete the
+# row once it has been handed to someone else.
+_RECEIPT = struct.Struct(">QI")
+_MAX_LEASE_MS: int = 12 * 3600 * 1000
+
+# Streams. A streamed message travels as chunks of at most _STREAM_CHUNK
+# bytes and is written to and read from its row with incremental BLOB I/O.
+# While it is being uploaded its row is hidden, marked by deliveries =
+# _STREAM_PENDING and a visible_at every chunk pushes _STREAM_IDLE_SECONDS
+# ahead; the maintenance thread deletes uploads left idle for longer.
+# _STREAM_AT is <u64 stream id><u64 offset>, _STREAM_READ a receipt, an
+# offset and a u32 length.
+_STREAM_CHUNK: int = 1024 * 1024
+_STREAM_IDLE_SECONDS: float = 300.0
+_STREAM_PENDING: int = -1
+_STREAM_AT = struct.Struct(">QQ")
+_STREAM_READ = struct.Struct(">QIQI")
+_STREAM_OPS = (
+    _OP_QSTREAM_PUT,
+    _OP_QSTREAM_WRITE,
+    _OP_QSTREAM_END,
+    _OP_QSTREAM_OPEN,
+    _OP_QSTREAM_READ,
+)
+
+# Longest delay a PUT may ask for (what fits in its u32 of milliseconds),
+# and the longest the maintenance thread sleeps between visibility sweeps.
+# It normally wakes exactly when the next hidden row is due; the cap is
+# what bounds the wait for rows hidden by another process sharing the DB.
+_MAX_DELAY_MS: int = 2**32 - 1
+_SWEEP_INTERVAL: float = 1.0
+
+# TTL reaping deletes expired rows oldest first, _REAP_BATCH rows per
+# transaction to start with. Each batch's size is then scaled so that its
+# transaction holds the writer lock for about _REAP_HOLD_SECONDS, within
+# [_REAP_MIN_BATCH, _REAP_MAX_BATCH]. A reap pass hands control back to
+# the maintenance loop after _REAP_PASS_SECONDS.
+_REAP_BATCH: int = 2000
+_REAP_MIN_BATCH: int = 100
+_REAP_MAX_BATCH: int = 50_000
+_REAP_HOLD_SECONDS: float = 0.02
+_REAP_PASS_SECONDS: float = 0.5
+
+# Message priorities travel as 4-byte signed integers.
+_MIN_PRIORITY: int = -(2**31)
+_MAX_PRIORITY: int = 2**31 - 1
+
+# What a PUT to a full queue does: evict the queue's oldest rows, get
+# refused with _OP_NACK, or wait for room. A NACK carries _RETRY_AFTER_MS
+# as its hint, and a waiting PUT is NACKed after _BLOCK_PUT_SECONDS. A
+# client backs off from a NACK for at least its hint, doubling with each
+# NACK in a row up to _MAX_BACKOFF_SECONDS, and from any other failed send
+# for _RETRY_BASE_SECONDS, doubling likewise.
+_OVERFLOW_POLICIES = ("drop_oldest", "reject", "block")
+_RETRY_AFTER_MS: int = 250
+_BLOCK_PUT_SECONDS: float = 5.0
+_RETRY_BASE_SECONDS: float = 0.25
+_MAX_BACKOFF_SECONDS: float = 5.0
+
+# Largest payload the head cache holds; bigger rows are always read from disk.
+# Reading big rows ahead of time would only push the pages their DELETE
+# needs out of SQLite's page cache.
+_CACHE_MAX_PAYLOAD: int = 4 * 1024
+
+# Segment-log storage (storage="segments"). Each record is a header of
+# <u32 payload length><f64 created_at><u32 CRC-32 of the payload> followed
+# by the payload. A queue starts a new segment file once its newest one has
+# reached _SEGMENT_BYTES. The read offset is <u64 segment><u64 position>.
+_STORAGES = ("sqlite", "segments")
+_FSYNC_POLICIES = ("always", "interval", "never")
+_SEGMENT_RECORD = struct.Struct(">IdI")
+_SEGMENT_OFFSET = struct.Struct(">QQ")
+_SEGMENT_BYTES: int = 64 * 1024 * 1024
+_SEGMENT_READ_AHEAD: int = 64 * 1024
+_SEGMENT_SUFFIX = ".seg"
+_FIFO_ONLY = "priorities, delays, leases and streams need storage='sqlite'"
+
+# Sharding (shards=N): db_path is a directory of N SQLite files named after
+# _SHARD_FILE. A lease receipt carries the shard of its row in the bits of
+# the row id from _SHARD_SHIFT up.
+_SHARD_FILE = "shard-%02d.db"
+_MAX_SHARDS: int = 64
+_SHARD_SHIFT: int = 56
+
+# Upper bounds (seconds) of the latency histogram buckets, plus +Inf.
+_LATENCY_BUCKETS: tuple[float, ...] = (
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+)
+
+# Longest a single wait GET may be parked on the server. Clients wanting a
+# longer wait simply issue another one.
+_MAX_WAIT_MS: int = 60_000
+
+# The two built-in queues, whose tables are named after them. We do
+# interpolate table names into SQL strings (sqlite3 placeholders don't work
+# for table names), so table names come exclusively from this set and from
+# _queue_table(), which only accepts names matching _QUEUE_NAME.
 _TABLES = ("consumer", "producer")
 
+# Named queues live in tables called q_<name>. Names are lowercase words
+# joined by single underscores, so a table's index and triggers can use a
+# "__" suffix without ever colliding with another queue's table.
+_QUEUE_NAME = re.compile(r"[a-z][a-z0-9]*(?:_[a-z0-9]+)*")
+_MAX_QUEUE_NAME: int = 64
+
 # Schema version stored in PRAGMA user_version. Bump when the schema changes
 # and add a migration in _initialize_db. An old binary opening a DB whose
 # schema is newer than it understands aborts rather than risk corruption.
-_SCHEMA_VERSION = 1
+_SCHEMA_VERSION = 6
 
 
 # --------------------------------------------------------------------------- #
@@ -235,98 +996,2334 @@ def _close_socket(sock: socket.socket | None) -> None:
         pass
 
 
-def _serialize(blob: Any) -> bytes:
-    """JSON-encode and zlib-compress an arbitrary JSON-serializable object.
+def _consume_buffers(views: deque[memoryview], sent: int) -> None:
+    """Drop ``sent`` bytes from the front of a queue of buffers."""
+    while sent:
+        head = views[0]
+        if sent >= len(head):
+            sent -= len(head)
+            views.popleft()
+        else:
+            views[0] = head[sent:]
+            sent = 0
+
+
+def _send_some(sock: socket.socket, views: deque[memoryview]) -> None:
+    """One vectored send of the queued buffers (``writev`` via
+    ``sendmsg`` where available), consuming what the kernel accepted.
+    Raises ``BlockingIOError`` on a non-blocking socket that is full."""
+    if _HAVE_SENDMSG:
+        sent = sock.sendmsg(list(islice(views, _IOV_MAX)))
+    else:
+        sent = sock.send(views[0])
+    _consume_buffers(views, sent)
+
+
+def _send_buffers(sock: socket.socket, buffers: list[bytes | memoryview]) -> None:
+    """Blocking ``sendall`` over several buffers without joining them."""
+    views = deque(memoryview(b) for b in buffers if len(b))
+    while views:
+        _send_some(sock, views)
+
+
+class _Zdict:
+    """A preset dictionary of the json codec, with the ids messages name
+    it by: the first ``_ZDICT_ID_SIZE`` bytes of its BLAKE2b digest, and
+    the Adler-32 that messages written before those ids carry."""
+
+    __slots__ = ("data", "id", "adler")
+
+    def __init__(self, data: bytes) -> None:
+        self.data = bytes(data)
+        self.id = hashlib.blake2b(self.data, digest_size=_ZDICT_ID_SIZE).digest()
+        self.adler = zlib.adler32(self.data)
+
+
+def _compress_level(size: int) -> int:
+    for limit, level in _COMPRESS_LEVELS:
+        if size <= limit:
+            return level
+    return 1
+
+
+def _json_text(blob: Any) -> bytes:
+    return json.dumps(blob, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def _json_encode(blob: Any, zdict: _Zdict | None = None) -> bytes:
+    """JSON-encode an arbitrary JSON-serializable object and compress it
+    as its size warrants (see module docstring), against the preset
+    dictionary ``zdict`` if given.
 
     Raises ``TypeError`` if ``blob`` contains values JSON cannot represent
     (bytes, sets, custom objects, etc.). Tuples become lists and integer
     dict keys become strings on round-trip — see module docstring."""
-    encoded = json.dumps(blob, separators=(",", ":"), ensure_ascii=False)
-    return zlib.compress(encoded.encode("utf-8"), 1)
+    text = _json_text(blob)
+    size = len(text)
+    if zdict is not None and size >= _ZDICT_MIN_BYTES:
+        c = zlib.compressobj(
+            _compress_level(size),
+            zlib.DEFLATED,
+            -zlib.MAX_WBITS,
+            zdict=zdict.data,
+        )
+        packed = c.compress(text) + c.flush()
+        if len(packed) + _ZDICT_ID_SIZE < size:
+            return _TAG_JSON_ZDICT + zdict.id + packed
+    elif zdict is None and size >= _COMPRESS_MIN_BYTES:
+        packed = zlib.compress(text, _compress_level(size))
+        if len(packed) < size:
+            return packed
+    return _TAG_JSON_PLAIN + text
+
+
+def _json_decode(data: bytes | memoryview, zdict: _Zdict | None = None) -> Any:
+    """Decode what ``_json_encode`` wrote. A message compressed against a
+    preset dictionary only decodes with that same ``zdict``."""
+    tag = data[0]
+    if tag == _TAG_JSON_PLAIN[0]:
+        return json.loads(bytes(data[1:]))
+    if tag == _TAG_JSON_ZDICT[0] or tag == _TAG_JSON_ZDICT_ADLER[0]:
+        if tag == _TAG_JSON_ZDICT[0]:
+            start = 1 + _ZDICT_ID_SIZE
+            named = bytes(data[1:start])
+            known = zdict is not None and named == zdict.id
+        else:
+            start = 1 + _U32.size
+            named = bytes(data[1:start])
+            known = zdict is not None and _U32.unpack(named)[0] == zdict.adler
+        if not known:
+            raise ValueError(
+                "compressed with preset dictionary %s, which this client "
+                "lacks (construct it with the same zdict)" % named.hex()
+            )
+        d = zlib.decompressobj(-zlib.MAX_WBITS, zdict=zdict.data)
+        text = d.decompress(data[start:]) + d.flush()
+        if not d.eof:
+            raise ValueError("truncated deflate stream")
+        return json.loads(text)
+    return json.loads(zlib.decompress(data).decode("utf-8"))
+
+
+def _raw_encode(blob: Any) -> bytes:
+    if not isinstance(blob, (bytes, bytearray, memoryview)):
+        raise TypeError(
+            "the raw codec only sends bytes-like objects, got %s" % type(blob).__name__
+        )
+    return _TAG_RAW + bytes(blob)
+
+
+def _raw_decode(data: bytes | memoryview) -> bytes:
+    return bytes(data[1:])
+
+
+def _write_varint(out: bytearray, n: int) -> None:
+    """Append non-negative ``n`` as a little-endian base-128 varint."""
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(view: memoryview, offset: int) -> tuple[int, int]:
+    """Return ``(value, next_offset)`` for the varint at ``offset``."""
+    n = shift = 0
+    while True:
+        byte = view[offset]
+        offset += 1
+        n |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return n, offset
+        shift += 7
 
 
-def _deserialize(data: bytes) -> Any:
-    """Inverse of ``_serialize``. Raises ``ValueError`` on malformed input."""
+def _binary_write(value: Any, out: bytearray, depth: int) -> None:
+    if depth > _BINARY_MAX_DEPTH:
+        raise ValueError(
+            "nested deeper than %d levels (circular reference?)" % _BINARY_MAX_DEPTH
+        )
+    if value is None:
+        out.append(_B_NONE)
+    elif value is True:
+        out.append(_B_TRUE)
+    elif value is False:
+        out.append(_B_FALSE)
+    elif isinstance(value, int):
+        out.append(_B_INT)
+        # Zigzag, so small negative numbers stay short too.
+        _write_varint(out, value << 1 if value >= 0 else (-value << 1) - 1)
+    elif isinstance(value, float):
+        out.append(_B_FLOAT)
+        out += _F64.pack(value)
+    elif isinstance(value, str):
+        data = value.encode("utf-8")
+        out.append(_B_STR)
+        _write_varint(out, len(data))
+        out += data
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        data = bytes(value)
+        out.append(_B_BYTES)
+        _write_varint(out, len(data))
+        out += data
+    elif isinstance(value, (list, tuple)):
+        out.append(_B_LIST if isinstance(value, list) else _B_TUPLE)
+        _write_varint(out, len(value))
+        for item in value:
+            _binary_write(item, out, depth + 1)
+    elif isinstance(value, dict):
+        out.append(_B_DICT)
+        _write_varint(out, len(value))
+        for key, item in value.items():
+            _binary_write(key, out, depth + 1)
+            _binary_write(item, out, depth + 1)
+    else:
+        raise TypeError("the binary codec cannot encode %s" % type(value).__name__)
+
+
+def _binary_read(view: memoryview, offset: int, depth: int) -> tuple[Any, int]:
+    """Return ``(value, next_offset)`` for the value at ``offset``."""
+    if depth > _BINARY_MAX_DEPTH:
+        raise ValueError("nested deeper than %d levels" % _BINARY_MAX_DEPTH)
+    marker = view[offset]
+    offset += 1
+    if marker == _B_NONE:
+        return None, offset
+    if marker == _B_TRUE:
+        return True, offset
+    if marker == _B_FALSE:
+        return False, offset
+    if marker == _B_INT:
+        n, offset = _read_varint(view, offset)
+        return (-(n >> 1) - 1 if n & 1 else n >> 1), offset
+    if marker == _B_FLOAT:
+        (f,) = _F64.unpack_from(view, offset)
+        return f, offset + _F64.size
+    if marker == _B_STR or marker == _B_BYTES:
+        n, offset = _read_varint(view, offset)
+        if offset + n > len(view):
+            raise ValueError("truncated string at offset %d" % offset)
+        data = bytes(view[offset : offset + n])
+        return (data.decode("utf-8") if marker == _B_STR else data), offset + n
+    if marker == _B_LIST or marker == _B_TUPLE:
+        n, offset = _read_varint(view, offset)
+        items = []
+        for _ in range(n):
+            item, offset = _binary_read(view, offset, depth + 1)
+            items.append(item)
+        return (items if marker == _B_LIST else tuple(items)), offset
+    if marker == _B_DICT:
+        n, offset = _read_varint(view, offset)
+        result = {}
+        for _ in range(n):
+            key, offset = _binary_read(view, offset, depth + 1)
+            result[key], offset = _binary_read(view, offset, depth + 1)
+        return result, offset
+    raise ValueError("unknown type marker 0x%02x at offset %d" % (marker, offset - 1))
+
+
+def _binary_encode(blob: Any) -> bytes:
+    out = bytearray(_TAG_BINARY)
+    _binary_write(blob, out, 0)
+    return bytes(out)
+
+
+def _binary_decode(data: bytes | memoryview) -> Any:
+    view = memoryview(data)
+    value, offset = _binary_read(view, 1, 0)
+    if offset != len(view):
+        raise ValueError("%d trailing bytes" % (len(view) - offset))
+    return value
+
+
+class _Codec:
+    """A named message encoding. Everything ``encode`` returns starts with
+    one of the ``tags`` bytes; ``decode`` gets the whole encoded message,
+    tag included."""
+
+    __slots__ = ("name", "tags", "encode", "decode")
+
+    def __init__(
+        self,
+        name: str,
+        tags: bytes,
+        encode: Callable[[Any], bytes],
+        decode: Callable[[bytes | memoryview], Any],
+    ) -> None:
+        self.name = name
+        self.tags = tags
+        self.encode = encode
+        self.decode = decode
+
+
+_CODECS: dict[str, _Codec] = {
+    codec.name: codec
+    for codec in (
+        _Codec(
+            "json",
+            _TAG_JSON + _TAG_JSON_PLAIN + _TAG_JSON_ZDICT_ADLER + _TAG_JSON_ZDICT,
+            _json_encode,
+            _json_decode,
+        ),
+        _Codec("raw", _TAG_RAW, _raw_encode, _raw_decode),
+        _Codec("binary", _TAG_BINARY, _binary_encode, _binary_decode),
+    )
+}
+_CODECS_BY_TAG: dict[int, _Codec] = {tag: c for c in _CODECS.values() for tag in c.tags}
+
+
+def _deserialize(
+    data: bytes | memoryview, codecs: dict[int, _Codec] = _CODECS_BY_TAG
+) -> Any:
+    """Decode a message written by any codec, chosen by its tag byte from
+    ``codecs`` (a client's own, to decode with its preset dictionary).
+    Raises ``ValueError`` on malformed input."""
+    codec = codecs.get(data[0]) if len(data) else None
+    if codec is None:
+        raise ValueError("malformed payload: unknown codec tag")
     try:
-        return json.loads(zlib.decompress(data).decode("utf-8"))
-    except (zlib.error, UnicodeDecodeError, ValueError) as ex:
-        raise ValueError("malformed payload: %s" % ex) from ex
+        return codec.decode(data)
+    except (
+        zlib.error,
+        UnicodeDecodeError,
+        ValueError,
+        IndexError,
+        TypeError,
+        struct.error,
+    ) as ex:
+        raise ValueError("malformed %s payload: %s" % (codec.name, ex)) from ex
+
+
+def _queue_table(name: str) -> str:
+    """Return the table holding queue ``name``. Raises ``ValueError`` if
+    ``name`` is not a valid queue name."""
+    if name in _TABLES:
+        return name
+    if (
+        not isinstance(name, str)
+        or len(name) > _MAX_QUEUE_NAME
+        or not _QUEUE_NAME.fullmatch(name)
+    ):
+        raise ValueError(
+            "invalid queue name %r: use up to %d lowercase letters, digits "
+            "and single underscores, starting with a letter" % (name, _MAX_QUEUE_NAME)
+        )
+    return "q_" + name
+
+
+def _room_key(name: str) -> str:
+    """Notifier key on which PUTs blocked on queue ``name`` wait for room.
+    Queue names have no colon, so it never collides with a queue's own."""
+    return "room:" + name
+
+
+def _pack_queue_name(name: str) -> bytes:
+    """Encode a queue name as the ``<u8 length><ascii>`` prefix of a named
+    queue request. Raises ``ValueError`` for an invalid name."""
+    _queue_table(name)
+    data = name.encode("ascii")
+    return bytes((len(data),)) + data
+
+
+def _split_queue_name(payload: bytes | memoryview) -> tuple[str, memoryview]:
+    """Inverse of ``_pack_queue_name``: return ``(name, rest)``. Raises
+    ``ValueError`` if the prefix is truncated or not ASCII."""
+    view = memoryview(payload)
+    if not view or len(view) < 1 + view[0]:
+        raise ValueError("truncated queue name")
+    n = view[0]
+    return bytes(view[1 : 1 + n]).decode("ascii"), view[1 + n :]
+
+
+def _split_request_id(body: memoryview) -> tuple[bytes, memoryview]:
+    """Split a protocol-2 payload into its 4-byte request ID and the rest.
+    Raises ``ValueError`` if the payload is too short to carry an ID."""
+    if len(body) < _U32.size:
+        raise ValueError("frame too short for a request ID")
+    return bytes(body[: _U32.size]), body[_U32.size :]
+
+
+def _check_batch_size(max_items: int) -> None:
+    if (
+        isinstance(max_items, bool)
+        or not isinstance(max_items, int)
+        or not 1 <= max_items <= _MAX_BATCH_ITEMS
+    ):
+        raise ValueError(
+            "max_items must be an integer between 1 and %d, got %r"
+            % (_MAX_BATCH_ITEMS, max_items)
+        )
+
+
+def _put_options(queue: str, priority: int, delay_seconds: float) -> bytes:
+    """The prefix of an ``_OP_QPUT_OPTIONS`` request. Raises
+    ``ValueError`` for an invalid queue name, priority or delay."""
+    if (
+        isinstance(priority, bool)
+        or not isinstance(priority, int)
+        or not _MIN_PRIORITY <= priority <= _MAX_PRIORITY
+    ):
+        raise ValueError(
+            "priority must be an integer between %d and %d, got %r"
+            % (_MIN_PRIORITY, _MAX_PRIORITY, priority)
+        )
+    if not 0 <= delay_seconds * 1000 <= _MAX_DELAY_MS:
+        raise ValueError(
+            "delay_seconds must be between 0 and %d, got %r"
+            % (_MAX_DELAY_MS // 1000, delay_seconds)
+        )
+    return (
+        _pack_queue_name(queue)
+        + _I32.pack(priority)
+        + _U32.pack(round(delay_seconds * 1000))
+    )
+
+
+def _check_overflow(overflow: str) -> None:
+    if overflow not in _OVERFLOW_POLICIES:
+        raise ValueError(
+            "overflow must be one of %s, got %r" % (_OVERFLOW_POLICIES, overflow)
+        )
+
+
+def _backoff(n: int, floor: float) -> float:
+    """Seconds to wait before retrying after the ``n``-th failure in a row
+    (from 1): ``floor`` doubled ``n - 1`` times, capped at
+    ``_MAX_BACKOFF_SECONDS``, plus up to half again as jitter so that
+    producers turned away together do not all come back together."""
+    delay = min(_MAX_BACKOFF_SECONDS, floor * 2 ** (n - 1))
+    return delay + random() * delay / 2
+
+
+def _lease_ms(lease_seconds: float) -> int:
+    """``lease_seconds`` in whole milliseconds, as a lease request carries
+    it. Raises ``ValueError`` if it is out of range."""
+    if not 0 < lease_seconds * 1000 <= _MAX_LEASE_MS:
+        raise ValueError(
+            "lease_seconds must be > 0 and at most %d, got %r"
+            % (_MAX_LEASE_MS // 1000, lease_seconds)
+        )
+    return max(1, round(lease_seconds * 1000))
+
+
+def _refused(payload: bytes | memoryview) -> ValueError:
+    """The exception a client raises for an ``_OP_ERROR`` response."""
+    return ValueError(bytes(payload).decode("utf-8", "replace"))
+
+
+def _nacked(payload: bytes | memoryview) -> QueueFull:
+    """The exception a client raises for an ``_OP_NACK`` response."""
+    if len(payload) < _U32.size:
+        raise ConnectionError("malformed NACK")
+    (retry_after_ms,) = _U32.unpack_from(payload)
+    reason = bytes(payload[_U32.size :]).decode("utf-8", "replace")
+    return QueueFull(reason, retry_after_ms / 1000.0)
+
+
+def _nack(ex: QueueFull) -> tuple[bytes, bytes]:
+    """The ``_OP_NACK`` response refusing a PUT with ``ex``."""
+    retry_after_ms = min(round(ex.retry_after * 1000), _MAX_DELAY_MS)
+    return _OP_NACK, _U32.pack(retry_after_ms) + str(ex).encode("utf-8")
+
+
+def _decode_item(
+    resp_opcode: bytes,
+    payload: bytes | memoryview,
+    codecs: dict[int, _Codec] = _CODECS_BY_TAG,
+) -> Any:
+    """Turn a single-GET response into its item, decoded with ``codecs``
+    (see ``_deserialize``). Raises ``queue.Empty``, ``ValueError`` if the
+    server refused the request, or ``ConnectionError``."""
+    if resp_opcode == _OP_EMPTY:
+        raise Empty()
+    if resp_opcode == _OP_ERROR:
+        raise _refused(payload)
+    if resp_opcode == _OP_ITEM:
+        try:
+            return _deserialize(payload, codecs)
+        except ValueError as ex:
+            raise ConnectionError(str(ex)) from ex
+    raise ConnectionError("unexpected response opcode 0x%02x" % resp_opcode[0])
+
+
+def _decode_items(
+    resp_opcode: bytes,
+    payload: bytes | memoryview,
+    codecs: dict[int, _Codec] = _CODECS_BY_TAG,
+) -> list[Any]:
+    """Turn a batch-GET response into its items. Raises like
+    ``_decode_item``."""
+    if resp_opcode == _OP_EMPTY:
+        raise Empty()
+    if resp_opcode == _OP_ERROR:
+        raise _refused(payload)
+    if resp_opcode == _OP_ITEMS:
+        try:
+            return [_deserialize(item, codecs) for item in _unpack_items(payload)]
+        except ValueError as ex:
+            raise ConnectionError(str(ex)) from ex
+    raise ConnectionError("unexpected response opcode 0x%02x" % resp_opcode[0])
+
+
+def _chain_future(source: Future[_T], convert: Callable[[_T], Any]) -> Future[Any]:
+    """Return a future that resolves to ``convert(source.result())``, or
+    with whatever ``source`` or ``convert`` raised."""
+    result: Future[Any] = Future()
+    result.set_running_or_notify_cancel()
+
+    def done(f: Future[_T]) -> None:
+        try:
+            result.set_result(convert(f.result()))
+        except Exception as ex:
+            result.set_exception(ex)
+
+    source.add_done_callback(done)
+    return result
+
+
+def _prometheus_text(metrics: dict[str, Any]) -> str:
+    """Render a ``MyQueue.metrics()`` snapshot in the Prometheus text
+    exposition format."""
+    lines: list[str] = []
+
+    def header(name: str, kind: str, text: str) -> None:
+        lines.append("# HELP tcpqueue_%s %s" % (name, text))
+        lines.append("# TYPE tcpqueue_%s %s" % (name, kind))
+
+    def labels(**kv: str) -> str:
+        return ",".join('%s="%s"' % item for item in kv.items())
+
+    def histogram(name: str, hist: dict[str, Any], **kv: str) -> None:
+        for bound, n in hist["buckets"].items():
+            le = "+Inf" if bound == math.inf else repr(bound)
+            lines.append("tcpqueue_%s_bucket{%s} %d" % (name, labels(**kv, le=le), n))
+        suffix = "{%s}" % labels(**kv) if kv else ""
+        lines.append("tcpqueue_%s_sum%s %r" % (name, suffix, hist["sum"]))
+        lines.append("tcpqueue_%s_count%s %d" % (name, suffix, hist["count"]))
+
+    header("requests_total", "counter", "Requests handled, by opcode.")
+    for op, n in metrics["requests"].items():
+        lines.append("tcpqueue_requests_total{%s} %d" % (labels(opcode=op), n))
+    header("request_seconds", "histogram", "Time to execute a request.")
+    for op, hist in metrics["request_seconds"].items():
+        histogram("request_seconds", hist, opcode=op)
+    for name, text in (
+        ("frame_read_seconds", "From a frame's first byte to all of it."),
+        ("hmac_verify_seconds", "Verifying the HMAC of a received frame."),
+        ("sqlite_lock_wait_seconds", "Waiting in BEGIN IMMEDIATE for the lock."),
+        ("sqlite_commit_seconds", "Running COMMIT."),
+        ("response_write_seconds", "Writing responses to the socket."),
+    ):
+        header(name, "histogram", text)
+        histogram(name, metrics[name])
+    header("queue_depth", "gauge", "Messages in each queue.")
+    for queue, n in metrics["queue_depth"].items():
+        lines.append("tcpqueue_queue_depth{%s} %d" % (labels(queue=queue), n))
+    header("wal_bytes", "gauge", "Size of the WAL file(s).")
+    lines.append("tcpqueue_wal_bytes %d" % metrics["wal_bytes"])
+    header("compact_reclaimed_pages_total", "counter", "Pages compaction freed.")
+    lines.append(
+        "tcpqueue_compact_reclaimed_pages_total %d" % metrics["compact_reclaimed_pages"]
+    )
+    header("ttl_reaped_total", "counter", "Messages deleted by TTL, by queue.")
+    for queue, n in metrics["ttl_reaped"].items():
+        lines.append("tcpqueue_ttl_reaped_total{%s} %d" % (labels(queue=queue), n))
+    header("ttl_reap_backlog", "gauge", "Expired messages not yet reaped, by queue.")
+    for queue, n in metrics["ttl_reap_backlog"].items():
+        lines.append("tcpqueue_ttl_reap_backlog{%s} %d" % (labels(queue=queue), n))
+    header("connections", "gauge", "Open client connections.")
+    lines.append("tcpqueue_connections %d" % metrics["connections"])
+    return "\n".join(lines) + "\n"
+
+
+def _pack_items(items: list[bytes]) -> bytes:
+    """Encode a list of payloads as ``<u32 length><bytes>`` records."""
+    parts: list[bytes] = []
+    for item in items:
+        parts.append(_U32.pack(len(item)))
+        parts.append(item)
+    return b"".join(parts)
+
+
+def _unpack_items(data: bytes | memoryview) -> list[bytes]:
+    """Inverse of ``_pack_items``. Raises ``ValueError`` on a truncated or
+    otherwise malformed record stream."""
+    items: list[bytes] = []
+    view = memoryview(data)
+    offset = 0
+    while offset < len(view):
+        if offset + _U32.size > len(view):
+            raise ValueError("truncated item length at offset %d" % offset)
+        (n,) = _U32.unpack_from(view, offset)
+        offset += _U32.size
+        if offset + n > len(view):
+            raise ValueError("truncated item body at offset %d" % offset)
+        items.append(bytes(view[offset : offset + n]))
+        offset += n
+    return items
+
+
+class _FrameMac:
+    """Signs and verifies frames with HMAC-SHA256 under ``secret_key``:
+    every frame of protocols 1 and 2, and the HELLO exchange of protocol
+    3. Stateless, so one instance serves every connection.
+
+    The key is absorbed once; each frame then starts from a ``copy()`` of
+    that state instead of building a fresh HMAC object."""
+
+    def __init__(self, secret_key: bytes) -> None:
+        self._send = self._recv = hmac.new(secret_key, digestmod=hashlib.sha256)
+
+    def sign(self, *chunks: bytes | memoryview) -> bytes:
+        mac = self._send.copy()
+        for chunk in chunks:
+            mac.update(chunk)
+        return mac.digest()
+
+    def verify(self, msg: memoryview, tag: memoryview) -> bool:
+        mac = self._recv.copy()
+        mac.update(msg)
+        return hmac.compare_digest(mac.digest(), tag)
+
+
+class _SessionMac(_FrameMac):
+    """The MAC of one protocol-3 connection after its handshake.
+
+    Each direction has a key of its own and counts its frames. A frame's
+    MAC covers its sequence number (which is implied, not sent), so a
+    frame replayed, dropped or reordered within the connection fails
+    verification, as does one replayed from any other connection (other
+    nonces, other keys) or reflected back at its sender (other key).
+    Frames must therefore be signed in exactly the order they are sent."""
+
+    def __init__(self, send_key: bytes, recv_key: bytes, mac_id: int) -> None:
+        if mac_id == _SESSION_MACS["blake2b"]:
+            self._send = hashlib.blake2b(key=send_key, digest_size=_HMAC_SIZE)
+            self._recv = hashlib.blake2b(key=recv_key, digest_size=_HMAC_SIZE)
+        else:
+            self._send = hmac.new(send_key, digestmod=hashlib.sha256)
+            self._recv = hmac.new(recv_key, digestmod=hashlib.sha256)
+        self._send_seq = 0
+        self._recv_seq = 0
+
+    def sign(self, *chunks: bytes | memoryview) -> bytes:
+        mac = self._send.copy()
+        mac.update(_U64.pack(self._send_seq))
+        self._send_seq += 1
+        for chunk in chunks:
+            mac.update(chunk)
+        return mac.digest()
+
+    def verify(self, msg: memoryview, tag: memoryview) -> bool:
+        mac = self._recv.copy()
+        mac.update(_U64.pack(self._recv_seq))
+        self._recv_seq += 1
+        mac.update(msg)
+        return hmac.compare_digest(mac.digest(), tag)
+
+
+def _session_mac(
+    secret_key: bytes,
+    client_nonce: bytes,
+    server_nonce: bytes,
+    mac_id: int,
+    client: bool,
+) -> _SessionMac:
+    """Derive the ``_SessionMac`` of one side of a protocol-3 connection
+    from the shared key and both nonces (an HKDF-style extract/expand)."""
+    prk = hmac.digest(
+        secret_key,
+        b"tcpQueue session" + client_nonce + server_nonce + bytes([mac_id]),
+        "sha256",
+    )
+    to_server = hmac.digest(prk, b"client to server", "sha256")
+    to_client = hmac.digest(prk, b"server to client", "sha256")
+    if client:
+        return _SessionMac(to_server, to_client, mac_id)
+    return _SessionMac(to_client, to_server, mac_id)
 
 
 class _Frame:
     """Frame I/O helpers. Stateless; just a namespace."""
 
     @staticmethod
-    def write(
-        sock: socket.socket,
+    def buffers(
         opcode: bytes,
-        payload: bytes,
-        secret_key: bytes | None,
-    ) -> None:
-        body = opcode + payload
-        if secret_key:
-            body += hmac.new(secret_key, body, hashlib.sha256).digest()
-        if len(body) > _MAX_FRAME_BYTES:
+        payload: bytes | memoryview,
+        mac: _FrameMac | None,
+        request_id: bytes = b"",
+    ) -> list[bytes | memoryview]:
+        """Return one frame as separate ``[header, opcode, request_id,
+        payload, mac]`` buffers, ready for a vectored send. ``request_id``
+        is empty on protocol-1 connections. The payload is never copied:
+        the MAC is computed incrementally over everything before it."""
+        length = len(opcode) + len(request_id) + len(payload)
+        if mac is not None:
+            length += _HMAC_SIZE
+        # Check before signing: a session MAC must not count a frame that
+        # is never sent.
+        if length > _MAX_FRAME_BYTES:
             raise ValueError(
-                "frame too large: %d bytes (max %d)" % (len(body), _MAX_FRAME_BYTES)
+                "frame too large: %d bytes (max %d)" % (length, _MAX_FRAME_BYTES)
             )
-        sock.sendall(str(len(body)).encode("ascii") + b":" + body)
+        parts: list[bytes | memoryview] = [b"%d:" % length, opcode, request_id, payload]
+        if mac is not None:
+            parts.append(mac.sign(opcode, request_id, payload))
+        return parts
 
     @staticmethod
-    def read(
-        sock: socket.socket, secret_key: bytes | None
-    ) -> tuple[bytes, bytes] | None:
-        """Return ``(opcode, payload)`` or ``None`` if the peer closed the
-        connection cleanly with no data buffered. Raises ``ValueError`` for
-        any malformed or unauthenticated frame."""
-        # Read the ASCII length header one byte at a time, stopping at the
-        # colon. Reading in larger chunks would consume bytes belonging to
-        # the *next* frame, which this stateless reader has nowhere to put.
-        header = bytearray()
-        while True:
-            chunk = sock.recv(1)
-            if not chunk:
-                if not header:
-                    return None  # clean close before any data arrived
-                raise ValueError("connection closed mid-header")
-            if chunk == b":":
-                break
-            header.extend(chunk)
-            if len(header) > _MAX_HEADER_BYTES:
-                raise ValueError(
-                    "header exceeds %d bytes; no colon found" % _MAX_HEADER_BYTES
-                )
+    def encode(opcode: bytes, payload: bytes, mac: _FrameMac | None) -> bytes:
+        """Return the complete on-the-wire bytes of one frame."""
+        return b"".join(_Frame.buffers(opcode, payload, mac))
+
+    @staticmethod
+    def decode(body: memoryview, mac: _FrameMac | None) -> tuple[bytes, memoryview]:
+        """Verify and split a frame body (everything after the colon) into
+        ``(opcode, payload)``. The payload is a slice of ``body``, not a
+        copy. Raises ``ValueError`` if unauthenticated."""
+        if mac is not None:
+            if len(body) < _HMAC_SIZE + 1:
+                raise ValueError("frame too short for HMAC")
+            if not mac.verify(body[:-_HMAC_SIZE], body[-_HMAC_SIZE:]):
+                raise ValueError("HMAC verification failed")
+            body = body[:-_HMAC_SIZE]
+        return bytes(body[:1]), body[1:]
 
-        length_str = bytes(header)
-        if not length_str.isdigit():
-            raise ValueError("non-numeric length: %r" % length_str)
-        length = int(length_str)
+    @staticmethod
+    def parse_length(header: bytes) -> int:
+        """Validate the ASCII length prefix and return it as an int."""
+        if not header.isdigit():
+            raise ValueError("non-numeric length: %r" % header)
+        length = int(header)
         if length < 1:
             raise ValueError("frame too short: length=%d" % length)
         if length > _MAX_FRAME_BYTES:
             raise ValueError(
                 "frame too large: %d bytes (max %d)" % (length, _MAX_FRAME_BYTES)
             )
+        return length
 
-        body_buf = bytearray()
-        while len(body_buf) < length:
-            chunk = sock.recv(min(length - len(body_buf), _RECV_CHUNK))
-            if not chunk:
+    @staticmethod
+    def write(
+        sock: socket.socket,
+        opcode: bytes,
+        payload: bytes | memoryview,
+        mac: _FrameMac | None,
+        request_id: bytes = b"",
+    ) -> None:
+        _send_buffers(sock, _Frame.buffers(opcode, payload, mac, request_id))
+
+    @staticmethod
+    def write_many(
+        sock: socket.socket,
+        frames: list[tuple[bytes, bytes | memoryview, bytes]],
+        mac: _FrameMac | None,
+    ) -> None:
+        """Write several ``(opcode, payload, request_id)`` frames with as
+        few syscalls as the kernel allows (normally one)."""
+        parts: list[bytes | memoryview] = []
+        for opcode, payload, request_id in frames:
+            parts.extend(_Frame.buffers(opcode, payload, mac, request_id))
+        _send_buffers(sock, parts)
+
+
+class _FrameReader:
+    """Buffered, stateful frame reader for one connection.
+
+    Reads with ``recv_into`` straight into a preallocated buffer, as much
+    as the socket has, and keeps any bytes past the end of one frame for
+    the next. Each header therefore costs no syscalls of its own. A frame
+    body larger than the buffer gets a dedicated buffer of exactly its
+    size.
+
+    Frames come back as ``(opcode, payload)`` where ``payload`` is a
+    ``memoryview`` into the reader's buffer: MAC verification,
+    decompression and SQLite inserts consume it without copying. The view
+    is only valid until the next ``read()`` / ``fill()``; callers that
+    keep a payload longer must take ``bytes(payload)``.
+
+    Used blocking via ``read()``, or non-blocking by calling ``fill()``
+    when the socket is readable and then ``next_frame()`` until it
+    returns ``None``. ``mac`` verifies each frame as it is parsed, so
+    replacing it after a handshake applies from the next frame on."""
+
+    def __init__(
+        self,
+        mac: _FrameMac | None,
+        capacity: int = _RECV_CHUNK,
+        metrics: _Metrics | None = None,
+    ) -> None:
+        self.mac = mac
+        # Server side: times each frame from its first byte on.
+        self._metrics = metrics
+        self._began = 0.0
+        self._buf = bytearray(capacity)
+        self._view = memoryview(self._buf)
+        self._start = 0  # first unconsumed byte in _buf
+        self._end = 0  # one past the last received byte in _buf
+        self._need: int | None = None  # body length once the header is parsed
+        self._big: memoryview | None = None  # buffer for an oversized body
+        self._big_filled = 0
+
+    def read(self, sock: socket.socket) -> tuple[bytes, memoryview] | None:
+        """Return the next frame, receiving as needed, or ``None`` if the
+        peer closed the connection cleanly between frames. Raises
+        ``ValueError`` for any malformed or unauthenticated frame; socket
+        timeouts propagate with the partial frame kept for a retry."""
+        while True:
+            frame = self.next_frame()
+            if frame is not None:
+                return frame
+            if self.fill(sock) == 0:
+                if self._need is None and self._start == self._end:
+                    return None  # clean close before any data arrived
+                if self._need is None:
+                    raise ValueError("connection closed mid-header")
                 raise ValueError("connection closed mid-body")
-            body_buf.extend(chunk)
 
-        body = bytes(body_buf)
+    def fill(self, sock: socket.socket) -> int:
+        """One ``recv_into`` call. Returns the byte count; 0 means EOF."""
+        if self._big is not None:
+            n = sock.recv_into(self._big[self._big_filled :])
+            self._big_filled += n
+            return n
+        if self._end == len(self._buf):
+            self._compact()
+        n = sock.recv_into(self._view[self._end :])
+        self._end += n
+        return n
+
+    def next_frame(self) -> tuple[bytes, memoryview] | None:
+        """Parse one frame out of what is already buffered, without any
+        I/O. Returns ``None`` if no complete frame is buffered."""
+        if self._big is not None:
+            if self._big_filled < len(self._big):
+                return None
+            body, self._big = self._big, None
+            self._need = None
+            return self._decode(body)
+
+        if self._need is None:
+            if self._metrics is not None and self._end > self._start:
+                self._began = time.perf_counter()
+            limit = min(self._end, self._start + _MAX_HEADER_BYTES + 1)
+            colon = self._buf.find(b":", self._start, limit)
+            if colon < 0:
+                if self._end - self._start > _MAX_HEADER_BYTES:
+                    raise ValueError(
+                        "header exceeds %d bytes; no colon found" % _MAX_HEADER_BYTES
+                    )
+                return None
+            self._need = _Frame.parse_length(bytes(self._view[self._start : colon]))
+            self._start = colon + 1
+            if self._need > len(self._buf):
+                # Give the body its own buffer so recv_into can fill it in
+                # place; copy over whatever part of it already arrived.
+                have = self._end - self._start
+                self._big = memoryview(bytearray(self._need))
+                self._big[:have] = self._view[self._start : self._end]
+                self._big_filled = have
+                self._start = self._end = 0
+                return None
+
+        if self._end - self._start < self._need:
+            if self._start + self._need > len(self._buf):
+                self._compact()
+            return None
+        body = self._view[self._start : self._start + self._need]
+        self._start += self._need
+        self._need = None
+        return self._decode(body)
+
+    def _decode(self, body: memoryview) -> tuple[bytes, memoryview]:
+        metrics = self._metrics
+        if metrics is None:
+            return _Frame.decode(body, self.mac)
+        t0 = time.perf_counter()
+        metrics.frame_read.observe(t0 - self._began)
+        frame = _Frame.decode(body, self.mac)
+        if self.mac is not None:
+            metrics.hmac_verify.observe(time.perf_counter() - t0)
+        return frame
+
+    def _compact(self) -> None:
+        """Move the unconsumed tail to the front of the buffer. Invalidates
+        previously returned payload views."""
+        n = self._end - self._start
+        if self._start:
+            self._buf[:n] = bytes(self._view[self._start : self._end])
+        self._start, self._end = 0, n
+
+
+class _QueueConfig:
+    """Settings of one queue, and the table its rows live in. ``dropped``
+    is set by ``drop_queue()`` before the table goes, so requests still
+    holding the config can tell why it vanished."""
+
+    __slots__ = (
+        "name",
+        "table",
+        "max_queue_size",
+        "ttl_seconds",
+        "overflow",
+        "dropped",
+    )
 
-        if secret_key:
-            if len(body) < _HMAC_SIZE + 1:
-                raise ValueError("frame too short for HMAC")
-            msg, mac = body[:-_HMAC_SIZE], body[-_HMAC_SIZE:]
-            expected = hmac.new(secret_key, msg, hashlib.sha256).digest()
-            if not hmac.compare_digest(mac, expected):
-                raise ValueError("HMAC verification failed")
-            body = msg
+    def __init__(
+        self,
+        name: str,
+        max_queue_size: int,
+        ttl_seconds: float | None,
+        overflow: str = "drop_oldest",
+    ) -> None:
+        self.name = name
+        self.table = _queue_table(name)
+        self.max_queue_size = max_queue_size
+        self.ttl_seconds = ttl_seconds
+        self.overflow = overflow
+        self.dropped = False
+
+
+class _Notifier:
+    """Wakes long-poll GETs when rows are committed to a queue, and PUTs
+    blocked on a full queue when rows leave it (under ``_room_key``).
+
+    Each queue has a sequence number bumped by every ``notify()``. A
+    waiter reads the sequence *before* checking the queue, then waits for
+    it to change, so a commit landing between the check and the wait is
+    never missed. Listeners registered with ``subscribe()`` are called
+    (on the notifying thread) for event loops that cannot block."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()  # guards creation of _conds entries
+        self._conds: dict[str, threading.Condition] = {}
+        self._seq: dict[str, int] = {}
+        self._listeners: list[Callable[[str], None]] = []
+
+    def _cond(self, queue: str) -> threading.Condition:
+        cond = self._conds.get(queue)
+        if cond is None:
+            with self._lock:
+                cond = self._conds.setdefault(queue, threading.Condition())
+        return cond
+
+    def seq(self, queue: str) -> int:
+        with self._cond(queue):
+            return self._seq.get(queue, 0)
+
+    def notify(self, queue: str) -> None:
+        cond = self._cond(queue)
+        with cond:
+            self._seq[queue] = self._seq.get(queue, 0) + 1
+            cond.notify_all()
+        for listener in list(self._listeners):
+            listener(queue)
+
+    def wait(self, queue: str, seen: int, timeout: float) -> bool:
+        """Block until ``queue``'s sequence moves past ``seen`` or
+        ``timeout`` elapses. Returns ``True`` if it moved."""
+        cond = self._cond(queue)
+        with cond:
+            return cond.wait_for(lambda: self._seq.get(queue, 0) != seen, timeout)
+
+    def subscribe(self, listener: Callable[[str], None]) -> None:
+        self._listeners.append(listener)
+
+    def unsubscribe(self, listener: Callable[[str], None]) -> None:
+        try:
+            self._listeners.remove(listener)
+        except ValueError:
+            pass
+
+
+class _Histogram:
+    """Latency histogram over ``_LATENCY_BUCKETS`` (seconds), kept the way
+    Prometheus exposes one: a count per bucket plus a running sum."""
+
+    __slots__ = ("lock", "counts", "sum")
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(_LATENCY_BUCKETS) + 1)  # the last is +Inf
+        self.sum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        i = bisect_left(_LATENCY_BUCKETS, seconds)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += seconds
+
+    def snapshot(self) -> dict[str, Any]:
+        """``{"count", "sum", "buckets"}``, where ``buckets`` maps each
+        upper bound (``math.inf`` last) to the cumulative count."""
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = list(accumulate(counts))
+        return {
+            "count": cumulative[-1],
+            "sum": total,
+            "buckets": dict(zip((*_LATENCY_BUCKETS, math.inf), cumulative)),
+        }
+
+
+class _Metrics:
+    """The counters and latency histograms a server updates on its hot
+    paths. Gauges (queue depths, WAL size, connections) are read when a
+    snapshot is taken instead; see ``MyQueue.metrics()``."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.requests: dict[bytes, _Histogram] = {}  # by opcode
+        self.frame_read = _Histogram()
+        self.hmac_verify = _Histogram()
+        self.lock_wait = _Histogram()
+        self.commit = _Histogram()
+        self.response_write = _Histogram()
+        self.compacted_pages = 0
+        self.reaped: Counter[str] = Counter()
+        # Expired rows the last TTL reap pass left for the next, by queue.
+        self.reap_backlog: dict[str, int] = {}
+
+    def request(self, opcode: bytes, seconds: float) -> None:
+        hist = self.requests.get(opcode)
+        if hist is None:
+            with self._lock:
+                hist = self.requests.setdefault(opcode, _Histogram())
+        hist.observe(seconds)
+
+    def count_compacted(self, pages: int) -> None:
+        with self._lock:
+            self.compacted_pages += pages
+
+    def count_reaped(self, deleted: dict[str, int]) -> None:
+        with self._lock:
+            self.reaped.update(deleted)
+
+    def set_reap_backlog(self, backlog: dict[str, int]) -> None:
+        self.reap_backlog = backlog  # replaced whole, so readers need no lock
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """Answers ``GET /metrics`` on the admin port with the owning server's
+    metrics in the Prometheus text format."""
+
+    server: _MetricsHTTPServer
+
+    def do_GET(self) -> None:
+        if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        owner = self.server.owner
+        try:
+            body = _prometheus_text(owner.metrics()).encode("utf-8")
+        finally:
+            owner.close_db()  # each scrape runs on a thread of its own
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        log.debug("metrics: " + format, *args)
+
+
+class _MetricsHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, addr: tuple[str, int], owner: MyQueue) -> None:
+        self.owner = owner
+        super().__init__(addr, _MetricsHandler)
+
+
+class _HeadCache:
+    """Write-through in-memory copy of the head of one queue: its next
+    visible rows in delivery order, with their ids, up to ``capacity``
+    rows of at most ``_CACHE_MAX_PAYLOAD`` bytes each.
+
+    The table stays the source of truth. An entry is only handed out once
+    a ``DELETE`` that requires the row to still be visible has removed it
+    from disk, and whatever changes the table behind the cache's back
+    invalidates it, so a stale cache costs a refill but never loses or
+    duplicates a message. Callers hold ``lock``."""
+
+    __slots__ = ("lock", "capacity", "entries", "valid", "complete", "pending")
+
+    def __init__(self, capacity: int) -> None:
+        self.lock = threading.Lock()
+        self.capacity = capacity
+        # (-priority, id, payload), sorted: the next row to deliver first.
+        self.entries: list[tuple[int, int, bytes]] = []
+        # valid: entries are the head of the queue; complete: and every
+        # visible row in it. Valid, incomplete and empty means the head row
+        # is too big to cache.
+        self.valid = False
+        self.complete = False
+        # Ids taken out whose DELETE has not committed yet; a refill must
+        # not bring them back.
+        self.pending: set[int] = set()
+
+    def invalidate(self) -> None:
+        self.entries.clear()
+        self.valid = self.complete = False
+
+    def fill(self, rows: Iterable[tuple[int, int, bytes | None]], limit: int) -> None:
+        """Replace the entries with ``rows``: the first ``limit`` visible
+        rows of the table in delivery order, with ``None`` for the payload
+        of a row too big to cache. Stops reading at the first row it
+        cannot use."""
+        entries: list[tuple[int, int, bytes]] = []
+        n = 0
+        for n, (key, id_, payload) in enumerate(rows, 1):
+            if id_ in self.pending:
+                continue
+            if payload is None or len(entries) == self.capacity:
+                complete = False
+                break
+            entries.append((key, id_, payload))
+        else:
+            complete = n < limit
+        self.entries = entries
+        self.valid, self.complete = True, complete
+
+    def take(self, max_items: int, overhead: int) -> list[tuple[int, int, bytes]]:
+        """Remove up to ``max_items`` entries from the front, as many as fit
+        in ``_BATCH_BUDGET`` counting ``overhead`` bytes per entry (the
+        first always fits), and mark them pending."""
+        if max_items == 1:
+            taken = [self.entries.pop(0)]
+        else:
+            n = total = 0
+            for entry in self.entries[:max_items]:
+                total += len(entry[2]) + overhead
+                if n and total > _BATCH_BUDGET:
+                    break
+                n += 1
+            taken = self.entries[:n]
+            del self.entries[:n]
+        self.pending.update(entry[1] for entry in taken)
+        if not self.entries and not self.complete:
+            self.valid = False  # drained; refill on next use
+        return taken
+
+    def insert(self, priority: int, ids: range, payloads: list[bytes]) -> None:
+        """Add freshly committed visible rows that belong in the head."""
+        if not self.valid:
+            return
+        entries = self.entries
+        for id_, payload in zip(ids, payloads):
+            key = (-priority, id_)
+            if not self.complete and (not entries or key > entries[-1][:2]):
+                return  # behind the cached head; stays on disk only
+            i = bisect_left(entries, key)
+            if id_ in self.pending or (i < len(entries) and entries[i][1] == id_):
+                continue  # a refill already picked it up
+            if len(payload) > _CACHE_MAX_PAYLOAD:
+                # The head now ends just before a row too big to cache.
+                del entries[i:]
+                self.complete = False
+                return
+            entries.insert(i, (-priority, id_, payload))
+            if len(entries) > self.capacity:
+                entries.pop()
+                self.complete = False
+
+
+class _SegmentLog:
+    """One queue of the ``storage="segments"`` engine: append-only segment
+    files, named by a sequence number, in a directory of their own, plus a
+    16-byte ``offset`` file recording where the next read starts.
+
+    Records are only ever appended to the newest segment and read from the
+    front, so a PUT is one sequential ``write()`` and a GET just moves the
+    read offset on. A segment the offset has moved past holds nothing but
+    consumed records and is deleted whole. Every method takes ``lock``."""
+
+    def __init__(self, directory: Path, fsync: str) -> None:
+        self.lock = threading.Lock()
+        self._dir = directory
+        self._fsync = fsync
+        directory.mkdir(parents=True, exist_ok=True)
+        self._offset_fd = os.open(directory / "offset", os.O_RDWR | os.O_CREAT, 0o600)
+        numbers = sorted(int(p.stem) for p in directory.glob("*" + _SEGMENT_SUFFIX))
+        saved = os.pread(self._offset_fd, _SEGMENT_OFFSET.size, 0)
+        if len(saved) == _SEGMENT_OFFSET.size:
+            first, read_pos = _SEGMENT_OFFSET.unpack(saved)
+        else:
+            first, read_pos = (numbers[0] if numbers else 0), 0
+        for n in numbers:
+            if n < first:  # consumed; a crash beat its deletion
+                os.unlink(self._path(n))
+        numbers = [n for n in numbers if n >= first] or [first]
+        if numbers[0] != first:
+            read_pos = 0  # the offset's own segment was deleted by hand
+        # Live segments, oldest first; reads start in the first.
+        self._segments: deque[int] = deque()
+        self._fds: dict[int, int] = {}
+        self._sizes: dict[int, int] = {}
+        for n in numbers:
+            self._open_segment(n)
+        self._truncate_torn_tail()
+        self._read_pos = min(read_pos, self._sizes[numbers[0]])
+        self._count = sum(1 for _ in self._records(payloads=False))
+        self._dirty = False  # written since the last fsync
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _path(self, n: int) -> Path:
+        return self._dir / ("%020d%s" % (n, _SEGMENT_SUFFIX))
+
+    def _open_segment(self, n: int) -> None:
+        fd = os.open(self._path(n), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+        self._segments.append(n)
+        self._fds[n] = fd
+        self._sizes[n] = os.fstat(fd).st_size
+
+    def _truncate_torn_tail(self) -> None:
+        """Cut off whatever follows the last whole record of the newest
+        segment: the remains of an append that a crash interrupted."""
+        tail = self._segments[-1]
+        data = memoryview(os.pread(self._fds[tail], self._sizes[tail], 0))
+        pos = 0
+        while pos + _SEGMENT_RECORD.size <= len(data):
+            length, _created_at, crc = _SEGMENT_RECORD.unpack_from(data, pos)
+            start, end = pos + _SEGMENT_RECORD.size, pos + _SEGMENT_RECORD.size + length
+            if end > len(data) or zlib.crc32(data[start:end]) != crc:
+                break
+            pos = end
+        if pos < len(data):
+            log.warning(
+                "Discarding %d bytes of torn records at the end of %s",
+                len(data) - pos,
+                self._path(tail),
+            )
+            os.ftruncate(self._fds[tail], pos)
+            self._sizes[tail] = pos
+
+    def _records(
+        self, payloads: bool = True
+    ) -> Iterator[tuple[int, int, float, bytes]]:
+        """``(segment, end, created_at, payload)`` of every unread record,
+        oldest first, where ``end`` is the position just past the record.
+        Reads ahead ``_SEGMENT_READ_AHEAD`` bytes at a time. Without
+        ``payloads`` a record too big for the read-ahead is skipped over
+        unread and comes back with an empty payload."""
+        header = _SEGMENT_RECORD.size
+        pos = self._read_pos
+        for seg in self._segments:
+            fd, size = self._fds[seg], self._sizes[seg]
+            buf, base = b"", pos  # buf holds the bytes from base on
+            while pos < size:
+                if pos + header > base + len(buf):
+                    buf, base = os.pread(fd, _SEGMENT_READ_AHEAD, pos), pos
+                length, created_at, _crc = _SEGMENT_RECORD.unpack_from(buf, pos - base)
+                start, pos = pos + header, pos + header + length
+                if pos <= base + len(buf):
+                    payload = buf[start - base : pos - base]
+                else:
+                    payload = os.pread(fd, length, start) if payloads else b""
+                yield seg, pos, created_at, payload
+            pos = 0
+
+    def _read(self, max_items: int, budget: float) -> tuple[list[bytes], int, int]:
+        """The next ``max_items`` unread payloads, as many as fit in
+        ``budget`` bytes counting a 4-byte length prefix each (the first
+        always fits), and the segment and position just past the last."""
+        items: list[bytes] = []
+        end_seg, end = self._segments[0], self._read_pos
+        used = 0
+        for seg, pos, _created_at, payload in self._records():
+            used += len(payload) + _U32.size
+            if items and used > budget:
+                break
+            items.append(payload)
+            end_seg, end = seg, pos
+            if len(items) == max_items:
+                break
+        return items, end_seg, end
+
+    def _advance(self, seg: int, pos: int, records: int) -> None:
+        """Move the read offset to ``pos`` in segment ``seg``, past
+        ``records`` records, and delete the segments left behind. The new
+        offset is written before any segment is deleted, so a crash in
+        between leaves nothing that a restart would read twice."""
+        if pos == self._sizes[seg] and seg != self._segments[-1]:
+            seg, pos = self._segments[self._segments.index(seg) + 1], 0
+        os.pwrite(self._offset_fd, _SEGMENT_OFFSET.pack(seg, pos), 0)
+        self._dirty = True
+        while self._segments[0] != seg:
+            n = self._segments.popleft()
+            os.close(self._fds.pop(n))
+            del self._sizes[n]
+            os.unlink(self._path(n))
+        self._read_pos = pos
+        self._count -= records
+
+    def _skip(self, max_items: int, cutoff: float = math.inf) -> int:
+        """Consume up to ``max_items`` records created before ``cutoff``
+        without reading them. Returns how many."""
+        n = 0
+        end_seg, end = self._segments[0], self._read_pos
+        for seg, pos, created_at, _payload in self._records(payloads=False):
+            if n == max_items or created_at >= cutoff:
+                break
+            n += 1
+            end_seg, end = seg, pos
+        if n:
+            self._advance(end_seg, end, n)
+        return n
+
+    def append(
+        self, payloads: list[bytes], now: float, max_size: int, evict: bool = True
+    ) -> int:
+        """Append ``payloads`` as one write, first consuming the oldest
+        records if they would push the queue past ``max_size``. Returns how
+        many were dropped that way. Without ``evict``, raises
+        ``QueueFull`` instead."""
+        data = bytearray()
+        for payload in payloads:
+            data += _SEGMENT_RECORD.pack(len(payload), now, zlib.crc32(payload))
+            data += payload
+        with self.lock:
+            overflow = self._count - max_size + len(payloads)
+            if overflow > 0:
+                if not evict:
+                    raise QueueFull("queue is full (%d)" % max_size)
+                self._skip(overflow)
+            tail = self._segments[-1]
+            if self._sizes[tail] >= _SEGMENT_BYTES:
+                self._open_segment(tail + 1)
+                tail += 1
+                if self._fsync == "always":
+                    self._sync_dir()
+            fd, size = self._fds[tail], self._sizes[tail]
+            view = memoryview(data)
+            try:
+                while view:
+                    view = view[os.write(fd, view) :]
+                if self._fsync == "always":
+                    os.fsync(fd)
+            except OSError:
+                # Never leave half a batch for the next append to follow.
+                os.ftruncate(fd, size)
+                raise
+            self._sizes[tail] = size + len(data)
+            self._count += len(payloads)
+            self._dirty = True
+            return max(overflow, 0)
+
+    def pop(self, max_items: int, budget: int) -> list[bytes]:
+        """Consume up to ``max_items`` records, oldest first; see
+        ``_read`` for ``budget``."""
+        with self.lock:
+            items, seg, end = self._read(max_items, budget)
+            if items:
+                self._advance(seg, end, len(items))
+            return items
+
+    def peek(self, max_items: int = 1) -> list[bytes]:
+        """The next ``max_items`` payloads, left in place."""
+        with self.lock:
+            return self._read(max_items, math.inf)[0]
+
+    def reap(self, cutoff: float) -> int:
+        """Consume the records created before ``cutoff``. They are the
+        oldest ones, so this stops at the first newer record."""
+        with self.lock:
+            return self._skip(self._count, cutoff)
+
+    def clear(self) -> None:
+        with self.lock:
+            tail = self._segments[-1]
+            self._advance(tail, self._sizes[tail], self._count)
+
+    def sync(self) -> None:
+        """Flush the newest segment and the read offset to disk."""
+        with self.lock:
+            if self._dirty:
+                os.fsync(self._fds[self._segments[-1]])
+                os.fsync(self._offset_fd)
+                self._dirty = False
+
+    def _sync_dir(self) -> None:
+        """Make a new segment's directory entry durable."""
+        fd = os.open(self._dir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self) -> None:
+        with self.lock:
+            if self._fsync != "never" and self._dirty:
+                os.fsync(self._fds[self._segments[-1]])
+                os.fsync(self._offset_fd)
+            for fd in self._fds.values():
+                os.close(fd)
+            os.close(self._offset_fd)
+            self._fds.clear()
+
+
+class _SegmentStorage:
+    """The ``storage="segments"`` engine: a ``_SegmentLog`` per queue
+    table, in a directory of that name under ``root``, opened on first
+    use. While any log is open it holds an exclusive ``flock()`` on
+    ``root``: two writers appending to one log would corrupt it.
+
+    Has the same methods as ``_SqliteStorage``, minus what a plain FIFO
+    cannot do (``fifo_only``): priorities, delays, leases and streams."""
+
+    fifo_only = True
+
+    def __init__(self, root: Path, fsync: str) -> None:
+        self.root = root
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._logs: dict[str, _SegmentLog] = {}
+        self._dropped: set[str] = set()  # until declared again
+        self._root_fd: int | None = None
+        with self._lock:
+            self._claim()
+
+    def _claim(self) -> None:
+        """Lock ``root`` unless this storage already holds it. Raises
+        ``RuntimeError`` if another process, or another ``MyQueue`` of
+        this one, has it open. Called with ``_lock`` held."""
+        if self._root_fd is not None:
+            return
+        self.root.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.root, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise RuntimeError("%s is already open elsewhere" % self.root) from None
+        self._root_fd = fd
+
+    def log(self, table: str) -> _SegmentLog:
+        """The log of ``table``. Raises ``ValueError`` once the table has
+        been dropped, rather than recreating its directory."""
+        seg_log = self._logs.get(table)
+        if seg_log is None:
+            with self._lock:
+                if table in self._dropped:
+                    raise ValueError("queue table %s was dropped" % table)
+                seg_log = self._logs.get(table)
+                if seg_log is None:
+                    self._claim()
+                    seg_log = _SegmentLog(self.root / table, self.fsync)
+                    self._logs[table] = seg_log
+        return seg_log
+
+    def put(
+        self,
+        config: _QueueConfig,
+        payloads: list[bytes],
+        now: float,
+        max_size: int,
+        priority: int,
+        visible_at: float | None,
+    ) -> None:
+        if priority or visible_at is not None:
+            raise ValueError(_FIFO_ONLY)
+        evict = config.overflow == "drop_oldest"
+        try:
+            evicted = self.log(config.table).append(payloads, now, max_size, evict)
+        except QueueFull as ex:
+            raise QueueFull("%s %s" % (config.name, ex)) from None
+        if evicted:
+            log.warning(
+                "%s queue at capacity (%d); dropped %d oldest",
+                config.name,
+                max_size,
+                evicted,
+            )
+
+    def pop(self, config: _QueueConfig, max_items: int) -> list[bytes]:
+        return self.log(config.table).pop(max_items, _BATCH_BUDGET)
+
+    def peek(self, config: _QueueConfig) -> bytes | None:
+        items = self.log(config.table).peek()
+        return items[0] if items else None
+
+    def sample(self, config: _QueueConfig, max_items: int) -> list[bytes]:
+        """The oldest ``max_items`` payloads, left in place."""
+        return self.log(config.table).peek(max_items)
+
+    def size(self, config: _QueueConfig) -> int:
+        return len(self.log(config.table))
+
+    def empty(self, config: _QueueConfig) -> bool:
+        return not self.log(config.table)
+
+    def clear(self, config: _QueueConfig) -> None:
+        self.log(config.table).clear()
+
+    def reap(self, configs: list[_QueueConfig], now: float) -> dict[str, int]:
+        """Consume the records older than each queue's TTL. Returns counts
+        per queue."""
+        deleted: dict[str, int] = {}
+        for config in configs:
+            n = self.log(config.table).reap(now - config.ttl_seconds)
+            if n:
+                deleted[config.name] = n
+        return deleted
+
+    def sync(self) -> None:
+        """With ``fsync="interval"`` this is what makes appends durable;
+        under ``"always"`` it still syncs the read offsets."""
+        if self.fsync == "never":
+            return
+        for seg_log in list(self._logs.values()):
+            seg_log.sync()
+
+    def revive(self, config: _QueueConfig) -> None:
+        """Let ``log()`` open the table again after a ``drop()``."""
+        with self._lock:
+            self._dropped.discard(config.table)
+
+    def drop(self, config: _QueueConfig) -> None:
+        """Close and delete the log of ``config``'s table; ``log()``
+        refuses it from then on."""
+        table = config.table
+        with self._lock:
+            self._dropped.add(table)
+            seg_log = self._logs.pop(table, None)
+        if seg_log is not None:
+            seg_log.close()
+        shutil.rmtree(self.root / table, ignore_errors=True)
+
+    def close(self) -> None:
+        """Close every log and unlock ``root``; the next use reopens and
+        relocks them."""
+        with self._lock:
+            logs = list(self._logs.values())
+            self._logs.clear()
+            fd, self._root_fd = self._root_fd, None
+        for seg_log in logs:
+            seg_log.close()
+        if fd is not None:
+            os.close(fd)  # releases the flock()
+
+
+class _SqliteStorage:
+    """The default ``storage="sqlite"`` engine: a table per queue in every
+    shard's DB, reached through its owner's connections, group-commit
+    writers and head caches. The owner keeps what only this engine
+    supports (priorities, delays, leases, streams) for itself."""
+
+    fifo_only = False
+
+    def __init__(self, owner: MyQueue) -> None:
+        self._owner = owner
+
+    def put(
+        self,
+        config: _QueueConfig,
+        payloads: list[bytes],
+        now: float,
+        max_size: int,
+        priority: int,
+        visible_at: float | None,
+    ) -> None:
+        """Insert ``payloads`` in one transaction on the next shard, making
+        room first (see ``MyQueue._make_room``)."""
+        q = self._owner
+        table = config.table
+
+        def insert(conn: sqlite3.Connection) -> tuple[int, bool]:
+            evicted = q._make_room(conn, config, max_size, len(payloads))
+            conn.executemany(
+                f"INSERT INTO {table} (payload, created_at, priority, visible_at) "
+                f"VALUES (?, ?, ?, ?)",
+                [(p, now, priority, visible_at) for p in payloads],
+            )
+            # One writer at a time, so the batch got consecutive ids.
+            (last_id,) = conn.execute("SELECT last_insert_rowid()").fetchone()
+            return last_id, evicted
+
+        shard = next(q._next_shard) % q._shards
+        last_id, evicted = q._write(insert, shard)
+        cache = q._caches.get(config.name)
+        if cache is not None:
+            with cache.lock:
+                if evicted:
+                    cache.invalidate()
+                elif visible_at is None:
+                    first_id = last_id - len(payloads) + 1
+                    cache.insert(priority, range(first_id, last_id + 1), payloads)
+
+    def pop(self, config: _QueueConfig, max_items: int) -> list[bytes]:
+        """Pop up to ``max_items`` payloads in one transaction; see
+        ``MyQueue._dequeue_batch``. Uses ``DELETE ... RETURNING`` (SQLite
+        >= 3.35, March 2021)."""
+        q = self._owner
+        table = config.table
+        if q._shards > 1:
+            return [row[3] for row in q._take_sharded(table, max_items)]
+        cache = q._cache(config.name)
+        if cache is not None and max_items <= cache.capacity:
+            items = q._dequeue_cached(table, cache, max_items)
+            if items is not None:
+                return items
+
+        def pop_one(conn: sqlite3.Connection) -> list[tuple[int, int, bytes]]:
+            # The cursor MUST be drained: with RETURNING, SQLite only
+            # guarantees the row is deleted once the statement has been
+            # stepped to completion.
+            return conn.execute(
+                f"DELETE FROM {table} "
+                f"WHERE id = (SELECT id FROM {table} WHERE visible_at IS NULL "
+                f"            ORDER BY priority DESC, id LIMIT 1) "
+                f"RETURNING priority, id, payload"
+            ).fetchall()
+
+        def pop_many(conn: sqlite3.Connection) -> list[tuple[int, int, bytes]]:
+            return conn.execute(
+                f"DELETE FROM {table} WHERE id IN ("
+                f"{q._next_visible_sql(table, _U32.size)}"
+                f") RETURNING priority, id, payload",
+                (max_items, _BATCH_BUDGET),
+            ).fetchall()
+
+        rows = q._write(pop_one if max_items == 1 else pop_many)
+        if cache is not None:
+            q._invalidate_cache(config.name)
+        # RETURNING yields rows in no particular order.
+        rows.sort(key=lambda r: (-r[0], r[1]))
+        return [r[2] for r in rows]
+
+    def peek(self, config: _QueueConfig) -> bytes | None:
+        """With the head cache, a memory read."""
+        q = self._owner
+        table = config.table
+        cache = q._cache(config.name)
+        if cache is not None:
+            with cache.lock:
+                if not cache.valid:
+                    q._fill_cache(cache, table)
+                if cache.entries:
+                    return cache.entries[0][2]
+                if cache.complete:
+                    return None
+        heads = []
+        for shard in range(q._shards):
+            row = (
+                q._open_db(shard)  # read-only: no writer lock needed
+                .execute(
+                    f"SELECT -priority, created_at, payload FROM {table} "
+                    f"WHERE visible_at IS NULL ORDER BY priority DESC, id LIMIT 1"
+                )
+                .fetchone()
+            )
+            if row is not None:
+                heads.append(row)
+        # Across shards, the same order as _take_sharded().
+        return min(heads)[2] if heads else None
+
+    def sample(self, config: _QueueConfig, max_items: int) -> list[bytes]:
+        """The newest ``max_items`` payloads, split evenly over the shards."""
+        q = self._owner
+        return [
+            payload
+            for shard in range(q._shards)
+            for (payload,) in q._open_db(shard).execute(
+                f"SELECT payload FROM {config.table} ORDER BY id DESC LIMIT ?",
+                (-(-max_items // q._shards),),
+            )
+        ]
+
+    def size(self, config: _QueueConfig) -> int:
+        q = self._owner
+        # Read-only: no writer lock needed.
+        return sum(
+            q._depth(q._open_db(shard), config.table) for shard in range(q._shards)
+        )
+
+    def empty(self, config: _QueueConfig) -> bool:
+        """O(1), unlike COUNT(*)."""
+        q = self._owner
+        return not any(
+            q._open_db(shard)  # read-only: no writer lock needed
+            .execute(f"SELECT 1 FROM {config.table} LIMIT 1")
+            .fetchone()
+            for shard in range(q._shards)
+        )
+
+    def clear(self, config: _QueueConfig) -> None:
+        q = self._owner
+        for shard in range(q._shards):
+            with q._db_txn(shard) as conn:
+                conn.execute(f"DELETE FROM {config.table}")
+        q._invalidate_cache(config.name)
+
+    def reap(self, configs: list[_QueueConfig], now: float) -> dict[str, int]:
+        """Delete the rows older than each queue's TTL in bounded batches,
+        and record what is left over as the reap backlog; see
+        ``MyQueue._reap_expired``. Returns counts per queue."""
+        q = self._owner
+        deleted: dict[str, int] = {}
+        deadline = time.monotonic() + _REAP_PASS_SECONDS
+        backlog: dict[str, int] = {}
+        for shard in range(q._shards):
+            for config in configs:
+                cutoff = now - config.ttl_seconds
+                while True:
+                    batch = q._reap_batch
+                    with q._db_txn(shard) as conn:
+                        t0 = time.perf_counter()
+                        # The created_at index yields the oldest rows
+                        # without visiting any other.
+                        n = conn.execute(
+                            f"DELETE FROM {config.table} WHERE id IN ("
+                            f"SELECT id FROM {config.table} WHERE created_at < ? "
+                            f"ORDER BY created_at LIMIT ?)",
+                            (cutoff, batch),
+                        ).rowcount
+                    held = time.perf_counter() - t0
+                    if n > 0:
+                        deleted[config.name] = deleted.get(config.name, 0) + n
+                    # At most halve or double per batch, so one slow commit
+                    # does not swing it to an extreme.
+                    scale = _REAP_HOLD_SECONDS / max(held, 1e-6)
+                    q._reap_batch = min(
+                        _REAP_MAX_BATCH,
+                        max(_REAP_MIN_BATCH, round(batch * min(2.0, max(0.5, scale)))),
+                    )
+                    if n < batch:
+                        break
+                    if time.monotonic() >= deadline or q._shutdown.wait(held):
+                        (left,) = (
+                            q._open_db(shard)  # read-only: no writer lock needed
+                            .execute(
+                                f"SELECT COUNT(*) FROM {config.table} "
+                                f"WHERE created_at < ?",
+                                (cutoff,),
+                            )
+                            .fetchone()
+                        )
+                        if left:
+                            backlog[config.name] = backlog.get(config.name, 0) + left
+                        break
+        q._metrics.set_reap_backlog(backlog)
+        for queue in deleted:
+            q._invalidate_cache(queue)
+        return deleted
+
+    def sync(self) -> None:
+        """Nothing to do: every write is committed before it returns."""
+
+    def revive(self, config: _QueueConfig) -> None:
+        """Nothing to do: ``declare_queue()`` recreates the table."""
+
+    def drop(self, config: _QueueConfig) -> None:
+        """Forget the head cache; ``drop_queue()`` drops the table."""
+        self._owner._caches.pop(config.name, None)
+
+    def close(self) -> None:
+        """Nothing to do: connections belong to the owner's threads."""
+
+
+class _Parked:
+    """A request asking to be parked rather than block an engine thread: a
+    wait GET that found its queue empty, or a PUT that found its ``block``
+    queue full. ``key`` is the notifier key it waits on and ``seen`` the
+    sequence read before the queue was checked. Once ``key`` is notified,
+    ``retry()`` runs the request again; at ``deadline`` it is answered
+    with ``expired`` instead."""
+
+    __slots__ = ("key", "deadline", "seen", "retry", "expired")
+
+    def __init__(
+        self,
+        key: str,
+        deadline: float,
+        seen: int,
+        retry: Callable[[], tuple[bytes, bytes] | _Parked | None],
+        expired: tuple[bytes, bytes],
+    ) -> None:
+        self.key = key
+        self.deadline = deadline
+        self.seen = seen
+        self.retry = retry
+        self.expired = expired
+
+
+class _PendingWrite:
+    """One write operation waiting for the group-commit writer thread."""
+
+    __slots__ = ("fn", "done", "result", "error")
+
+    def __init__(self, fn: Callable[[sqlite3.Connection], Any]) -> None:
+        self.fn = fn
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: BaseException | None = None
+
+
+class _GroupCommitter:
+    """Single writer thread that commits many callers' writes together.
+
+    ``submit(fn)`` queues ``fn`` and blocks until the transaction that ran
+    it has committed, then returns ``fn``'s result (or re-raises its
+    exception). The writer waits at most ``window`` seconds after the first
+    queued operation, or until ``max_ops`` are queued, before committing."""
+
+    def __init__(
+        self,
+        txn: Callable[[], Any],
+        close_db: Callable[[], None],
+        window: float,
+        max_ops: int,
+    ) -> None:
+        self._txn = txn
+        self._close_db = close_db
+        self._window = window
+        self._max_ops = max_ops
+        self._pending: SimpleQueue[_PendingWrite] = SimpleQueue()
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        with self._lock:
+            self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="tcpQueue-writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop accepting work, drain what is already queued, and join."""
+        with self._lock:
+            self._running = False
+        t, self._thread = self._thread, None
+        if t is not None and t is not threading.current_thread():
+            t.join(timeout=5.0)
+
+    def submit(self, fn: Callable[[sqlite3.Connection], _T]) -> _T:
+        """Run ``fn(conn)`` inside the next group transaction. Raises
+        ``RuntimeError`` if the committer is not running."""
+        op = _PendingWrite(fn)
+        with self._lock:
+            if not self._running:
+                raise RuntimeError("group committer is not running")
+            self._pending.put(op)
+        op.done.wait()
+        if op.error is not None:
+            raise op.error
+        return op.result
+
+    def _run(self) -> None:
+        try:
+            while True:
+                try:
+                    first = self._pending.get(timeout=0.5)
+                except Empty:
+                    with self._lock:
+                        if not self._running and self._pending.empty():
+                            return
+                    continue
+                batch = [first]
+                deadline = time.monotonic() + self._window
+                while len(batch) < self._max_ops:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(self._pending.get(timeout=remaining))
+                    except Empty:
+                        break
+                self._commit(batch)
+        finally:
+            self._close_db()
+
+    def _commit(self, batch: list[_PendingWrite]) -> None:
+        try:
+            with self._txn() as conn:
+                for op in batch:
+                    conn.execute("SAVEPOINT op")
+                    try:
+                        op.result = op.fn(conn)
+                    except Exception as ex:
+                        conn.execute("ROLLBACK TO op")
+                        op.error = ex
+                    conn.execute("RELEASE op")
+        except Exception as ex:
+            # The shared commit failed, so nothing in the group is durable.
+            for op in batch:
+                if op.error is None:
+                    op.result = None
+                    op.error = ex
+        for op in batch:
+            op.done.set()
+
+
+class _LoopConn:
+    """Per-connection state for the selectors engine."""
+
+    __slots__ = (
+        "sock",
+        "reader",
+        "outbuf",
+        "pending",
+        "busy",
+        "closed",
+        "events",
+        "version",
+        "request_id",
+        "mac",
+    )
+
+    def __init__(
+        self, sock: socket.socket, mac: _FrameMac | None, metrics: _Metrics
+    ) -> None:
+        self.sock = sock
+        # Idle connections are the common case here, so use a small buffer;
+        # big frames get their own buffer anyway.
+        self.reader = _FrameReader(mac, _LOOP_READ_BUFFER, metrics)
+        # Signs responses; the session MAC after a protocol-3 HELLO. Only
+        # the loop thread signs, so responses are signed in sending order.
+        self.mac = mac
+        self.outbuf: deque[memoryview] = deque()
+        # (opcode, payload, request_id) of requests not yet executing.
+        self.pending: deque[tuple[bytes, bytes, bytes]] = deque()
+        self.busy = False  # a request from this connection is executing
+        self.closed = False
+        self.events = 0  # selector event mask currently registered
+        self.version = 0  # protocol version; 0 until the first frame
+        self.request_id = b""  # ID of the request currently executing
+
+
+class _SelectorEngine:
+    """Single-threaded event loop serving every connection of a MyQueue.
+
+    The loop thread owns all sockets and the selector. Requests run on a
+    bounded ``ThreadPoolExecutor``; finished responses come back through
+    ``_done`` and a self-pipe wakeup, so only the loop thread ever touches
+    a socket."""
+
+    def __init__(self, owner: MyQueue, ssock: socket.socket, workers: int) -> None:
+        self._owner = owner
+        self._ssock = ssock
+        self._sel = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="tcpQueue-exec"
+        )
+        self._done: SimpleQueue[
+            tuple[_LoopConn, tuple[bytes, bytes] | _Parked | None]
+        ] = SimpleQueue()
+        self._conns: set[_LoopConn] = set()
+        # Parked requests by the notifier key they wait on (long-poll GETs
+        # for their queue to be written, blocked PUTs for room in it), and
+        # the keys the notifier has reported since the last loop iteration.
+        self._parked: dict[str, list[tuple[_LoopConn, _Parked]]] = {}
+        self._notified: SimpleQueue[str] = SimpleQueue()
+
+    def wake(self) -> None:
+        """Interrupt ``select()``. Safe to call from any thread."""
+        try:
+            self._wake_w.send(b"\0")
+        except OSError:
+            # Buffer full (a wakeup is already pending) or already closed.
+            pass
+
+    def _on_notify(self, queue: str) -> None:
+        """Notifier listener; runs on whichever thread committed."""
+        self._notified.put(queue)
+        self.wake()
+
+    def run(self) -> None:
+        owner = self._owner
+        owner._notifier.subscribe(self._on_notify)
+        try:
+            self._ssock.setblocking(False)
+            self._sel.register(self._ssock, selectors.EVENT_READ, None)
+            self._sel.register(self._wake_r, selectors.EVENT_READ, self._wake_r)
+            while not owner._shutdown.is_set():
+                try:
+                    events = self._sel.select(timeout=self._select_timeout())
+                except OSError:
+                    if owner._shutdown.is_set():
+                        return
+                    log.exception("select() failed")
+                    sleep(0.5)
+                    continue
+                for key, mask in events:
+                    if key.data is None:
+                        self._accept()
+                    elif key.data is self._wake_r:
+                        self._drain_wakeups()
+                    else:
+                        conn = key.data
+                        if mask & selectors.EVENT_WRITE:
+                            self._flush(conn)
+                        if mask & selectors.EVENT_READ and not conn.closed:
+                            self._read(conn)
+                self._finish_completed()
+                self._retry_notified()
+                self._expire_parked()
+        except Exception:
+            log.exception("Unexpected error in selector loop")
+        finally:
+            owner._notifier.unsubscribe(self._on_notify)
+            for conn in list(self._conns):
+                self._close(conn)
+            # Let in-flight requests finish so their writes are not cut off
+            # mid-transaction; their responses are simply discarded.
+            self._executor.shutdown(wait=True)
+            self._sel.close()
+            _close_socket(self._wake_r)
+            _close_socket(self._wake_w)
+
+    def _accept(self) -> None:
+        owner = self._owner
+        while True:
+            try:
+                sock, _addr = self._ssock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                if not owner._shutdown.is_set():
+                    log.exception("accept() failed")
+                return
+            try:
+                sock.setblocking(False)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError as ex:
+                log.warning("Could not configure accepted socket: %s", ex)
+            conn = _LoopConn(sock, owner._mac, owner._metrics)
+            self._conns.add(conn)
+            with owner._workers_lock:
+                owner._workers.append(sock)
+            self._update_interest(conn)
+
+    def _drain_wakeups(self) -> None:
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _read(self, conn: _LoopConn) -> None:
+        try:
+            received = conn.reader.fill(conn.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as ex:
+            log.debug("Connection closed: %s", ex)
+            self._close(conn)
+            return
+        if not received:
+            self._close(conn)
+            return
+        try:
+            while (frame := conn.reader.next_frame()) is not None:
+                opcode, payload = frame
+                if conn.version == 0 and opcode == _OP_HELLO:
+                    # Nothing else can be queued yet, so answer right here.
+                    agreed = self._owner._negotiate(payload)
+                    if agreed is None:
+                        self._close(conn)
+                        return
+                    conn.version, ack, session = agreed
+                    parts = _Frame.buffers(_OP_ACK, ack, conn.mac)
+                    conn.outbuf.extend(memoryview(b) for b in parts if len(b))
+                    conn.mac = conn.reader.mac = session
+                    continue
+                if conn.version == 0 and self._owner._require_session:
+                    log.warning("Client skipped HELLO; require_session is set")
+                    self._close(conn)
+                    return
+                conn.version = conn.version or 1
+                request_id = b""
+                if conn.version >= 2:
+                    request_id, payload = _split_request_id(payload)
+                # Requests outlive the reader's buffer (they run on the
+                # executor), so take a private copy of each payload.
+                conn.pending.append((opcode, bytes(payload), request_id))
+        except ValueError as ex:
+            log.warning("Closing connection: %s", ex)
+            self._close(conn)
+            return
+        self._dispatch(conn)
+        # Sends a HELLO answer, if any, and updates the selector interest.
+        self._flush(conn)
+
+    def _dispatch(self, conn: _LoopConn) -> None:
+        if conn.busy or not conn.pending:
+            return
+        conn.busy = True
+        opcode, payload, conn.request_id = conn.pending.popleft()
+        self._executor.submit(self._execute, conn, opcode, payload)
 
-        return body[:1], body[1:]
+    def _execute(self, conn: _LoopConn, opcode: bytes, payload: bytes) -> None:
+        """Runs on an executor thread."""
+        response: tuple[bytes, bytes] | _Parked | None
+        try:
+            response = self._owner._handle_request(opcode, payload, can_park=True)
+        except Exception:
+            log.exception("Unexpected error handling request")
+            response = None
+        self._done.put((conn, response))
+        self.wake()
+
+    def _execute_retry(self, conn: _LoopConn, parked: _Parked) -> None:
+        """Retry a parked request. Runs on an executor thread."""
+        response: tuple[bytes, bytes] | _Parked | None
+        try:
+            response = parked.retry()
+        except Exception:
+            log.exception("Unexpected error handling request")
+            response = None
+        self._done.put((conn, response))
+        self.wake()
+
+    def _select_timeout(self) -> float:
+        """Sleep no longer than the nearest long-poll deadline."""
+        timeout = 1.0
+        now = time.monotonic()
+        for parked in self._parked.values():
+            for _conn, p in parked:
+                timeout = min(timeout, max(0.0, p.deadline - now))
+        return timeout
+
+    def _park(self, conn: _LoopConn, parked: _Parked) -> None:
+        if self._owner._notifier.seq(parked.key) != parked.seen:
+            # A commit landed after the queue was checked; retry right away.
+            self._executor.submit(self._execute_retry, conn, parked)
+            return
+        self._parked.setdefault(parked.key, []).append((conn, parked))
+
+    def _retry_notified(self) -> None:
+        queues: set[str] = set()
+        while True:
+            try:
+                queues.add(self._notified.get_nowait())
+            except Empty:
+                break
+        for queue in queues:
+            for conn, p in self._parked.pop(queue, ()):
+                if not conn.closed:
+                    self._executor.submit(self._execute_retry, conn, p)
+
+    def _expire_parked(self) -> None:
+        now = time.monotonic()
+        for queue, waiting in list(self._parked.items()):
+            if not any(p.deadline <= now or conn.closed for conn, p in waiting):
+                continue
+            keep: list[tuple[_LoopConn, _Parked]] = []
+            for conn, p in waiting:
+                if conn.closed:
+                    continue
+                if p.deadline > now:
+                    keep.append((conn, p))
+                    continue
+                self._done.put((conn, p.expired))
+            if keep:
+                self._parked[queue] = keep
+            else:
+                del self._parked[queue]
+        # Anything just expired is answered on the next pass through
+        # _finish_completed; make sure that pass happens promptly.
+        if not self._done.empty():
+            self.wake()
+
+    def _finish_completed(self) -> None:
+        # Queue every finished response first and flush afterwards, so
+        # several responses for one connection leave in one sendmsg().
+        ready: list[_LoopConn] = []
+        while True:
+            try:
+                conn, response = self._done.get_nowait()
+            except Empty:
+                break
+            if conn.closed:
+                conn.busy = False
+                continue
+            if response is None:
+                conn.busy = False
+                self._close(conn)
+                continue
+            if isinstance(response, _Parked):
+                # Still busy: later requests on this connection must wait
+                # for the parked request to be answered.
+                self._park(conn, response)
+                continue
+            conn.busy = False
+            try:
+                parts = _Frame.buffers(*response, conn.mac, conn.request_id)
+            except ValueError as ex:
+                log.warning("Closing connection: %s", ex)
+                self._close(conn)
+                continue
+            conn.outbuf.extend(memoryview(b) for b in parts if len(b))
+            ready.append(conn)
+            self._dispatch(conn)
+        for conn in ready:
+            if not conn.closed:
+                self._flush(conn)
+
+    def _flush(self, conn: _LoopConn) -> None:
+        t0 = time.perf_counter() if conn.outbuf else 0.0
+        while conn.outbuf:
+            try:
+                _send_some(conn.sock, conn.outbuf)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as ex:
+                log.debug("Connection closed: %s", ex)
+                self._close(conn)
+                return
+        if t0:
+            self._owner._metrics.response_write.observe(time.perf_counter() - t0)
+        self._update_interest(conn)
+
+    def _update_interest(self, conn: _LoopConn) -> None:
+        """Register for reads unless too many requests are already queued
+        (backpressure), and for writes while output is buffered."""
+        if conn.closed:
+            return
+        events = 0
+        if len(conn.pending) < _MAX_PENDING_FRAMES:
+            events |= selectors.EVENT_READ
+        if conn.outbuf:
+            events |= selectors.EVENT_WRITE
+        if events == conn.events:
+            return
+        try:
+            if conn.events == 0:
+                self._sel.register(conn.sock, events, conn)
+            elif events == 0:
+                self._sel.unregister(conn.sock)
+            else:
+                self._sel.modify(conn.sock, events, conn)
+        except (KeyError, ValueError, OSError) as ex:
+            log.debug("Connection closed: %s", ex)
+            self._close(conn)
+            return
+        conn.events = events
+
+    def _close(self, conn: _LoopConn) -> None:
+        if conn.closed:
+            return
+        conn.closed = True
+        if conn.events:
+            try:
+                self._sel.unregister(conn.sock)
+            except (KeyError, ValueError, OSError):
+                pass
+        self._conns.discard(conn)
+        owner = self._owner
+        with owner._workers_lock:
+            try:
+                owner._workers.remove(conn.sock)
+            except ValueError:
+                pass
+        _close_socket(conn.sock)
+
+
+class _Pipeline:
+    """One protocol-2 client connection with many requests in flight.
+
+    Any thread may ``submit()`` a request: it is written at once under a
+    fresh request ID and a ``Future`` for the ``(opcode, payload)`` of
+    its response is returned. A reader thread matches each response to
+    its future by ID as it arrives. Any socket or framing failure, or
+    ``timeout`` seconds without a response while requests are
+    outstanding, fails every outstanding future with ``ConnectionError``
+    and closes the pipeline for good; the owner opens a new one on next
+    use."""
+
+    def __init__(
+        self,
+        sock: socket.socket,
+        reader: _FrameReader,
+        mac: _FrameMac | None,
+    ) -> None:
+        self._sock = sock
+        self._reader = reader
+        self._mac = mac
+        self._send_lock = threading.Lock()  # also orders signing with sending
+        self._lock = threading.Lock()  # guards the three fields below
+        self._pending: dict[int, Future[tuple[bytes, bytes]]] = {}
+        self._next_id = 0
+        self._error: ConnectionError | None = None
+        self._thread = threading.Thread(
+            target=self._read_loop, name="tcpQueue-pipeline", daemon=True
+        )
+        self._thread.start()
+
+    @property
+    def closed(self) -> bool:
+        return self._error is not None
+
+    def submit(self, opcode: bytes, payload: bytes) -> Future[tuple[bytes, bytes]]:
+        """Send one request. Raises ``ValueError`` if it is too large for a
+        frame and ``ConnectionError`` if the pipeline is already closed."""
+        future: Future[tuple[bytes, bytes]] = Future()
+        # The request is on the wire as soon as this returns; it cannot
+        # be cancelled.
+        future.set_running_or_notify_cancel()
+        with self._lock:
+            request_id = self._next_id
+            self._next_id = (request_id + 1) & 0xFFFFFFFF
+        with self._send_lock:
+            # A session MAC counts frames: sign in the order frames are sent.
+            parts = _Frame.buffers(opcode, payload, self._mac, _U32.pack(request_id))
+            with self._lock:
+                if self._error is not None:
+                    raise ConnectionError(str(self._error))
+                self._pending[request_id] = future
+            try:
+                _send_buffers(self._sock, parts)
+            except OSError as ex:
+                self._fail(ConnectionError(str(ex)))
+        return future
+
+    def close(self) -> None:
+        self._fail(ConnectionError("connection closed"))
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _read_loop(self) -> None:
+        try:
+            while True:
+                try:
+                    frame = self._reader.read(self._sock)
+                except TimeoutError:
+                    with self._lock:
+                        idle = not self._pending
+                    if idle:
+                        continue
+                    raise ConnectionError("timed out waiting for a response")
+                if frame is None:
+                    raise ConnectionError("server closed connection")
+                opcode, body = frame
+                request_id, payload = _split_request_id(body)
+                (rid,) = _U32.unpack(request_id)
+                with self._lock:
+                    future = self._pending.pop(rid, None)
+                if future is None:
+                    raise ConnectionError("response to unknown request %d" % rid)
+                future.set_result((opcode, bytes(payload)))
+        except (OSError, ValueError) as ex:
+            if not isinstance(ex, ConnectionError):
+                ex = ConnectionError(str(ex))
+            self._fail(ex)
+
+    def _fail(self, error: ConnectionError) -> None:
+        with self._lock:
+            if self._error is None:
+                self._error = error
+                log.debug("Pipeline closed: %s", error)
+            pending, self._pending = self._pending, {}
+        _close_socket(self._sock)
+        for future in pending.values():
+            future.set_exception(ConnectionError(str(error)))
 
 
 # --------------------------------------------------------------------------- #
@@ -334,11 +3331,24 @@ class _Frame:
 # --------------------------------------------------------------------------- #
 
 
+class QueueFull(ValueError):
+    """A PUT was refused because its queue is at ``max_queue_size`` and
+    its overflow policy is ``"reject"`` or ``"block"``. ``retry_after`` is
+    the server's hint, in seconds, for when to try again."""
+
+    def __init__(
+        self, message: str, retry_after: float = _RETRY_AFTER_MS / 1000
+    ) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
 class MyQueue:
     """Bidirectional TCP message queue with on-disk durability."""
 
-    def _initialize_db(self) -> None:
-        """Create tables and indexes if they don't exist. Idempotent.
+    def _initialize_db(self, path: str) -> None:
+        """Create tables and indexes in the DB at ``path`` (the whole DB, or
+        one shard) if they don't exist. Idempotent.
 
         On a fresh DB, sets ``auto_vacuum=INCREMENTAL`` so deletes can later
         be reclaimed back to the OS by ``_db_compact()``. ``auto_vacuum``
@@ -350,17 +3360,17 @@ class MyQueue:
         version on a fresh DB."""
         # Make sure the containing directory exists, otherwise sqlite3 fails
         # with an opaque "unable to open database file".
-        parent = Path(self._db_path).expanduser().resolve().parent
+        parent = Path(path).expanduser().resolve().parent
         parent.mkdir(parents=True, exist_ok=True)
 
         # Open a dedicated connection for setup, separate from _open_db's
         # thread-local cache. We need direct pragma access outside a txn.
-        conn = sqlite3.connect(self._db_path, isolation_level=None, timeout=30.0)
+        conn = sqlite3.connect(path, isolation_level=None, timeout=30.0)
         try:
             (current_version,) = conn.execute("PRAGMA user_version").fetchone()
             if current_version > _SCHEMA_VERSION:
                 raise RuntimeError(
-                    f"Database at {self._db_path} has schema version "
+                    f"Database at {path} has schema version "
                     f"{current_version}, newer than this code supports "
                     f"({_SCHEMA_VERSION}). Refusing to open to avoid "
                     f"corruption."
@@ -394,8 +3404,8 @@ class MyQueue:
                         "the OS. To enable (this locks the DB; runtime "
                         "depends on size): "
                         "sqlite3 %s 'PRAGMA auto_vacuum=2; VACUUM;'",
-                        self._db_path,
-                        self._db_path,
+                        path,
+                        path,
                     )
 
             # Set durability / mode pragmas. journal_mode=WAL is persistent
@@ -408,18 +3418,34 @@ class MyQueue:
             # nothing half-built.
             conn.execute("BEGIN IMMEDIATE")
             try:
-                for table in _TABLES:
-                    conn.execute(f"""
-                        CREATE TABLE IF NOT EXISTS {table} (
-                            id         INTEGER PRIMARY KEY AUTOINCREMENT,
-                            payload    BLOB NOT NULL,
-                            created_at REAL NOT NULL
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS queue_depth (
+                        name  TEXT PRIMARY KEY,
+                        depth INTEGER NOT NULL
+                    ) WITHOUT ROWID
+                """)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS queues (
+                        name           TEXT PRIMARY KEY,
+                        max_queue_size INTEGER NOT NULL,
+                        ttl_seconds    REAL,
+                        overflow       TEXT NOT NULL DEFAULT 'drop_oldest'
+                    ) WITHOUT ROWID
+                """)
+                if current_version < 6:
+                    # Schema 6 gave named queues an overflow policy.
+                    info = conn.execute("PRAGMA table_info(queues)")
+                    if "overflow" not in {row[1] for row in info}:
+                        conn.execute(
+                            "ALTER TABLE queues ADD COLUMN "
+                            "overflow TEXT NOT NULL DEFAULT 'drop_oldest'"
                         )
-                    """)
-                    conn.execute(f"""
-                        CREATE INDEX IF NOT EXISTS {table}_created_at_idx
-                        ON {table}(created_at)
-                    """)
+                for table in _TABLES:
+                    self._create_queue_table(conn, table, reseed=current_version < 2)
+                if current_version < 5:
+                    # Give the named queues' tables their newer columns.
+                    for (name,) in conn.execute("SELECT name FROM queues").fetchall():
+                        self._create_queue_table(conn, _queue_table(name), reseed=False)
                 # PRAGMA user_version doesn't accept a bound parameter;
                 # literal interpolation of an int constant is safe.
                 conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
@@ -433,6 +3459,74 @@ class MyQueue:
         finally:
             conn.close()
 
+    @staticmethod
+    def _create_queue_table(conn: sqlite3.Connection, table: str, reseed: bool) -> None:
+        """Create a queue table with its ``created_at``, lease and
+        delivery-order indexes, its ``queue_depth`` counter and the ``AFTER
+        INSERT`` / ``AFTER DELETE`` triggers that keep the counter in step.
+        Idempotent; must run inside a transaction. ``reseed`` recounts the
+        table, for DBs from before the counters existed. Tables from older
+        schema versions get their missing columns added."""
+        # The built-in tables predate named queues and keep their original
+        # index and trigger names.
+        sep = "_" if table in _TABLES else "__"
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                id         INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload    BLOB NOT NULL,
+                created_at REAL NOT NULL,
+                visible_at REAL,
+                deliveries INTEGER NOT NULL DEFAULT 0,
+                priority   INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for column, decl in (
+            ("visible_at", "REAL"),
+            ("deliveries", "INTEGER NOT NULL DEFAULT 0"),
+            ("priority", "INTEGER NOT NULL DEFAULT 0"),
+        ):
+            # Adding a nullable or defaulted column only rewrites the
+            # schema, not the rows, so this is instant on any table size.
+            if column not in columns:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+        conn.execute(f"""
+            CREATE INDEX IF NOT EXISTS {table}{sep}created_at_idx
+            ON {table}(created_at)
+        """)
+        # Only leased rows are indexed, so the index stays as small as the
+        # number of messages in flight.
+        conn.execute(f"""
+            CREATE INDEX IF NOT EXISTS {table}{sep}lease_idx
+            ON {table}(visible_at) WHERE visible_at IS NOT NULL
+        """)
+        # Delivery order over the rows that can be handed out. Every GET
+        # and lease walks this index from its start.
+        conn.execute(f"""
+            CREATE INDEX IF NOT EXISTS {table}{sep}ready_idx
+            ON {table}(priority DESC, id) WHERE visible_at IS NULL
+        """)
+        verb = "REPLACE" if reseed else "IGNORE"
+        conn.execute(
+            f"INSERT OR {verb} INTO queue_depth (name, depth) "
+            f"SELECT ?, COUNT(*) FROM {table}",
+            (table,),
+        )
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}{sep}depth_ins
+            AFTER INSERT ON {table} BEGIN
+                UPDATE queue_depth SET depth = depth + 1
+                WHERE name = '{table}';
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}{sep}depth_del
+            AFTER DELETE ON {table} BEGIN
+                UPDATE queue_depth SET depth = depth - 1
+                WHERE name = '{table}';
+            END
+        """)
+
     def __init__(
         self,
         host: str = "127.0.0.1",
@@ -444,6 +3538,21 @@ class MyQueue:
         ttl_seconds: float | None = None,
         reaper_interval: float = 60.0,
         timeout: float = 75.0,
+        group_commit: bool = False,
+        group_commit_window: float = 0.0005,
+        group_commit_max_ops: int = 256,
+        engine: str = "threads",
+        engine_workers: int = 8,
+        codec: str = "json",
+        zdict: bytes | None = None,
+        cache_size: int = 0,
+        storage: str = "sqlite",
+        segment_fsync: str = "interval",
+        shards: int = 1,
+        metrics_port: int | None = None,
+        session_mac: str = "blake2b",
+        require_session: bool = False,
+        overflow: str = "drop_oldest",
     ) -> None:
         if not isinstance(host, str):
             raise ValueError("host must be a string, got %s" % type(host).__name__)
@@ -462,6 +3571,8 @@ class MyQueue:
                 )
             if len(secret_key) < 16:
                 raise ValueError("secret_key must be at least 16 bytes")
+        if require_session and secret_key is None:
+            raise ValueError("require_session needs a secret_key")
         if isinstance(max_queue_size, bool) or not isinstance(max_queue_size, int):
             raise ValueError(
                 "max_queue_size must be an integer, got %s"
@@ -471,20 +3582,162 @@ class MyQueue:
             raise ValueError("max_queue_size must be >= 1")
         if ttl_seconds is not None and ttl_seconds <= 0:
             raise ValueError("ttl_seconds must be > 0 or None")
+        _check_overflow(overflow)
         if reaper_interval <= 0:
             raise ValueError("reaper_interval must be > 0")
         if timeout <= 0:
             raise ValueError("timeout must be > 0")
+        if group_commit_window < 0:
+            raise ValueError("group_commit_window must be >= 0")
+        if group_commit_max_ops < 1:
+            raise ValueError("group_commit_max_ops must be >= 1")
+        if engine not in _ENGINES:
+            raise ValueError("engine must be one of %s, got %r" % (_ENGINES, engine))
+        if engine_workers < 1:
+            raise ValueError("engine_workers must be >= 1")
+        if codec not in _CODECS:
+            raise ValueError(
+                "codec must be one of %s, got %r" % (tuple(_CODECS), codec)
+            )
+        if session_mac not in _SESSION_MACS:
+            raise ValueError(
+                "session_mac must be one of %s, got %r"
+                % (tuple(_SESSION_MACS), session_mac)
+            )
+        if zdict is not None:
+            if codec != "json":
+                raise ValueError("zdict only applies to the json codec")
+            if not isinstance(zdict, (bytes, bytearray)):
+                raise ValueError("zdict must be bytes, got %s" % type(zdict).__name__)
+            if not 1 <= len(zdict) <= _ZDICT_MAX_BYTES:
+                raise ValueError(
+                    "zdict must be between 1 and %d bytes" % _ZDICT_MAX_BYTES
+                )
+        if isinstance(cache_size, bool) or not isinstance(cache_size, int):
+            raise ValueError(
+                "cache_size must be an integer, got %s" % type(cache_size).__name__
+            )
+        if cache_size < 0:
+            raise ValueError("cache_size must be >= 0")
+        if storage not in _STORAGES:
+            raise ValueError("storage must be one of %s, got %r" % (_STORAGES, storage))
+        if segment_fsync not in _FSYNC_POLICIES:
+            raise ValueError(
+                "segment_fsync must be one of %s, got %r"
+                % (_FSYNC_POLICIES, segment_fsync)
+            )
+        if storage == "segments":
+            if group_commit or cache_size:
+                raise ValueError(
+                    "group_commit and cache_size only apply to storage='sqlite'"
+                )
+            if fcntl is None or not hasattr(os, "pread"):
+                raise ValueError("storage='segments' is not available on this platform")
+        if (
+            isinstance(shards, bool)
+            or not isinstance(shards, int)
+            or not 1 <= shards <= _MAX_SHARDS
+        ):
+            raise ValueError(
+                "shards must be an integer between 1 and %d, got %r"
+                % (_MAX_SHARDS, shards)
+            )
+        if shards > 1 and (cache_size or storage != "sqlite"):
+            raise ValueError("cache_size and storage='segments' do not support shards")
+        if metrics_port is not None and (
+            isinstance(metrics_port, bool)
+            or not isinstance(metrics_port, int)
+            or not (1 <= metrics_port <= 65535)
+        ):
+            raise ValueError(
+                "metrics_port must be an integer between 1 and 65535, got %r"
+                % (metrics_port,)
+            )
 
         self._addr: tuple[str, int] = (host, port)
         self._db_path: str | None = str(db_path) if db_path is not None else None
+        # One SQLite file per shard: db_path itself, or the shard files in
+        # the db_path directory. PUTs go to the shards in turn.
+        self._shards: int = shards
+        self._db_paths: list[str] = []
+        if db_path is not None:
+            self._db_paths = (
+                [str(db_path)]
+                if shards == 1
+                else [str(Path(db_path) / (_SHARD_FILE % i)) for i in range(shards)]
+            )
+        self._next_shard: Iterator[int] = count()
         self._secret_key: bytes | None = (
             bytes(secret_key) if secret_key is not None else None
         )
+        # Signs every protocol-1/2 frame and each protocol-3 HELLO exchange.
+        self._mac: _FrameMac | None = (
+            _FrameMac(self._secret_key) if self._secret_key is not None else None
+        )
+        # Session MAC IDs a client offers in its HELLO, preferred first.
+        preferred = _SESSION_MACS[session_mac]
+        self._session_macs: bytes = bytes(
+            sorted(_SESSION_MACS.values(), key=lambda i: i != preferred)
+        )
+        # Refuse protocols 1 and 2, as server and as client.
+        self._require_session: bool = require_session
         self._max_queue_size: int = max_queue_size
         self._ttl_seconds: float | None = ttl_seconds
         self._reaper_interval: float = reaper_interval
+        # Rows per TTL reaper transaction, adapted as it runs.
+        self._reap_batch: int = _REAP_BATCH
         self._timeout: float = timeout
+        self._group_commit: bool = group_commit
+        self._group_commit_window: float = group_commit_window
+        self._group_commit_max_ops: int = group_commit_max_ops
+        self._engine: str = engine
+        self._engine_workers: int = engine_workers
+        # Queue name -> in-memory head, created on the queue's first GET.
+        # Empty with cache_size=0, which turns the cache off.
+        self._cache_size: int = cache_size
+        self._caches: dict[str, _HeadCache] = {}
+        # Where the messages live: the DB's queue tables or, with
+        # storage="segments", segment files under <db_path>.segments, the DB
+        # then only holding the queue registry.
+        self._storage: _SqliteStorage | _SegmentStorage = _SqliteStorage(self)
+        if storage == "segments" and db_path is not None:
+            self._storage = _SegmentStorage(
+                Path(str(db_path) + ".segments"), segment_fsync
+            )
+        # Queue name -> settings. Holds the built-ins plus every named queue
+        # seen so far; see _queue() and _load_queues(). Changed only under
+        # _queues_lock, and replaced rather than mutated by _load_queues().
+        self._queues_lock = threading.Lock()
+        self._queues: dict[str, _QueueConfig] = {
+            name: _QueueConfig(name, max_queue_size, ttl_seconds, overflow)
+            for name in _TABLES
+        }
+        # What the maintenance sweeps iterate: the last _load_queues(), or
+        # None once declare_queue() / drop_queue() has made it stale.
+        self._sweep_queues: list[_QueueConfig] | None = None
+        self._codec: _Codec = _CODECS[codec]
+        if zdict is not None:
+            # Bound into this instance's codec alone: what it can decode
+            # never depends on which other instances exist.
+            bound = _Zdict(zdict)
+            self._codec = _Codec(
+                "json",
+                self._codec.tags,
+                partial(_json_encode, zdict=bound),
+                partial(_json_decode, zdict=bound),
+            )
+        self._encode: Callable[[Any], bytes] = self._codec.encode
+        codecs = dict(_CODECS_BY_TAG)
+        codecs.update((tag, self._codec) for tag in self._codec.tags)
+        self._deserialize: Callable[[bytes | memoryview], Any] = partial(
+            _deserialize, codecs=codecs
+        )
+        self._decode_item: Callable[[bytes, bytes | memoryview], Any] = partial(
+            _decode_item, codecs=codecs
+        )
+        self._decode_items: Callable[[bytes, bytes | memoryview], list[Any]] = partial(
+            _decode_items, codecs=codecs
+        )
 
         # Thread-local SQLite connections — one per thread, lazily opened.
         self._tls = threading.local()
@@ -498,16 +3751,48 @@ class MyQueue:
         self._ssock: socket.socket | None = None
         self._listen_thread: threading.Thread | None = None
         self._maintenance_thread: threading.Thread | None = None
+        # Wakes the maintenance thread before its next planned visibility
+        # sweep, which is due at _next_sweep (time.time() scale); math.inf
+        # while no sweep is planned, so any delayed PUT wakes it.
+        self._sweep_wakeup = threading.Event()
+        self._next_sweep: float = math.inf
+        # One group-commit writer per shard while the server runs.
+        self._committers: list[_GroupCommitter] = []
+        self._loop: _SelectorEngine | None = None
+        self._notifier = _Notifier()
+        self._metrics = _Metrics()
+        self._metrics_port: int | None = metrics_port
+        self._metrics_server: _MetricsHTTPServer | None = None
 
         # Client-side state.
         self._csock: socket.socket | None = None
+        self._creader: _FrameReader | None = None
+        # Signs frames on _csock, and the request ID it sends (empty below
+        # protocol 2; the blocking API never has more than one in flight).
+        self._cmac: _FrameMac | None = None
+        self._crid: bytes = b""
         self._csock_lock = threading.RLock()
+        # Protocol-2 connection used by the *_async methods, and the older
+        # protocol version to offer the server (with the monotonic time to
+        # stop) after it hung up on a newer HELLO; see _offer_version().
+        self._pipeline: _Pipeline | None = None
+        self._pipeline_lock = threading.Lock()
+        self._server_version: tuple[int, float] | None = None
 
         # Initialize the DB schema if a path was provided. Doing this here
         # (rather than lazily on first use) surfaces permission / disk
         # errors at construction time, where they belong.
         if self._db_path is not None:
-            self._initialize_db()
+            if shards > 1:
+                found = len(list(Path(self._db_path).glob("shard-*.db")))
+                if found > shards:
+                    raise ValueError(
+                        "%s holds %d shards; opening it with shards=%d would "
+                        "hide the rows of the others" % (self._db_path, found, shards)
+                    )
+            for path in self._db_paths:
+                self._initialize_db(path)
+            self._load_queues()
 
         if self._secret_key is None:
             log.warning(
@@ -523,8 +3808,8 @@ class MyQueue:
     # SQLite layer                                                       #
     # ------------------------------------------------------------------ #
 
-    def _open_db(self) -> sqlite3.Connection:
-        """Return this thread's connection, opening it lazily.
+    def _open_db(self, shard: int = 0) -> sqlite3.Connection:
+        """Return this thread's connection to ``shard``, opening it lazily.
         Reopens if ``db_path`` has changed since this thread last used it
         (which happens between test cases)."""
         if self._db_path is None:
@@ -533,48 +3818,50 @@ class MyQueue:
                 "DB-backed methods are unavailable"
             )
 
-        cached = getattr(self._tls, "conn", None)
-        cached_path = getattr(self._tls, "path", None)
-        if cached is not None and cached_path == self._db_path:
-            return cached
-        if cached is not None:
-            try:
-                cached.close()
-            except Exception:
-                pass
-        # Drop the stale entries *before* connecting: if connect() raises we
-        # must not leave a closed connection cached.
-        self._tls.conn = None
-        self._tls.path = None
+        conns: dict[int, sqlite3.Connection] | None = getattr(self._tls, "conns", None)
+        if conns is not None and getattr(self._tls, "path", None) == self._db_path:
+            cached = conns.get(shard)
+            if cached is not None:
+                return cached
+        else:
+            # Drop the stale entries *before* connecting: if connect() raises
+            # we must not leave a closed connection cached.
+            self.close_db()
+            conns = self._tls.conns = {}
 
-        conn = sqlite3.connect(self._db_path, isolation_level=None, timeout=30.0)
+        conn = sqlite3.connect(
+            self._db_paths[shard], isolation_level=None, timeout=30.0
+        )
         # WAL mode is persistent in the DB file, but we re-set it because
         # this might be the first open. NORMAL synchronous gives us
         # excellent durability with much higher throughput than FULL.
         conn.execute("PRAGMA journal_mode=WAL")
         conn.execute("PRAGMA synchronous=NORMAL")
         conn.execute("PRAGMA busy_timeout=5000")
-        self._tls.conn = conn
+        conns[shard] = conn
         self._tls.path = self._db_path
         return conn
 
     def close_db(self) -> None:
-        """Close this thread's cached SQLite connection, if any."""
-        conn = getattr(self._tls, "conn", None)
-        if conn is not None:
+        """Close this thread's cached SQLite connections, if any."""
+        conns = getattr(self._tls, "conns", None) or {}
+        for conn in conns.values():
             try:
                 conn.close()
             except Exception:
                 pass
-        self._tls.conn = None
+        self._tls.conns = None
         self._tls.path = None
 
     @contextmanager
-    def _db_txn(self) -> Iterator[sqlite3.Connection]:
-        """Context manager that opens a write transaction, commits on
-        success, rolls back on exception."""
-        conn = self._open_db()
+    def _db_txn(self, shard: int = 0) -> Iterator[sqlite3.Connection]:
+        """Context manager that opens a write transaction on ``shard``,
+        commits on success, rolls back on exception."""
+        conn = self._open_db(shard)
+        metrics = self._metrics
+        t0 = time.perf_counter()
         conn.execute("BEGIN IMMEDIATE")
+        metrics.lock_wait.observe(time.perf_counter() - t0)
         try:
             yield conn
         except Exception:
@@ -585,7 +3872,9 @@ class MyQueue:
             raise
         else:
             try:
+                t0 = time.perf_counter()
                 conn.execute("COMMIT")
+                metrics.commit.observe(time.perf_counter() - t0)
             except Exception:
                 try:
                     conn.execute("ROLLBACK")
@@ -593,6 +3882,22 @@ class MyQueue:
                     pass
                 raise
 
+    def _write(self, fn: Callable[[sqlite3.Connection], _T], shard: int = 0) -> _T:
+        """Run ``fn(conn)`` in a write transaction on ``shard`` and return
+        its result once committed. With group commit active the transaction
+        is shared with other workers' writes to the shard; otherwise it is a
+        private one."""
+        committers = self._committers
+        if committers:
+            try:
+                return committers[shard].submit(fn)
+            except RuntimeError:
+                # Committer stopped between the check and the submit (server
+                # shutting down); fall through to a private transaction.
+                pass
+        with self._db_txn(shard) as conn:
+            return fn(conn)
+
     def _db_compact(self) -> None:
         """Reclaim free pages back to the OS and truncate the WAL file.
 
@@ -606,22 +3911,35 @@ class MyQueue:
         ``fetchall()`` is required (a bare ``execute()`` reclaims exactly
         one page regardless of the limit). We cap each pass at 1000
         pages (~4MB at default page size) to bound how long any single
-        compaction call can take."""
+        compaction call can take; the number reclaimed is the drop in
+        ``freelist_count`` and is counted in ``metrics()``.
+
+        With ``storage="segments"`` only the registry lives in the DB;
+        segments are deleted as soon as they have been read, so there is
+        nothing else to reclaim."""
         if self._db_path is None:
             return
+        for shard in range(self._shards):
+            self._compact_shard(shard)
+
+    def _compact_shard(self, shard: int) -> None:
         try:
-            conn = self._open_db()
+            conn = self._open_db(shard)
             # 1. Flush WAL into main DB so vacuum sees the freed pages.
             conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
             # 2. Reclaim free pages. Drain the cursor — each row is one
-            #    page actually being returned to the OS.
-            reclaimed = conn.execute("PRAGMA incremental_vacuum(1000)").fetchall()
+            #    page actually being returned to the OS. Counted by the
+            #    drop in the freelist.
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            conn.execute("PRAGMA incremental_vacuum(1000)").fetchall()
+            reclaimed = free - conn.execute("PRAGMA freelist_count").fetchone()[0]
             # 3. Truncate the WAL again to flush vacuum's own bookkeeping.
             ckpt = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
-            if reclaimed:
+            if reclaimed > 0:
+                self._metrics.count_compacted(reclaimed)
                 log.debug(
                     "DB compact: reclaimed %d pages, WAL log=%d ckpt=%d busy=%d",
-                    len(reclaimed),
+                    reclaimed,
                     ckpt[1] if ckpt else -1,
                     ckpt[2] if ckpt else -1,
                     ckpt[0] if ckpt else -1,
@@ -639,111 +3957,1077 @@ class MyQueue:
             raise RuntimeError("compact requires db_path to be set")
         self._db_compact()
 
-    def _enqueue(self, table: str, payload: bytes) -> None:
+    def _queue(self, name: str) -> _QueueConfig:
+        """Return the settings of queue ``name``. A queue declared by
+        another process sharing the DB is picked up on first use. Raises
+        ``ValueError`` if there is no such queue, or it has been dropped."""
+        config = self._queues.get(name)
+        if config is None and self._db_path is not None:
+            # Under the lock, so a concurrent drop_queue() cannot delete the
+            # row between the lookup and the registration.
+            with self._queues_lock:
+                config = self._queues.get(name)
+                if config is None:
+                    row = (
+                        self._open_db()
+                        .execute(
+                            "SELECT max_queue_size, ttl_seconds, overflow "
+                            "FROM queues WHERE name = ?",
+                            (name,),
+                        )
+                        .fetchone()
+                    )
+                    if row is not None:
+                        config = self._queues[name] = _QueueConfig(name, *row)
+        if config is None or config.dropped:
+            raise ValueError("unknown queue: %r" % (name,))
+        return config
+
+    @contextmanager
+    def _live(self, config: _QueueConfig) -> Iterator[None]:
+        """Context manager around an operation on ``config``'s queue: if a
+        concurrent ``drop_queue()`` pulls the table out from under it, the
+        resulting SQLite or filesystem error becomes the ``ValueError`` of
+        an unknown queue."""
+        try:
+            yield
+        except (sqlite3.Error, OSError, KeyError) as ex:
+            if not config.dropped:
+                raise
+            raise ValueError("unknown queue: %r" % (config.name,)) from ex
+
+    def _load_queues(self) -> list[_QueueConfig]:
+        """Refresh the queue registry from the DB (other processes may have
+        declared or dropped queues) and return every queue, built-ins
+        first. A queue whose settings did not change keeps its config, and
+        one that vanished is marked dropped, as ``drop_queue()`` would."""
+        with self._queues_lock:
+            rows = self._open_db().execute(
+                "SELECT name, max_queue_size, ttl_seconds, overflow "
+                "FROM queues ORDER BY name"
+            )
+            queues = {name: self._queues[name] for name in _TABLES}
+            for name, *settings in rows:
+                config = self._queues.get(name)
+                if config is None or settings != [
+                    config.max_queue_size,
+                    config.ttl_seconds,
+                    config.overflow,
+                ]:
+                    config = _QueueConfig(name, *settings)
+                queues[name] = config
+            for name, config in self._queues.items():
+                if name not in queues:
+                    config.dropped = True
+            self._queues = queues
+            self._sweep_queues = list(queues.values())
+            return self._sweep_queues
+
+    def _swept_queues(self) -> list[_QueueConfig]:
+        """Every queue, for the maintenance sweeps: the registry as last
+        loaded, reloaded only after ``declare_queue()`` or ``drop_queue()``
+        changed it, so an idle sweep costs no registry query."""
+        configs = self._sweep_queues
+        if configs is None:
+            configs = self._load_queues()
+        return configs
+
+    def _cache(self, queue: str) -> _HeadCache | None:
+        """The head cache of ``queue``, or ``None`` if caching is off."""
+        if not self._cache_size:
+            return None
+        cache = self._caches.get(queue)
+        if cache is None:
+            cache = self._caches.setdefault(queue, _HeadCache(self._cache_size))
+        return cache
+
+    def _invalidate_cache(self, queue: str) -> None:
+        """Discard the head cache of ``queue`` after a change it cannot
+        follow; the next GET rebuilds it from disk."""
+        cache = self._caches.get(queue)
+        if cache is not None:
+            with cache.lock:
+                cache.invalidate()
+
+    def _fill_cache(self, cache: _HeadCache, table: str) -> None:
+        """Rebuild ``cache`` from ``table``. The caller holds its lock."""
+        limit = cache.capacity + len(cache.pending)
+        # LENGTH() of a blob comes from the record header, so a row too big
+        # to cache is never read. The cursor is consumed lazily and
+        # abandoned at the first such row.
+        rows = self._open_db().execute(  # read-only: no writer lock needed
+            f"SELECT -priority, id, IIF(LENGTH(payload) <= ?, payload, NULL) "
+            f"FROM {table} WHERE visible_at IS NULL "
+            f"ORDER BY priority DESC, id LIMIT ?",
+            (_CACHE_MAX_PAYLOAD, limit),
+        )
+        cache.fill(rows, limit)
+
+    def _dequeue_cached(
+        self, table: str, cache: _HeadCache, max_items: int
+    ) -> list[bytes] | None:
+        """Pop up to ``max_items`` payloads through the head cache, deleting
+        their rows by id. Returns ``None`` when the cache cannot answer (its
+        head row is too big to cache, or every entry it offered was stale)
+        and the caller should pop from disk instead."""
+        with cache.lock:
+            if not cache.valid or (
+                0 < len(cache.entries) < max_items and not cache.complete
+            ):
+                self._fill_cache(cache, table)
+            if not cache.entries:
+                return [] if cache.complete else None
+            taken = cache.take(max_items, _U32.size)
+        ids = [entry[1] for entry in taken]
+        marks = ",".join("?" * len(ids))
+
+        def delete(conn: sqlite3.Connection) -> list[tuple[int]]:
+            return conn.execute(
+                f"DELETE FROM {table} "
+                f"WHERE id IN ({marks}) AND visible_at IS NULL RETURNING id",
+                ids,
+            ).fetchall()
+
+        deleted: set[int] = set()
+        try:
+            deleted = {row[0] for row in self._write(delete)}
+        finally:
+            with cache.lock:
+                cache.pending.difference_update(ids)
+                if len(deleted) < len(ids):
+                    # Leased, evicted or deleted behind the cache's back,
+                    # or the DELETE failed: start again from disk.
+                    cache.invalidate()
+        if not deleted:
+            return None
+        return [entry[2] for entry in taken if entry[1] in deleted]
+
+    def _enqueue(
+        self, queue: str, payload: bytes, priority: int = 0, delay: float = 0.0
+    ) -> None:
         """Insert one row, evicting the oldest if we're at capacity."""
-        if table not in _TABLES:
-            raise ValueError("unknown table: %s" % table)
-        if not payload:
+        self._enqueue_many(queue, [payload], priority, delay)
+
+    def _enqueue_many(
+        self,
+        queue: str,
+        payloads: list[bytes],
+        priority: int = 0,
+        delay: float = 0.0,
+    ) -> None:
+        """Insert several rows with the same ``priority`` in one
+        transaction, evicting the oldest rows once for the whole batch if it
+        would push us past capacity. With a ``delay`` (seconds) the rows
+        stay hidden until it is over.
+
+        A batch larger than ``max_queue_size`` keeps only its newest
+        ``max_queue_size`` entries, exactly as if they had been inserted one
+        at a time.
+
+        Under the ``reject`` and ``block`` overflow policies nothing is
+        evicted: a batch that does not fit raises ``QueueFull`` (for a
+        ``block`` queue, ``_until_room`` waits and tries again), and one
+        that never could raises ``ValueError``.
+
+        With shards, each batch goes to the next shard in turn, and each
+        shard holds at most its share of ``max_queue_size`` (rounded
+        up)."""
+        config = self._queue(queue)
+        max_size = -(-config.max_queue_size // self._shards)
+        if not payloads:
+            return
+        if not all(payloads):
             raise ValueError("refusing to enqueue an empty payload")
+        if len(payloads) > max_size and config.overflow != "drop_oldest":
+            raise ValueError(
+                "a batch of %d can never fit in %s (%d per shard)"
+                % (len(payloads), queue, max_size)
+            )
+        if len(payloads) > max_size:
+            log.warning(
+                "%s batch of %d exceeds capacity (%d); dropping %d oldest",
+                queue,
+                len(payloads),
+                max_size,
+                len(payloads) - max_size,
+            )
+            payloads = payloads[-max_size:]
         now = time.time()
-        with self._db_txn() as conn:
-            (count,) = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()
-            # Evict as many as needed so that after the insert we are at
-            # most at max_queue_size (a single delete is not enough if the
-            # table somehow grew past the limit).
-            overflow = count - self._max_queue_size + 1
-            if overflow > 0:
-                log.warning(
-                    "%s queue at capacity (%d); dropping %d oldest",
-                    table,
-                    self._max_queue_size,
-                    overflow,
+        visible_at = now + delay if delay > 0 else None
+        self._storage.put(config, payloads, now, max_size, priority, visible_at)
+        if visible_at is None:
+            self._notifier.notify(queue)
+        elif visible_at < self._next_sweep:
+            # Due before the maintenance thread would next look.
+            self._sweep_wakeup.set()
+
+    def _make_room(
+        self,
+        conn: sqlite3.Connection,
+        config: _QueueConfig,
+        max_size: int,
+        incoming: int,
+    ) -> bool:
+        """Evict the oldest rows of ``config``'s table so that ``incoming``
+        more fit within ``max_size``. Returns whether any were evicted.
+        Under the ``reject`` and ``block`` overflow policies, raises
+        ``QueueFull`` instead of evicting."""
+        table = config.table
+        # Evict as many as needed so that after the insert we are at most
+        # at max_queue_size (a single delete is not enough if the table
+        # somehow grew past the limit).
+        overflow = self._depth(conn, table) - max_size + incoming
+        if overflow <= 0:
+            return False
+        if config.overflow != "drop_oldest":
+            raise QueueFull("%s queue is full (%d)" % (config.name, max_size))
+        log.warning(
+            "%s queue at capacity (%d); dropping %d oldest",
+            config.name,
+            max_size,
+            overflow,
+        )
+        conn.execute(
+            f"DELETE FROM {table} "
+            f"WHERE id IN (SELECT id FROM {table} ORDER BY id LIMIT ?)",
+            (overflow,),
+        )
+        return True
+
+    def _until_room(
+        self,
+        config: _QueueConfig,
+        put: Callable[[], tuple[bytes, bytes] | None],
+        can_park: bool = False,
+        deadline: float | None = None,
+    ) -> tuple[bytes, bytes] | _Parked | None:
+        """Answer a PUT to ``config``'s queue by running ``put``, which
+        stores it and returns the response; if the queue is full, NACK it.
+        Under the ``block`` overflow policy, first wait for a consumer to
+        make room (see ``_made_room``) and run ``put`` again, until
+        ``deadline`` (``_BLOCK_PUT_SECONDS`` from now by default). With
+        ``can_park`` the caller is an event loop that must not block, so a
+        full queue yields a ``_Parked`` marker instead of a wait."""
+        if deadline is None:
+            deadline = time.monotonic() + _BLOCK_PUT_SECONDS
+        key = _room_key(config.name)
+        while True:
+            seen = self._notifier.seq(key)
+            try:
+                with self._live(config):
+                    return put()
+            except QueueFull as ex:
+                full = _nack(ex)
+            except ValueError as ex:
+                if not config.dropped:
+                    raise
+                # The queue was dropped while this PUT was waiting.
+                return _OP_ERROR, str(ex).encode("utf-8")
+            remaining = deadline - time.monotonic()
+            if config.overflow != "block" or remaining <= 0 or self._shutdown.is_set():
+                return full
+            if can_park:
+                retry = partial(self._until_room, config, put, True, deadline)
+                return _Parked(key, deadline, seen, retry, full)
+            # Wake at least once a second to notice a shutdown.
+            self._notifier.wait(key, seen, min(remaining, 1.0))
+
+    def _made_room(self, config: _QueueConfig) -> None:
+        """Wake the PUTs waiting for room in ``config``'s queue, if its
+        overflow policy lets them wait. Call after rows leave the queue."""
+        if config.overflow == "block":
+            self._notifier.notify(_room_key(config.name))
+
+    def _dequeue(self, queue: str) -> bytes | None:
+        """Atomically pop the payload of the oldest of the highest-priority
+        rows. Returns None if empty."""
+        config = self._queue(queue)
+        items = self._storage.pop(config, 1)
+        if not items:
+            return None
+        self._made_room(config)
+        return items[0]
+
+    def _dequeue_batch(self, queue: str, max_items: int) -> list[bytes]:
+        """Atomically pop up to ``max_items`` payloads in one transaction,
+        in delivery order: highest priority first, oldest first within a
+        priority. Returns an empty list if the queue is empty.
+
+        The running-total window keeps the summed size of the returned
+        items (plus their length prefixes) within ``_BATCH_BUDGET`` so the
+        response always fits in one frame. The first row is always taken,
+        whatever its size, so a batch never comes back empty while rows
+        remain."""
+        config = self._queue(queue)
+        items = self._storage.pop(config, max_items)
+        if items:
+            self._made_room(config)
+        return items
+
+    @staticmethod
+    def _next_visible_sql(table: str, overhead: int) -> str:
+        """SQL selecting the ids of the next rows of ``table`` to deliver
+        that are not leased: up to ``?`` of them, as many as fit in ``?``
+        bytes counting ``overhead`` bytes of framing per row (see
+        ``_dequeue_batch``)."""
+        return (
+            f"SELECT id FROM ("
+            f"  SELECT id,"
+            f"         ROW_NUMBER() OVER (ORDER BY priority DESC, id) AS rn,"
+            f"         SUM(LENGTH(payload) + {overhead})"
+            f"           OVER (ORDER BY priority DESC, id) AS running"
+            f"  FROM {table} WHERE visible_at IS NULL"
+            f"  ORDER BY priority DESC, id LIMIT ?"
+            f") WHERE rn = 1 OR running <= ?"
+        )
+
+    def _take_sharded(
+        self, table: str, max_items: int, until: float | None = None
+    ) -> list[tuple[int, int, int, bytes]]:
+        """Pop, or with ``until`` lease until then, up to ``max_items`` rows
+        of ``table`` across all shards, as many as fit in ``_BATCH_BUDGET``
+        (the first always fits). Returns ``(shard, id, deliveries,
+        payload)`` in delivery order.
+
+        Each shard's ready index yields its own next rows; merging them by
+        priority and then ``created_at`` gives the order the rows would
+        have had in a single table, give or take rows created in the same
+        instant. The chosen rows are then taken with one write per shard
+        that only matches rows still visible, so rows another consumer got
+        to first are skipped, never handed out twice."""
+        overhead = _U32.size if until is None else _U32.size + _RECEIPT.size
+
+        def take(
+            sql: str, params: list[Any], conn: sqlite3.Connection
+        ) -> list[tuple[int, float, int, int, bytes]]:
+            return conn.execute(sql, params).fetchall()
+
+        while True:
+            heads: list[tuple[int, float, int, int, int]] = []
+            for shard in range(self._shards):
+                rows = self._open_db(shard).execute(  # read-only: no lock
+                    f"SELECT -priority, created_at, id, LENGTH(payload) "
+                    f"FROM {table} WHERE visible_at IS NULL "
+                    f"ORDER BY priority DESC, id LIMIT ?",
+                    (max_items,),
                 )
-                conn.execute(
-                    f"DELETE FROM {table} "
-                    f"WHERE id IN (SELECT id FROM {table} ORDER BY id LIMIT ?)",
-                    (overflow,),
+                heads.extend((key, at, shard, id_, n) for key, at, id_, n in rows)
+            if not heads:
+                return []
+            heads.sort()
+            picked: dict[int, list[int]] = {}
+            used = 0
+            for i, (_key, _at, shard, id_, size) in enumerate(heads[:max_items]):
+                used += size + overhead
+                if i and used > _BATCH_BUDGET:
+                    break
+                picked.setdefault(shard, []).append(id_)
+
+            taken: list[tuple[int, float, int, int, int, bytes]] = []
+            for shard, ids in picked.items():
+                marks = ",".join("?" * len(ids))
+                where = (
+                    f"WHERE id IN ({marks}) AND visible_at IS NULL "
+                    f"RETURNING -priority, created_at, id, deliveries, payload"
+                )
+                params: list[Any] = list(ids)
+                if until is None:
+                    sql = f"DELETE FROM {table} {where}"
+                else:
+                    sql = (
+                        f"UPDATE {table} "
+                        f"SET visible_at = ?, deliveries = deliveries + 1 {where}"
+                    )
+                    params.insert(0, until)
+                taken.extend(
+                    (key, at, shard, id_, n, payload)
+                    for key, at, id_, n, payload in self._write(
+                        partial(take, sql, params), shard
+                    )
                 )
-            conn.execute(
-                f"INSERT INTO {table} (payload, created_at) VALUES (?, ?)",
-                (payload, now),
+            if taken:
+                taken.sort()
+                return [row[2:] for row in taken]
+
+    def _lease(
+        self, queue: str, max_items: int, lease_seconds: float
+    ) -> list[tuple[bytes, bytes]]:
+        """Lease up to ``max_items`` visible rows of ``queue`` for
+        ``lease_seconds`` in one transaction. Returns ``(receipt, payload)``
+        pairs in delivery order; an empty list if no row is visible. The
+        rows stay in the table until ``_ack`` deletes them or their lease
+        runs out."""
+        table = self._queue(queue).table
+        if self._storage.fifo_only:
+            raise ValueError(_FIFO_ONLY)
+        until = time.time() + lease_seconds
+        if self._shards > 1:
+            # The receipt names the shard in the row id's top bits.
+            return [
+                (_RECEIPT.pack(shard << _SHARD_SHIFT | id_, n), p)
+                for shard, id_, n, p in self._take_sharded(table, max_items, until)
+            ]
+
+        def lease(conn: sqlite3.Connection) -> list[tuple[int, int, int, bytes]]:
+            return conn.execute(
+                f"UPDATE {table} SET visible_at = ?, deliveries = deliveries + 1 "
+                f"WHERE id IN ("
+                f"{self._next_visible_sql(table, _U32.size + _RECEIPT.size)}"
+                f") RETURNING priority, id, deliveries, payload",
+                (until, max_items, _BATCH_BUDGET),
+            ).fetchall()
+
+        rows = self._write(lease)
+        self._invalidate_cache(queue)
+        rows.sort(key=lambda r: (-r[0], r[1]))
+        return [(_RECEIPT.pack(id_, n), p) for _, id_, n, p in rows]
+
+    def _ack(self, queue: str, receipts: list[tuple[int, int]]) -> int:
+        """Delete the leased rows named by ``(id, deliveries)`` receipts.
+        Returns how many were deleted: a receipt whose row was since leased
+        again, acknowledged or evicted matches nothing."""
+        config = self._queue(queue)
+        table = config.table
+        if self._storage.fifo_only:
+            raise ValueError(_FIFO_ONLY)
+
+        by_shard: dict[int, list[tuple[int, int]]] = {}
+        for id_, n in receipts:
+            shard = id_ >> _SHARD_SHIFT
+            by_shard.setdefault(shard, []).append((id_ - (shard << _SHARD_SHIFT), n))
+
+        def delete(pairs: list[tuple[int, int]], conn: sqlite3.Connection) -> int:
+            cur = conn.executemany(
+                f"DELETE FROM {table} WHERE id = ? AND deliveries = ?", pairs
+            )
+            return cur.rowcount
+
+        deleted = sum(
+            self._write(partial(delete, pairs), shard)
+            for shard, pairs in by_shard.items()
+            if shard < self._shards  # anything else is not our receipt
+        )
+        if deleted:
+            self._made_room(config)
+        return deleted
+
+    def _split_row_id(self, row_id: int) -> tuple[int, int]:
+        """Split the row id of a receipt or stream ID into ``(shard, id)``.
+        Raises ``ValueError`` if it names a shard this server lacks."""
+        shard = row_id >> _SHARD_SHIFT
+        if shard >= self._shards:
+            raise ValueError("row %d belongs to no shard of this server" % row_id)
+        return shard, row_id - (shard << _SHARD_SHIFT)
+
+    def _stream_begin(self, queue: str, size: int) -> int:
+        """Insert the hidden row of a streamed PUT: the raw codec's tag
+        followed by ``size`` zero bytes for the chunks to overwrite. Returns
+        the stream ID (the row id, with its shard in the top bits)."""
+        config = self._queue(queue)
+        if self._storage.fifo_only:
+            raise ValueError(_FIFO_ONLY)
+        table = config.table
+        max_size = -(-config.max_queue_size // self._shards)
+        now = time.time()
+
+        def insert(conn: sqlite3.Connection) -> tuple[int, bool]:
+            limit = conn.getlimit(sqlite3.SQLITE_LIMIT_LENGTH)
+            if size >= limit:
+                raise ValueError(
+                    "a stream of %d bytes exceeds SQLite's BLOB limit of %d"
+                    % (size, limit - 1)
+                )
+            evicted = self._make_room(conn, config, max_size, 1)
+            cur = conn.execute(
+                f"INSERT INTO {table} (payload, created_at, visible_at, deliveries) "
+                f"VALUES (zeroblob(?), ?, ?, ?)",
+                (size + 1, now, now + _STREAM_IDLE_SECONDS, _STREAM_PENDING),
+            )
+            with conn.blobopen(table, "payload", cur.lastrowid) as blob:
+                blob.write(_TAG_RAW)
+            return cur.lastrowid, evicted
+
+        shard = next(self._next_shard) % self._shards
+        row, evicted = self._write(insert, shard)
+        if evicted:
+            self._invalidate_cache(queue)
+        return shard << _SHARD_SHIFT | row
+
+    def _stream_write(
+        self, queue: str, stream_id: int, offset: int, data: bytes | memoryview
+    ) -> None:
+        """Write one chunk of a streamed PUT at byte ``offset`` of its
+        message, and push back the moment the upload counts as idle."""
+        table = self._queue(queue).table
+        shard, row = self._split_row_id(stream_id)
+
+        def write(conn: sqlite3.Connection) -> None:
+            cur = conn.execute(
+                f"UPDATE {table} SET visible_at = ? WHERE id = ? AND deliveries = ?",
+                (time.time() + _STREAM_IDLE_SECONDS, row, _STREAM_PENDING),
+            )
+            if cur.rowcount != 1:
+                raise ValueError("no upload %d in progress on %s" % (stream_id, queue))
+            with conn.blobopen(table, "payload", row) as blob:
+                if offset + len(data) >= len(blob):
+                    raise ValueError(
+                        "chunk of %d bytes at %d overruns a %d-byte stream"
+                        % (len(data), offset, len(blob) - 1)
+                    )
+                blob.seek(1 + offset)
+                blob.write(data)
+
+        self._write(write, shard)
+
+    def _stream_end(self, queue: str, stream_id: int) -> None:
+        """Publish a streamed PUT: its row becomes an ordinary message,
+        queued in the place the upload started in."""
+        table = self._queue(queue).table
+        shard, row = self._split_row_id(stream_id)
+
+        def publish(conn: sqlite3.Connection) -> int:
+            return conn.execute(
+                f"UPDATE {table} SET visible_at = NULL, deliveries = 0 "
+                f"WHERE id = ? AND deliveries = ?",
+                (row, _STREAM_PENDING),
+            ).rowcount
+
+        if not self._write(publish, shard):
+            raise ValueError("no upload %d in progress on %s" % (stream_id, queue))
+        # The row may belong anywhere in the cached head.
+        self._invalidate_cache(queue)
+        self._notifier.notify(queue)
+
+    def _stream_open(
+        self, queue: str, lease_seconds: float
+    ) -> tuple[bytes, int] | None:
+        """Lease the next message of ``queue`` like ``_lease``, but return
+        ``(receipt, size)`` instead of its payload, which stays on disk
+        for ``_stream_read``. Returns ``None`` if no row is visible. Raises
+        ``ValueError``, leasing nothing, if the next message was not sent
+        as raw bytes."""
+        table = self._queue(queue).table
+        if self._storage.fifo_only:
+            raise ValueError(_FIFO_ONLY)
+        until = time.time() + lease_seconds
+
+        def lease(row: int, conn: sqlite3.Connection) -> tuple[int, int] | None:
+            head = conn.execute(
+                f"SELECT substr(payload, 1, 1) FROM {table} "
+                f"WHERE id = ? AND visible_at IS NULL",
+                (row,),
+            ).fetchone()
+            if head is None:
+                return None  # another consumer got there first
+            if head[0] != _TAG_RAW:
+                raise ValueError(
+                    "the next message of %s was not sent as raw bytes; "
+                    "use get() or lease()" % queue
+                )
+            return conn.execute(
+                f"UPDATE {table} SET visible_at = ?, deliveries = deliveries + 1 "
+                f"WHERE id = ? RETURNING deliveries, LENGTH(payload)",
+                (until, row),
+            ).fetchone()
+
+        while True:
+            # Same order as _take_sharded: priority, then age across shards.
+            heads = []
+            for shard in range(self._shards):
+                head = (
+                    self._open_db(shard)
+                    .execute(  # read-only: no lock
+                        f"SELECT -priority, created_at, id FROM {table} "
+                        f"WHERE visible_at IS NULL ORDER BY priority DESC, id LIMIT 1"
+                    )
+                    .fetchone()
+                )
+                if head is not None:
+                    heads.append((head[0], head[1], shard, head[2]))
+            if not heads:
+                return None
+            _key, _at, shard, row = min(heads)
+            leased = self._write(partial(lease, row), shard)
+            if leased is not None:
+                self._invalidate_cache(queue)
+                deliveries, length = leased
+                receipt = _RECEIPT.pack(shard << _SHARD_SHIFT | row, deliveries)
+                return receipt, length - 1
+
+    def _stream_read(
+        self, queue: str, receipt: tuple[int, int], offset: int, length: int
+    ) -> bytes:
+        """Up to ``length`` bytes from ``offset`` of the message leased
+        under ``receipt``. Reads only those bytes, without the writer
+        lock. Raises ``ValueError`` once the lease no longer holds."""
+        table = self._queue(queue).table
+        shard, row = self._split_row_id(receipt[0])
+        conn = self._open_db(shard)
+        conn.execute("BEGIN")  # one snapshot for the check and the read
+        try:
+            if not conn.execute(
+                f"SELECT 1 FROM {table} "
+                f"WHERE id = ? AND deliveries = ? AND visible_at IS NOT NULL",
+                (row, receipt[1]),
+            ).fetchone():
+                raise ValueError("the lease of this message on %s is over" % queue)
+            with conn.blobopen(table, "payload", row, readonly=True) as blob:
+                if offset >= len(blob):
+                    return b""
+                blob.seek(1 + offset)
+                return blob.read(length)
+        finally:
+            conn.execute("COMMIT")
+
+    def _release_due_rows(self) -> dict[str, int]:
+        """Make rows whose lease or delay has run out visible and wake any
+        waiting consumers. Returns counts per queue. Each queue is probed
+        through its lease index without the writer lock first, so only
+        queues with due rows cost a write."""
+        now = time.time()
+        configs = self._swept_queues()
+        released: dict[str, int] = {}
+
+        def release(
+            expired: list[_QueueConfig], conn: sqlite3.Connection
+        ) -> dict[str, int]:
+            counts: dict[str, int] = {}
+            for config in expired:
+                cur = conn.execute(
+                    f"DELETE FROM {config.table} "
+                    f"WHERE visible_at <= ? AND deliveries = ?",
+                    (now, _STREAM_PENDING),
+                )
+                if cur.rowcount > 0:
+                    log.warning(
+                        "Dropped %d abandoned stream upload(s) from %s",
+                        cur.rowcount,
+                        config.name,
+                    )
+                cur = conn.execute(
+                    f"UPDATE {config.table} SET visible_at = NULL "
+                    f"WHERE visible_at <= ?",
+                    (now,),
+                )
+                if cur.rowcount > 0:
+                    counts[config.name] = cur.rowcount
+            return counts
+
+        for shard in range(self._shards):
+            conn = self._open_db(shard)  # read-only probe: no writer lock needed
+            expired = [
+                config
+                for config in configs
+                if not config.dropped
+                and conn.execute(
+                    f"SELECT 1 FROM {config.table} WHERE visible_at <= ? LIMIT 1",
+                    (now,),
+                ).fetchone()
+            ]
+            if not expired:
+                continue
+            for queue, n in self._write(partial(release, expired), shard).items():
+                released[queue] = released.get(queue, 0) + n
+        for queue in released:
+            # The released rows may belong anywhere in the cached head.
+            self._invalidate_cache(queue)
+            self._notifier.notify(queue)
+        return released
+
+    def _next_visible_at(self) -> float:
+        """Earliest ``visible_at`` of any hidden row in any known queue, or
+        ``math.inf`` if nothing is hidden. One index probe per queue and
+        shard."""
+        due = math.inf
+        for shard in range(self._shards):
+            conn = self._open_db(shard)  # read-only: no writer lock needed
+            for config in list(self._queues.values()):
+                if config.dropped:
+                    continue
+                (first,) = conn.execute(
+                    f"SELECT MIN(visible_at) FROM {config.table} "
+                    f"WHERE visible_at IS NOT NULL"
+                ).fetchone()
+                if first is not None:
+                    due = min(due, first)
+        return due
+
+    @staticmethod
+    def _depth(conn: sqlite3.Connection, table: str) -> int:
+        """Current row count of ``table`` from the trigger-maintained
+        counter: one primary-key lookup however deep the queue is."""
+        row = conn.execute(
+            "SELECT depth FROM queue_depth WHERE name = ?", (table,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def _table_size(self, queue: str) -> int:
+        return self._storage.size(self._queue(queue))
+
+    def _table_empty(self, queue: str) -> bool:
+        """O(1) emptiness check, unlike COUNT(*)."""
+        return self._storage.empty(self._queue(queue))
+
+    def _table_clear(self, queue: str) -> None:
+        config = self._queue(queue)
+        self._storage.clear(config)
+        self._made_room(config)
+
+    def _table_peek(self, queue: str) -> bytes | None:
+        """Return the payload the next GET would pop, without removing it.
+        None if there is none."""
+        return self._storage.peek(self._queue(queue))
+
+    def _reap_expired(self) -> dict[str, int]:
+        """Delete rows older than their queue's ``ttl_seconds``. Returns
+        counts per queue.
+
+        Rows go oldest first, in batches of ``self._reap_batch`` with a
+        transaction each, so a backlog of millions never holds the writer
+        lock for more than one batch at a time. After each batch the
+        reaper sleeps as long as the batch held the lock, letting waiting
+        producers and consumers in, and rescales the batch toward
+        ``_REAP_HOLD_SECONDS``. After ``_REAP_PASS_SECONDS`` it counts
+        the expired rows left over per queue, records them as the reap
+        backlog, and returns."""
+        configs = [
+            c
+            for c in self._swept_queues()
+            if c.ttl_seconds is not None and not c.dropped
+        ]
+        if not configs:
+            self._metrics.set_reap_backlog({})
+            return {}
+        reaped = self._storage.reap(configs, time.time())
+        for config in configs:
+            if reaped.get(config.name):
+                self._made_room(config)
+        return reaped
+
+    def _batch_get_response(
+        self, queue: str, payload: bytes
+    ) -> tuple[bytes, bytes] | None:
+        if len(payload) != _U32.size:
+            log.warning("Malformed batch GET (%d bytes); closing", len(payload))
+            return None
+        (max_items,) = _U32.unpack(payload)
+        if not 1 <= max_items <= _MAX_BATCH_ITEMS:
+            log.warning("Batch GET size %d out of range; closing", max_items)
+            return None
+        items = self._dequeue_batch(queue, max_items)
+        if not items:
+            return _OP_EMPTY, b""
+        return _OP_ITEMS, _pack_items(items)
+
+    def _lease_response(self, queue: str, payload: bytes) -> tuple[bytes, bytes] | None:
+        if len(payload) != 2 * _U32.size:
+            log.warning("Malformed LEASE (%d bytes); closing", len(payload))
+            return None
+        if self._storage.fifo_only:
+            return _OP_ERROR, _FIFO_ONLY.encode("utf-8")
+        (max_items,) = _U32.unpack(payload[: _U32.size])
+        (lease_ms,) = _U32.unpack(payload[_U32.size :])
+        if not 1 <= max_items <= _MAX_BATCH_ITEMS or not 1 <= lease_ms <= _MAX_LEASE_MS:
+            log.warning(
+                "LEASE of %d for %d ms out of range; closing", max_items, lease_ms
             )
+            return None
+        leased = self._lease(queue, max_items, lease_ms / 1000.0)
+        if not leased:
+            return _OP_EMPTY, b""
+        return _OP_ITEMS, _pack_items([receipt + item for receipt, item in leased])
+
+    def _ack_response(self, queue: str, payload: bytes) -> tuple[bytes, bytes] | None:
+        if not payload or len(payload) % _RECEIPT.size:
+            log.warning("Malformed lease ACK (%d bytes); closing", len(payload))
+            return None
+        if self._storage.fifo_only:
+            return _OP_ERROR, _FIFO_ONLY.encode("utf-8")
+        receipts = list(_RECEIPT.iter_unpack(payload))
+        return _OP_ACK, _U32.pack(self._ack(queue, receipts))
+
+    def _stream_response(
+        self, opcode: bytes, queue: str, payload: bytes, can_park: bool
+    ) -> tuple[bytes, bytes] | _Parked | None:
+        if self._storage.fifo_only:
+            return _OP_ERROR, _FIFO_ONLY.encode("utf-8")
+        try:
+            if opcode == _OP_QSTREAM_PUT and len(payload) == _U64.size:
+                (size,) = _U64.unpack(payload)
+
+                def begin() -> tuple[bytes, bytes]:
+                    return _OP_ACK, _U64.pack(self._stream_begin(queue, size))
+
+                return self._until_room(self._queue(queue), begin, can_park)
+            if opcode == _OP_QSTREAM_WRITE and (
+                _STREAM_AT.size < len(payload) <= _STREAM_AT.size + _STREAM_CHUNK
+            ):
+                stream_id, offset = _STREAM_AT.unpack_from(payload)
+                data = memoryview(payload)[_STREAM_AT.size :]
+                self._stream_write(queue, stream_id, offset, data)
+                return _OP_ACK, b""
+            if opcode == _OP_QSTREAM_END and len(payload) == _U64.size:
+                self._stream_end(queue, _U64.unpack(payload)[0])
+                return _OP_ACK, b""
+            if opcode == _OP_QSTREAM_OPEN and len(payload) == _U32.size:
+                (lease_ms,) = _U32.unpack(payload)
+                if 1 <= lease_ms <= _MAX_LEASE_MS:
+                    opened = self._stream_open(queue, lease_ms / 1000.0)
+                    if opened is None:
+                        return _OP_EMPTY, b""
+                    receipt, size = opened
+                    return _OP_ITEM, receipt + _U64.pack(size)
+            if opcode == _OP_QSTREAM_READ and len(payload) == _STREAM_READ.size:
+                row, deliveries, offset, length = _STREAM_READ.unpack(payload)
+                if 1 <= length <= _STREAM_CHUNK:
+                    data = self._stream_read(queue, (row, deliveries), offset, length)
+                    return _OP_ITEM, data
+        except ValueError as ex:
+            # Expired uploads and leases, oversized streams, non-raw
+            # messages: refuse the request but keep the connection.
+            return _OP_ERROR, str(ex).encode("utf-8")
+        log.warning(
+            "Malformed stream request 0x%02x (%d bytes); closing",
+            opcode[0],
+            len(payload),
+        )
+        return None
+
+    def _wait_get_response(
+        self, queue: str, payload: bytes, can_park: bool
+    ) -> tuple[bytes, bytes] | _Parked | None:
+        if len(payload) != _U32.size:
+            log.warning("Malformed wait GET (%d bytes); closing", len(payload))
+            return None
+        (wait_ms,) = _U32.unpack(payload)
+        deadline = time.monotonic() + min(wait_ms, _MAX_WAIT_MS) / 1000.0
+        return self._poll_for_item(queue, deadline, can_park)
 
-    def _dequeue(self, table: str) -> bytes | None:
-        """Atomically pop the oldest row's payload. Returns None if empty.
-        Uses ``DELETE ... RETURNING`` (SQLite >= 3.35, March 2021)."""
-        if table not in _TABLES:
-            raise ValueError("unknown table: %s" % table)
-        with self._db_txn() as conn:
-            # The cursor MUST be drained: with RETURNING, SQLite only
-            # guarantees the row is deleted once the statement has been
-            # stepped to completion.
-            rows = conn.execute(
-                f"DELETE FROM {table} "
-                f"WHERE id = (SELECT id FROM {table} ORDER BY id LIMIT 1) "
-                f"RETURNING payload"
-            ).fetchall()
-            return rows[0][0] if rows else None
+    def _put_response(
+        self, queue: str, payload: bytes, can_park: bool
+    ) -> tuple[bytes, bytes] | _Parked | None:
+        if not payload:
+            log.warning("Empty PUT payload; closing connection")
+            return None
 
-    def _table_size(self, table: str) -> int:
-        if table not in _TABLES:
-            raise ValueError("unknown table: %s" % table)
-        conn = self._open_db()  # read-only: no writer lock needed
-        (count,) = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()
-        return count
+        def put() -> tuple[bytes, bytes]:
+            self._enqueue(queue, payload)
+            # ACK only after the row is committed, so the client knows the
+            # message is durable.
+            return _OP_ACK, b""
 
-    def _table_empty(self, table: str) -> bool:
-        """O(1) emptiness check, unlike COUNT(*)."""
-        if table not in _TABLES:
-            raise ValueError("unknown table: %s" % table)
-        conn = self._open_db()  # read-only: no writer lock needed
-        row = conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone()
-        return row is None
-
-    def _table_clear(self, table: str) -> None:
-        if table not in _TABLES:
-            raise ValueError("unknown table: %s" % table)
-        with self._db_txn() as conn:
-            conn.execute(f"DELETE FROM {table}")
-
-    def _table_peek(self, table: str) -> bytes | None:
-        """Return the oldest payload without removing it. None if empty."""
-        if table not in _TABLES:
-            raise ValueError("unknown table: %s" % table)
-        conn = self._open_db()  # read-only: no writer lock needed
-        row = conn.execute(
-            f"SELECT payload FROM {table} ORDER BY id LIMIT 1"
-        ).fetchone()
-        return row[0] if row else None
+        return self._until_room(self._queue(queue), put, can_park)
 
-    def _reap_expired(self) -> dict[str, int]:
-        """Delete rows older than ``ttl_seconds``. Returns counts per table."""
-        if self._ttl_seconds is None:
-            return {}
-        cutoff = time.time() - self._ttl_seconds
-        deleted: dict[str, int] = {}
-        with self._db_txn() as conn:
-            for table in _TABLES:
-                cur = conn.execute(
-                    f"DELETE FROM {table} WHERE created_at < ?", (cutoff,)
-                )
-                if cur.rowcount > 0:
-                    deleted[table] = cur.rowcount
-        return deleted
+    def _options_put_response(
+        self, queue: str, payload: bytes, can_park: bool
+    ) -> tuple[bytes, bytes] | _Parked | None:
+        if len(payload) < _I32.size + _U32.size:
+            log.warning("Malformed PUT options (%d bytes); closing", len(payload))
+            return None
+        (priority,) = _I32.unpack(payload[: _I32.size])
+        (delay_ms,) = _U32.unpack(payload[_I32.size : _I32.size + _U32.size])
+        if self._storage.fifo_only and (priority or delay_ms):
+            return _OP_ERROR, _FIFO_ONLY.encode("utf-8")
+        return self._batch_put_response(
+            queue,
+            payload[_I32.size + _U32.size :],
+            can_park,
+            priority,
+            delay_ms / 1000.0,
+        )
 
-    def _respond_with_item(self, sock: socket.socket, table: str) -> None:
-        item = self._dequeue(table)
-        if item is None:
-            _Frame.write(sock, _OP_EMPTY, b"", self._secret_key)
-        else:
-            _Frame.write(sock, _OP_ITEM, item, self._secret_key)
+    def _batch_put_response(
+        self,
+        queue: str,
+        payload: bytes,
+        can_park: bool,
+        priority: int = 0,
+        delay: float = 0.0,
+    ) -> tuple[bytes, bytes] | _Parked | None:
+        try:
+            items = _unpack_items(payload)
+        except ValueError as ex:
+            log.warning("Malformed batch PUT (%s); closing", ex)
+            return None
+        if not items or not all(items):
+            log.warning("Empty batch PUT item; closing connection")
+            return None
+
+        def put() -> tuple[bytes, bytes]:
+            try:
+                self._enqueue_many(queue, items, priority, delay)
+            except QueueFull:
+                raise
+            except ValueError as ex:
+                return _OP_ERROR, str(ex).encode("utf-8")
+            return _OP_ACK, _U32.pack(len(items))
+
+        return self._until_room(self._queue(queue), put, can_park)
+
+    def _poll_for_item(
+        self, queue: str, deadline: float, can_park: bool
+    ) -> tuple[bytes, bytes] | _Parked:
+        """Pop an item from ``queue``, waiting until ``deadline`` (a
+        ``time.monotonic()`` value) for one to be committed. With
+        ``can_park`` the caller is an event loop that must not block, so
+        an empty queue yields a ``_Parked`` marker instead of a wait."""
+        while True:
+            seen = self._notifier.seq(queue)
+            try:
+                config = self._queue(queue)
+                with self._live(config):
+                    item = self._dequeue(queue)
+            except ValueError as ex:
+                # The queue was dropped while this GET was waiting.
+                return _OP_ERROR, str(ex).encode("utf-8")
+            if item is not None:
+                return _OP_ITEM, item
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._shutdown.is_set():
+                return _OP_EMPTY, b""
+            if can_park:
+                retry = partial(self._poll_for_item, queue, deadline, True)
+                return _Parked(queue, deadline, seen, retry, (_OP_EMPTY, b""))
+            # Wake at least once a second to notice a shutdown.
+            self._notifier.wait(queue, seen, min(remaining, 1.0))
+
+    def _negotiate(
+        self, payload: bytes | memoryview
+    ) -> tuple[int, bytes, _FrameMac | None] | None:
+        """Answer a HELLO: pick the highest protocol version both sides
+        speak and, for protocol 3, a session MAC and this side's nonce.
+        Returns ``(version, ACK payload, MAC of every later frame)``, or
+        ``None`` if the offer is malformed."""
+        if not payload or payload[0] < 1:
+            log.warning("Malformed HELLO; closing connection")
+            return None
+        if len(payload) == 1:
+            # A client from before protocol 3 offers just its version.
+            version = min(payload[0], 2)
+            if self._require_session:
+                log.warning(
+                    "Refusing a protocol-%d HELLO: require_session is set", version
+                )
+                return None
+            return version, bytes([version]), self._mac
+        if payload[0] < 3 or len(payload) < 2 + _NONCE_SIZE:
+            log.warning("Malformed HELLO; closing connection")
+            return None
+        client_nonce = bytes(payload[1 : 1 + _NONCE_SIZE])
+        offered = bytes(payload[1 + _NONCE_SIZE :])
+        mac_id = next((i for i in offered if i in _SESSION_MACS.values()), None)
+        if mac_id is None:
+            log.warning("HELLO offers no session MAC this server knows; closing")
+            return None
+        server_nonce = os.urandom(_NONCE_SIZE)
+        if self._secret_key is None:
+            return 3, b"\x03" + server_nonce + b"\x00", None
+        session = _session_mac(
+            self._secret_key, client_nonce, server_nonce, mac_id, client=False
+        )
+        return 3, b"\x03" + server_nonce + bytes([mac_id]), session
+
+    def _handle_request(
+        self, opcode: bytes, payload: bytes, can_park: bool = False
+    ) -> tuple[bytes, bytes] | _Parked | None:
+        """Execute one request and return the ``(opcode, payload)`` of its
+        response. Returns ``None`` if the request is malformed and the
+        connection should be closed. Shared by both server engines; see
+        ``_poll_for_item`` for ``can_park``."""
+        t0 = time.perf_counter()
+        try:
+            return self._run_request(opcode, payload, can_park)
+        finally:
+            self._metrics.request(opcode, time.perf_counter() - t0)
+
+    def _run_request(
+        self, opcode: bytes, payload: bytes, can_park: bool
+    ) -> tuple[bytes, bytes] | _Parked | None:
+        if opcode == _OP_GET_CONSUMER or opcode == _OP_GET_PRODUCER:
+            item = self._dequeue(
+                "consumer" if opcode == _OP_GET_CONSUMER else "producer"
+            )
+            if item is None:
+                return _OP_EMPTY, b""
+            return _OP_ITEM, item
+        if opcode == _OP_WAIT_CONSUMER or opcode == _OP_WAIT_PRODUCER:
+            queue = "consumer" if opcode == _OP_WAIT_CONSUMER else "producer"
+            return self._wait_get_response(queue, payload, can_park)
+        if opcode == _OP_GET_CONSUMER_BATCH:
+            return self._batch_get_response("consumer", payload)
+        if opcode == _OP_GET_PRODUCER_BATCH:
+            return self._batch_get_response("producer", payload)
+        if opcode == _OP_PING:
+            return _OP_ACK, b""
+        if opcode == _OP_PUT_PRODUCER:
+            return self._put_response("producer", payload, can_park)
+        if opcode == _OP_PUT_PRODUCER_BATCH:
+            return self._batch_put_response("producer", payload, can_park)
+        if opcode in (
+            _OP_QGET,
+            _OP_QGET_BATCH,
+            _OP_QPUT,
+            _OP_QPUT_BATCH,
+            _OP_QPUT_OPTIONS,
+            _OP_QLEASE,
+            _OP_QACK,
+            *_STREAM_OPS,
+        ):
+            try:
+                queue, payload = _split_queue_name(payload)
+            except ValueError as ex:
+                log.warning("Malformed queue name (%s); closing", ex)
+                return None
+            try:
+                config = self._queue(queue)
+            except ValueError as ex:
+                # A well-formed request for a queue that does not exist
+                # (yet): refuse it but keep the connection.
+                return _OP_ERROR, str(ex).encode("utf-8")
+            try:
+                with self._live(config):
+                    return self._queue_request(opcode, queue, payload, can_park)
+            except ValueError as ex:
+                if not config.dropped:
+                    raise
+                # Dropped while the request was in flight: refuse it as if
+                # it had arrived a moment later.
+                return _OP_ERROR, str(ex).encode("utf-8")
+        log.warning(
+            "Unknown opcode 0x%02x; closing connection",
+            opcode[0] if opcode else 0,
+        )
+        return None
+
+    def _queue_request(
+        self, opcode: bytes, queue: str, payload: bytes, can_park: bool
+    ) -> tuple[bytes, bytes] | _Parked | None:
+        """Execute a request naming ``queue``, an existing queue."""
+        if opcode == _OP_QGET:
+            return self._wait_get_response(queue, payload, can_park)
+        if opcode == _OP_QGET_BATCH:
+            return self._batch_get_response(queue, payload)
+        if opcode == _OP_QPUT:
+            return self._put_response(queue, payload, can_park)
+        if opcode == _OP_QLEASE:
+            return self._lease_response(queue, payload)
+        if opcode == _OP_QACK:
+            return self._ack_response(queue, payload)
+        if opcode == _OP_QPUT_OPTIONS:
+            return self._options_put_response(queue, payload, can_park)
+        if opcode in _STREAM_OPS:
+            return self._stream_response(opcode, queue, payload, can_park)
+        return self._batch_put_response(queue, payload, can_park)
 
     def _serve_connection(self, client_sock: socket.socket) -> None:
         """Handle a single accepted connection until close or shutdown."""
+        mac = self._mac  # replaced by the session MAC after a protocol-3 HELLO
+        reader = _FrameReader(mac, metrics=self._metrics)
+        version = 0  # protocol version; 0 until the first frame
         try:
             while not self._shutdown.is_set():
                 try:
-                    frame = _Frame.read(client_sock, self._secret_key)
+                    frame = reader.read(client_sock)
                 except ValueError as ex:
                     log.warning("Closing connection: %s", ex)
                     return
@@ -751,27 +5035,51 @@ class MyQueue:
                     # Idle client; keep the connection open unless we are
                     # shutting down.
                     continue
-                if frame is None:
-                    return
-                opcode, payload = frame
-
-                if opcode == _OP_GET_CONSUMER:
-                    self._respond_with_item(client_sock, "consumer")
-                elif opcode == _OP_GET_PRODUCER:
-                    self._respond_with_item(client_sock, "producer")
-                elif opcode == _OP_PUT_PRODUCER:
-                    if not payload:
-                        log.warning("Empty PUT payload; closing connection")
-                        return
-                    self._enqueue("producer", payload)
-                    # ACK only after the row is committed, so the client
-                    # knows the message is durable.
-                    _Frame.write(client_sock, _OP_ACK, b"", self._secret_key)
-                else:
-                    log.warning(
-                        "Unknown opcode 0x%02x; closing connection",
-                        opcode[0] if opcode else 0,
-                    )
+                # Answer every request the client has already sent (it may
+                # pipeline), then write all the responses in one sendmsg().
+                # Each is signed as soon as it exists: a session MAC counts
+                # frames, and the HELLO answer is signed with the old MAC.
+                parts: list[bytes | memoryview] = []
+                close = False
+                while frame is not None:
+                    opcode, payload = frame
+                    request_id = b""
+                    response: tuple[bytes, bytes] | _Parked | None = None
+                    session = mac
+                    if version == 0 and opcode == _OP_HELLO:
+                        agreed = self._negotiate(payload)
+                        if agreed is not None:
+                            version, ack, session = agreed
+                            response = _OP_ACK, ack
+                    elif version == 0 and self._require_session:
+                        log.warning("Client skipped HELLO; require_session is set")
+                    else:
+                        version = version or 1
+                        try:
+                            if version >= 2:
+                                request_id, payload = _split_request_id(payload)
+                            # The payload is a view into the reader's buffer,
+                            # which the next frame overwrites, and storage
+                            # (the head cache) may keep it: take a copy.
+                            response = self._handle_request(opcode, bytes(payload))
+                        except ValueError as ex:
+                            log.warning("Closing connection: %s", ex)
+                    if response is None or isinstance(response, _Parked):
+                        close = True
+                        break
+                    try:
+                        parts.extend(_Frame.buffers(*response, mac, request_id))
+                        mac = reader.mac = session
+                        frame = reader.next_frame()
+                    except ValueError as ex:
+                        log.warning("Closing connection: %s", ex)
+                        close = True
+                        break
+                if parts:
+                    t0 = time.perf_counter()
+                    _send_buffers(client_sock, parts)
+                    self._metrics.response_write.observe(time.perf_counter() - t0)
+                if close or not parts:
                     return
         except (ConnectionError, OSError) as ex:
             log.debug("Connection closed: %s", ex)
@@ -838,36 +5146,93 @@ class MyQueue:
             t.start()
 
     def _maintenance_loop(self) -> None:
-        """Periodic background maintenance: thread reaping, TTL reaping,
-        WAL checkpointing."""
+        """Periodic background maintenance: lease and delay expiry, thread
+        reaping, TTL reaping, WAL checkpointing."""
+        next_reap = time.monotonic() + self._reaper_interval
+        timeout = 0.0
         try:
-            while not self._shutdown.wait(self._reaper_interval):
-                # 1. Drop references to finished worker threads.
-                with self._worker_threads_lock:
-                    self._worker_threads = [
-                        t for t in self._worker_threads if t.is_alive()
-                    ]
-
-                # 2. Delete rows whose created_at is past the TTL cutoff.
-                if self._ttl_seconds is not None:
-                    try:
-                        deleted = self._reap_expired()
-                        for table, n in deleted.items():
-                            log.info("Reaped %d expired entries from %s", n, table)
-                    except Exception:
-                        log.exception("TTL reaper iteration failed")
-
-                # 3. Compact the DB: return free pages to the OS, truncate
-                # the WAL. Replaces the previous PASSIVE checkpoint — that
-                # kept the WAL functionally bounded but didn't shrink either
-                # the main DB file or the WAL file on disk.
+            while True:
+                self._sweep_wakeup.wait(timeout)
+                self._sweep_wakeup.clear()
+                if self._shutdown.is_set():
+                    break
+
+                # Make rows whose lease or delay ran out visible. This runs
+                # whenever the next one is due, not every reaper_interval:
+                # neither a consumer that died holding a lease nor a
+                # message delayed by a second should wait that long. Until
+                # the next sweep is planned, any delayed PUT wakes us again
+                # rather than risk being missed.
+                self._next_sweep = math.inf
                 try:
-                    self._db_compact()
+                    released = self._release_due_rows()
+                    for queue, n in released.items():
+                        log.debug("%d rows became visible in %s", n, queue)
+                    due = self._next_visible_at()
                 except Exception:
-                    log.exception("DB compaction failed")
+                    log.exception("Visibility sweep failed")
+                    due = math.inf
+
+                # With segment_fsync="interval" this is what makes PUTs
+                # durable.
+                try:
+                    self._storage.sync()
+                except OSError:
+                    log.exception("Storage fsync failed")
+
+                if time.monotonic() >= next_reap:
+                    next_reap = time.monotonic() + self._reaper_interval
+                    self._periodic_maintenance()
+                elif self._metrics.reap_backlog:
+                    # The last reap pass ran out of time: carry on with it
+                    # now, with a visibility sweep in between.
+                    self._reap_ttl()
+
+                now = time.time()
+                timeout = max(
+                    0.0,
+                    min(due - now, _SWEEP_INTERVAL, next_reap - time.monotonic()),
+                )
+                if self._metrics.reap_backlog:
+                    timeout = 0.0
+                self._next_sweep = now + timeout
         finally:
             self.close_db()
 
+    def _periodic_maintenance(self) -> None:
+        """The maintenance done every ``reaper_interval``."""
+        # 1. Drop references to finished worker threads.
+        with self._worker_threads_lock:
+            self._worker_threads = [t for t in self._worker_threads if t.is_alive()]
+
+        # 2. Delete rows whose created_at is past their queue's TTL cutoff.
+        self._reap_ttl()
+
+        # 3. Compact the DB: return free pages to the OS, truncate the WAL.
+        # Replaces the previous PASSIVE checkpoint — that kept the WAL
+        # functionally bounded but didn't shrink either the main DB file or
+        # the WAL file on disk.
+        try:
+            self._db_compact()
+        except Exception:
+            log.exception("DB compaction failed")
+
+        # 4. Drop the head caches, so rows another process wrote to a queue
+        # wait at most this long behind this process's own.
+        for queue in list(self._caches):
+            self._invalidate_cache(queue)
+
+    def _reap_ttl(self) -> None:
+        """One TTL reap pass, logged and counted."""
+        try:
+            deleted = self._reap_expired()
+            self._metrics.count_reaped(deleted)
+            for queue, n in deleted.items():
+                log.info("Reaped %d expired entries from %s", n, queue)
+        except Exception:
+            log.exception("TTL reaper iteration failed")
+            self._metrics.set_reap_backlog({})  # retry on the normal schedule
+
     # ------------------------------------------------------------------ #
     # Server lifecycle                                                   #
     # ------------------------------------------------------------------ #
@@ -895,8 +5260,25 @@ class MyQueue:
         # stale "shutting down" state from a previous run and exit at once.
         self._shutdown.clear()
         self._ssock = ssock
+        if self._group_commit:
+            committers = [
+                _GroupCommitter(
+                    partial(self._db_txn, shard),
+                    self.close_db,
+                    self._group_commit_window,
+                    self._group_commit_max_ops,
+                )
+                for shard in range(self._shards)
+            ]
+            for committer in committers:
+                committer.start()
+            self._committers = committers
+        target: Callable[[], None] = self._controlling_loop
+        if self._engine == "selectors":
+            self._loop = _SelectorEngine(self, ssock, self._engine_workers)
+            target = self._loop.run
         self._listen_thread = threading.Thread(
-            target=self._controlling_loop,
+            target=target,
             name="tcpQueue-listener",
             daemon=True,
         )
@@ -907,16 +5289,43 @@ class MyQueue:
             daemon=True,
         )
         self._maintenance_thread.start()
+        if self._metrics_port is not None:
+            self._start_metrics_server()
+
+    def _start_metrics_server(self) -> None:
+        """Serve ``GET /metrics`` on ``metrics_port`` from a thread of its
+        own, next to the queue listener."""
+        try:
+            server = _MetricsHTTPServer((self._addr[0], self._metrics_port), self)
+        except Exception:
+            self.stop_server()
+            raise
+        self._metrics_server = server
+        threading.Thread(
+            target=server.serve_forever,
+            kwargs={"poll_interval": 0.5},
+            name="tcpQueue-metrics",
+            daemon=True,
+        ).start()
 
     def stop_server(self) -> None:
         """Stop accepting connections, close all server-side sockets, and
         join background threads. Idempotent. No data flushing is needed —
         every operation is already on disk."""
         self._shutdown.set()
+        self._sweep_wakeup.set()
+        loop, self._loop = self._loop, None
+        if loop is not None:
+            loop.wake()
 
         ssock, self._ssock = self._ssock, None
         _close_socket(ssock)
 
+        server, self._metrics_server = self._metrics_server, None
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
         with self._workers_lock:
             workers = list(self._workers)
             self._workers.clear()
@@ -937,6 +5346,56 @@ class MyQueue:
             if t is not current:
                 t.join(timeout=1.0)
 
+        # Stop the writer last: workers still finishing a request may have
+        # writes queued on it.
+        committers, self._committers = self._committers, []
+        for committer in committers:
+            committer.stop()
+        self._storage.close()
+
+    def metrics(self) -> dict[str, Any]:
+        """A snapshot of this server's instrumentation, as a dict.
+
+        Counters and latency histograms accumulate from construction;
+        ``queue_depth``, ``wal_bytes`` and ``connections`` are read now.
+        Each histogram is ``{"count", "sum", "buckets"}`` with ``buckets``
+        mapping upper bounds in seconds (``math.inf`` last) to cumulative
+        counts. The same data is served on ``metrics_port`` if set."""
+        m = self._metrics
+        requests = {
+            _OPCODE_NAMES.get(op, "0x%s" % op.hex()): hist.snapshot()
+            for op, hist in list(m.requests.items())
+        }
+        depths: dict[str, int] = {}
+        wal = 0
+        if self._db_path is not None:
+            depths = {q.name: self._table_size(q.name) for q in self._load_queues()}
+            for path in self._db_paths:
+                try:
+                    wal += os.path.getsize(path + "-wal")
+                except OSError:
+                    pass
+        with m._lock:
+            compacted, reaped = m.compacted_pages, dict(m.reaped)
+        backlog = dict(m.reap_backlog)
+        with self._workers_lock:
+            connections = len(self._workers)
+        return {
+            "requests": {op: hist["count"] for op, hist in requests.items()},
+            "request_seconds": requests,
+            "frame_read_seconds": m.frame_read.snapshot(),
+            "hmac_verify_seconds": m.hmac_verify.snapshot(),
+            "sqlite_lock_wait_seconds": m.lock_wait.snapshot(),
+            "sqlite_commit_seconds": m.commit.snapshot(),
+            "response_write_seconds": m.response_write.snapshot(),
+            "queue_depth": depths,
+            "wal_bytes": wal,
+            "compact_reclaimed_pages": compacted,
+            "ttl_reaped": reaped,
+            "ttl_reap_backlog": backlog,
+            "connections": connections,
+        }
+
     def install_signal_handlers(
         self,
         signals: tuple[int, ...] | None = None,
@@ -977,7 +5436,8 @@ class MyQueue:
         return self._shutdown.wait(timeout=timeout)
 
     def _connect_locked(self) -> socket.socket | None:
-        """Open a new client socket. Caller MUST hold self._csock_lock."""
+        """Open a new client socket. Touches no client state, so it needs
+        no lock; the new socket belongs to the caller."""
         sock: socket.socket | None = None
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -1005,95 +5465,496 @@ class MyQueue:
         Returns ``True`` if a connection is established, ``False`` otherwise
         (later calls will transparently retry the connect)."""
         with self._csock_lock:
-            if self._csock is not None:
-                _close_socket(self._csock)
-                self._csock = None
-            self._csock = self._connect_locked()
-            return self._csock is not None
+            self._drop_connection_locked()
+            return self._ensure_connected_locked() is not None
 
     def close(self) -> None:
-        """Close the client connection."""
+        """Close the client connection, and the pipelined one if open."""
         with self._csock_lock:
-            _close_socket(self._csock)
-            self._csock = None
+            self._drop_connection_locked()
+        with self._pipeline_lock:
+            if self._pipeline is not None:
+                self._pipeline.close()
+                self._pipeline = None
+            self._server_version = None
 
     def _ensure_connected_locked(self) -> socket.socket | None:
-        if self._csock is None:
-            self._csock = self._connect_locked()
-        return self._csock
+        if self._csock is not None:
+            return self._csock
+        # A fresh reader per connection: leftover bytes from a dropped
+        # connection must never be parsed as part of the new one.
+        reader = _FrameReader(self._mac)
+        version, mac = 1, self._mac
+        # With a key, negotiate protocol 3 for its session MAC; without
+        # one there is nothing to gain over protocol 1.
+        if self._secret_key is not None:
+            try:
+                connected = self._connect_hello(self._offer_version())
+            except ConnectionError as ex:
+                log.error("HELLO to %s:%d failed: %s", *self._addr, ex)
+                return None
+            if connected is None:
+                return None
+            sock, reader, version, mac = connected
+        else:
+            sock = self._connect_locked()
+            if sock is None:
+                return None
+        self._csock, self._creader, self._cmac = sock, reader, mac
+        self._crid = bytes(_U32.size) if version >= 2 else b""
+        return sock
 
     def _drop_connection_locked(self) -> None:
         _close_socket(self._csock)
         self._csock = None
+        self._creader = None
+        self._cmac = None
+        self._crid = b""
+
+    def _read_response_locked(
+        self, sock: socket.socket
+    ) -> tuple[bytes, memoryview] | None:
+        assert self._creader is not None
+        frame = self._creader.read(sock)
+        if frame is None or not self._crid:
+            return frame
+        opcode, body = frame
+        request_id, payload = _split_request_id(body)
+        if request_id != self._crid:
+            raise ValueError("response to unknown request %r" % request_id)
+        return opcode, payload
+
+    def _offer_version(self) -> int:
+        """Protocol version to offer in the next HELLO: the newest, unless
+        the server hung up on it within the last ``_RENEGOTIATE_SECONDS``."""
+        fallback = self._server_version
+        if fallback is None:
+            return _PROTOCOL_VERSION
+        version, until = fallback
+        if time.monotonic() >= until:
+            self._server_version = None
+            return _PROTOCOL_VERSION
+        return version
+
+    def _connect_hello(
+        self, offer: int
+    ) -> tuple[socket.socket, _FrameReader, int, _FrameMac | None] | None:
+        """Connect and negotiate at most protocol ``offer``, reconnecting
+        with the next older version each time the server hangs up on the
+        HELLO (protocol 1 has none). Returns ``(socket, reader, version,
+        MAC)``, or ``None`` if it cannot connect. Raises ``ConnectionError``
+        if the HELLO fails otherwise, or if ``require_session`` is set and
+        the server will not agree to protocol 3."""
+        newest = offer
+        while True:
+            sock = self._connect_locked()
+            if sock is None:
+                return None
+            reader = _FrameReader(self._mac)
+            agreed = self._hello(sock, reader, offer) if offer >= 2 else None
+            if agreed is not None or offer < 2 or self._require_session:
+                break
+            offer -= 1
+        version, mac = agreed or (1, self._mac)
+        if self._require_session and version < 3:
+            _close_socket(sock)
+            raise ConnectionError(
+                "server at %s:%d will not open a protocol-3 session and "
+                "require_session is set" % self._addr
+            )
+        if version == _PROTOCOL_VERSION:
+            self._server_version = None
+        elif version < newest:
+            until = time.monotonic() + _RENEGOTIATE_SECONDS
+            self._server_version = version, until
+        return sock, reader, version, mac
+
+    def _hello(
+        self, sock: socket.socket, reader: _FrameReader, version: int
+    ) -> tuple[int, _FrameMac | None] | None:
+        """Send a protocol-``version`` HELLO as the first frame on the fresh
+        connection ``sock`` and return ``(version, MAC of every later
+        frame)``, switching ``reader`` to that MAC. Returns ``None`` if the
+        server hung up on it, as servers predating that version do; ``sock``
+        is closed then. Raises ``ConnectionError`` on any other failure,
+        closing ``sock``."""
+        nonce = os.urandom(_NONCE_SIZE)
+        offer = bytes([version])
+        if version >= 3:
+            offer += nonce + self._session_macs
+        try:
+            _Frame.write(sock, _OP_HELLO, offer, self._mac)
+            frame = reader.read(sock)
+        except ConnectionResetError:
+            frame = None
+        except (OSError, ValueError) as ex:
+            _close_socket(sock)
+            raise ConnectionError(str(ex)) from ex
+        if frame is None:
+            _close_socket(sock)
+            return None
+        resp_opcode, payload = frame
+        if resp_opcode != _OP_ACK or len(payload) not in (1, 2 + _NONCE_SIZE):
+            _close_socket(sock)
+            raise ConnectionError("malformed HELLO response")
+        version = payload[0]
+        if version < 3:
+            return version, self._mac
+        mac_id = payload[-1]
+        if self._secret_key is None and mac_id == 0:
+            return version, None
+        if self._secret_key is None or mac_id not in self._session_macs:
+            _close_socket(sock)
+            raise ConnectionError(
+                "server and client disagree on frame authentication; "
+                "is secret_key set on both?"
+            )
+        session = _session_mac(
+            self._secret_key,
+            nonce,
+            bytes(payload[1 : 1 + _NONCE_SIZE]),
+            mac_id,
+            client=True,
+        )
+        reader.mac = session
+        return version, session
+
+    def _request_locked(
+        self, opcode: bytes, payload: bytes, extra_timeout: float = 0.0
+    ) -> tuple[bytes, memoryview]:
+        """Send one request frame and return the ``(opcode, payload)`` of
+        the response. Caller MUST hold self._csock_lock. Any socket or
+        framing failure drops the connection and raises
+        ``ConnectionError``.
+
+        ``extra_timeout`` lengthens the socket timeout for this one
+        request, for responses the server deliberately holds back."""
+        sock = self._ensure_connected_locked()
+        if sock is None:
+            raise ConnectionError("not connected")
+        try:
+            if extra_timeout:
+                sock.settimeout(self._timeout + extra_timeout)
+            _Frame.write(sock, opcode, payload, self._cmac, self._crid)
+            frame = self._read_response_locked(sock)
+            if extra_timeout:
+                sock.settimeout(self._timeout)
+        except (OSError, ValueError) as ex:
+            self._drop_connection_locked()
+            raise ConnectionError(str(ex)) from ex
+
+        if frame is None:
+            self._drop_connection_locked()
+            raise ConnectionError("server closed connection")
+        return frame
 
     def _get(self, opcode: bytes) -> Any:
         with self._csock_lock:
-            sock = self._ensure_connected_locked()
-            if sock is None:
-                raise ConnectionError("not connected")
-            try:
-                _Frame.write(sock, opcode, b"", self._secret_key)
-                frame = _Frame.read(sock, self._secret_key)
-            except (OSError, ValueError) as ex:
+            resp_opcode, payload = self._request_locked(opcode, b"")
+            return self._item_from_response_locked(resp_opcode, payload)
+
+    def _get_wait(self, opcode: bytes, timeout: float, prefix: bytes = b"") -> Any:
+        """Long-poll GET. Re-issues the wait if ``timeout`` is longer than
+        the server will park a single request. ``prefix`` goes in front of
+        the wait time (the queue name, for named queues)."""
+        if timeout < 0:
+            raise ValueError("timeout must be >= 0")
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = max(0.0, deadline - time.monotonic())
+            wait_ms = min(math.ceil(remaining * 1000), _MAX_WAIT_MS)
+            with self._csock_lock:
+                resp_opcode, payload = self._request_locked(
+                    opcode, prefix + _U32.pack(wait_ms), extra_timeout=wait_ms / 1000.0
+                )
+                if resp_opcode != _OP_EMPTY or time.monotonic() >= deadline:
+                    return self._item_from_response_locked(resp_opcode, payload)
+
+    def _item_from_response_locked(
+        self, resp_opcode: bytes, payload: memoryview
+    ) -> Any:
+        if resp_opcode not in (_OP_EMPTY, _OP_ITEM, _OP_ERROR):
+            self._drop_connection_locked()
+        return self._decode_item(resp_opcode, payload)
+
+    def _get_batch(
+        self, opcode: bytes, max_items: int, prefix: bytes = b""
+    ) -> list[Any]:
+        _check_batch_size(max_items)
+        with self._csock_lock:
+            resp_opcode, payload = self._request_locked(
+                opcode, prefix + _U32.pack(max_items)
+            )
+            if resp_opcode not in (_OP_EMPTY, _OP_ITEMS, _OP_ERROR):
                 self._drop_connection_locked()
-                raise ConnectionError(str(ex)) from ex
+            return self._decode_items(resp_opcode, payload)
+
+    def get_consumer(self, timeout: float | None = None) -> Any:
+        """Pop the next item from the consumer queue.
+
+        With ``timeout=None`` (the default) returns at once. Otherwise the
+        server waits up to ``timeout`` seconds for an item to be enqueued
+        and hands it over the moment it is committed.
+
+        Raises ``queue.Empty`` if the queue is (still) empty.
+        Raises ``ConnectionError`` on socket / protocol failure."""
+        if timeout is None:
+            return self._get(_OP_GET_CONSUMER)
+        return self._get_wait(_OP_WAIT_CONSUMER, timeout)
+
+    def get_producer(self, timeout: float | None = None) -> Any:
+        """Pop the next item from the producer queue.
+
+        With ``timeout=None`` (the default) returns at once. Otherwise the
+        server waits up to ``timeout`` seconds for an item to be enqueued
+        and hands it over the moment it is committed.
 
-            if frame is None:
+        Raises ``queue.Empty`` if the queue is (still) empty.
+        Raises ``ConnectionError`` on socket / protocol failure."""
+        if timeout is None:
+            return self._get(_OP_GET_PRODUCER)
+        return self._get_wait(_OP_WAIT_PRODUCER, timeout)
+
+    def ping(self) -> bool:
+        """Round-trip a no-op frame to the server, connecting first if
+        needed. Returns ``True`` if it answered; on failure the connection
+        is dropped (the next call reconnects) and ``False`` returned."""
+        with self._csock_lock:
+            try:
+                resp_opcode, _ = self._request_locked(_OP_PING, b"")
+            except ConnectionError as ex:
+                log.debug("Ping failed: %s", ex)
+                return False
+            if resp_opcode != _OP_ACK:
                 self._drop_connection_locked()
-                raise ConnectionError("server closed connection")
+                return False
+            return True
+
+    def _open_pipeline(self) -> _Pipeline | None:
+        """Return the live pipelined (protocol 2 or later) connection,
+        opening one (HELLO and all) if needed. Returns ``None`` if the
+        server only speaks protocol 1. Raises ``ConnectionError`` if it
+        cannot connect."""
+        with self._pipeline_lock:
+            if self._pipeline is not None and not self._pipeline.closed:
+                return self._pipeline
+            self._pipeline = None
+            offer = self._offer_version()
+            if offer < 2:
+                return None
+            connected = self._connect_hello(offer)
+            if connected is None:
+                raise ConnectionError("not connected")
+            sock, reader, version, mac = connected
+            if version < 2:
+                log.info(
+                    "Server at %s:%d speaks protocol %d; not pipelining",
+                    self._addr[0],
+                    self._addr[1],
+                    version,
+                )
+                _close_socket(sock)
+                return None
+            self._pipeline = _Pipeline(sock, reader, mac)
+            return self._pipeline
 
-            resp_opcode, payload = frame
-            if resp_opcode == _OP_EMPTY:
-                raise Empty()
-            if resp_opcode == _OP_ITEM:
-                try:
-                    return _deserialize(payload)
-                except ValueError as ex:
-                    raise ConnectionError(str(ex)) from ex
-            self._drop_connection_locked()
-            raise ConnectionError("unexpected response opcode 0x%02x" % resp_opcode[0])
+    def _submit(
+        self,
+        opcode: bytes,
+        payload: bytes,
+        convert: Callable[[bytes, bytes], Any],
+        fallback: Callable[[], Any],
+    ) -> Future[Any]:
+        """Pipeline one request; the returned future resolves to
+        ``convert(resp_opcode, resp_payload)``. Against a protocol-1 server
+        ``fallback`` runs synchronously instead."""
+        pipeline = self._open_pipeline()
+        if pipeline is None:
+            future: Future[Any] = Future()
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(fallback())
+            except Exception as ex:
+                future.set_exception(ex)
+            return future
+        return _chain_future(
+            pipeline.submit(opcode, payload), lambda response: convert(*response)
+        )
 
-    def get_consumer(self) -> Any:
-        """Pop the next item from the consumer queue.
+    def get_consumer_async(self) -> Future[Any]:
+        """Pipelined ``get_consumer()``: send the request and return a
+        ``Future`` for the item at once. The future raises ``queue.Empty``
+        or ``ConnectionError`` where ``get_consumer()`` would.
+
+        Raises ``ConnectionError`` right away if it cannot connect."""
+        return self._submit(_OP_GET_CONSUMER, b"", self._decode_item, self.get_consumer)
+
+    def get_producer_async(self) -> Future[Any]:
+        """Pipelined ``get_producer()``; see ``get_consumer_async()``."""
+        return self._submit(_OP_GET_PRODUCER, b"", self._decode_item, self.get_producer)
+
+    def get_consumer_batch_async(self, max_items: int) -> Future[list[Any]]:
+        """Pipelined ``get_consumer_batch()``; see ``get_consumer_async()``."""
+        _check_batch_size(max_items)
+        return self._submit(
+            _OP_GET_CONSUMER_BATCH,
+            _U32.pack(max_items),
+            self._decode_items,
+            lambda: self.get_consumer_batch(max_items),
+        )
+
+    def get_producer_batch_async(self, max_items: int) -> Future[list[Any]]:
+        """Pipelined ``get_producer_batch()``; see ``get_consumer_async()``."""
+        _check_batch_size(max_items)
+        return self._submit(
+            _OP_GET_PRODUCER_BATCH,
+            _U32.pack(max_items),
+            self._decode_items,
+            lambda: self.get_producer_batch(max_items),
+        )
+
+    def send_to_producer_async(self, blob: Any) -> Future[bool]:
+        """Pipelined ``send_to_producer()``: send `blob` and return a
+        ``Future`` that resolves to ``True`` once the server's ACK arrives.
+
+        Unlike ``send_to_producer`` this is not retried: if the future
+        raises ``ConnectionError`` the message may or may not have been
+        stored, and it is up to the caller to send it again. If it raises
+        ``QueueFull``, the message was not stored.
+
+        Raises ``TypeError`` immediately if the codec cannot encode `blob`
+        and ``ConnectionError`` right away if it cannot connect."""
+        payload = self._encode(blob)
+
+        def check_ack(resp_opcode: bytes, ack: bytes) -> bool:
+            if resp_opcode == _OP_NACK:
+                raise _nacked(ack)
+            if resp_opcode != _OP_ACK:
+                raise ConnectionError(
+                    "unexpected response opcode 0x%02x" % resp_opcode[0]
+                )
+            return True
+
+        return self._submit(
+            _OP_PUT_PRODUCER,
+            payload,
+            check_ack,
+            lambda: self._put_with_retry(_OP_PUT_PRODUCER, payload, b""),
+        )
+
+    def get_consumer_batch(self, max_items: int) -> list[Any]:
+        """Pop up to ``max_items`` items from the consumer queue in one
+        round trip. Returns a non-empty list, oldest first.
 
         Raises ``queue.Empty`` if the queue is empty.
         Raises ``ConnectionError`` on socket / protocol failure."""
-        return self._get(_OP_GET_CONSUMER)
+        return self._get_batch(_OP_GET_CONSUMER_BATCH, max_items)
 
-    def get_producer(self) -> Any:
-        """Pop the next item from the producer queue.
+    def get_producer_batch(self, max_items: int) -> list[Any]:
+        """Pop up to ``max_items`` items from the producer queue in one
+        round trip. Returns a non-empty list, oldest first.
 
         Raises ``queue.Empty`` if the queue is empty.
         Raises ``ConnectionError`` on socket / protocol failure."""
-        return self._get(_OP_GET_PRODUCER)
+        return self._get_batch(_OP_GET_PRODUCER_BATCH, max_items)
 
-    def send_to_producer(self, blob: Any) -> bool:
+    def send_to_producer(
+        self, blob: Any, priority: int = 0, delay_seconds: float = 0.0
+    ) -> bool:
         """Send `blob` to the producer queue and wait for the server's ACK.
-        Retries up to 3 times with random back-off, then drops the message.
+        Retries up to 3 times with exponential back-off, then drops the
+        message. A queue that is full and refuses PUTs (see Backpressure)
+        is retried for up to ``timeout`` seconds, backing off from the
+        server's retry-after hint with every refusal.
         Returns ``True`` on success, ``False`` if the message was dropped.
+        Items with a higher ``priority`` are delivered before lower ones;
+        with ``delay_seconds`` the item is delivered only once that many
+        seconds have passed.
 
         Delivery is at-least-once: if the ACK is lost after the server
         committed the row, the retry stores a second copy.
 
-        Raises ``TypeError`` immediately if `blob` is not JSON-serializable."""
-        payload = _serialize(blob)
+        Raises ``TypeError`` immediately if the codec cannot encode `blob`,
+        ``ValueError`` if ``priority`` is not a 32-bit signed integer or
+        ``delay_seconds`` is out of range."""
+        if priority or delay_seconds:
+            return self.send("producer", blob, priority, delay_seconds)
+        return self._put_with_retry(_OP_PUT_PRODUCER, self._encode(blob), b"")
+
+    def send_to_producer_many(
+        self, blobs: list[Any], priority: int = 0, delay_seconds: float = 0.0
+    ) -> bool:
+        """Send every item in `blobs` to the producer queue using batch PUT
+        frames: one frame, one server-side commit and one ACK per batch.
+        Blobs are split into as few batches as fit under the frame size
+        limit. Each batch is retried like ``send_to_producer``.
+
+        Returns ``True`` once every batch is acknowledged, ``False`` as
+        soon as one is dropped; batches acknowledged before that point
+        stay stored.
+
+        Raises ``TypeError`` before sending anything if the codec cannot
+        encode every blob, ``ValueError`` like ``send_to_producer()``."""
+        if priority or delay_seconds:
+            return self.send_many("producer", blobs, priority, delay_seconds)
+        return self._send_many(_OP_PUT_PRODUCER_BATCH, b"", blobs)
+
+    def _send_many(self, opcode: bytes, prefix: bytes, blobs: list[Any]) -> bool:
+        payloads = [self._encode(blob) for blob in blobs]
+        batch: list[bytes] = []
+        size = 0
+        for payload in payloads:
+            need = _U32.size + len(payload)
+            if batch and size + need > _BATCH_BUDGET:
+                if not self._put_batch(opcode, prefix, batch):
+                    return False
+                batch, size = [], 0
+            batch.append(payload)
+            size += need
+        if batch:
+            return self._put_batch(opcode, prefix, batch)
+        return True
+
+    def _put_batch(self, opcode: bytes, prefix: bytes, payloads: list[bytes]) -> bool:
+        return self._put_with_retry(
+            opcode, prefix + _pack_items(payloads), _U32.pack(len(payloads))
+        )
 
+    def _put_with_retry(self, opcode: bytes, payload: bytes, expect_ack: bytes) -> bool:
+        """Send one PUT frame and wait for an ``_OP_ACK`` whose payload is
+        ``expect_ack``. Retries up to 3 times with exponential back-off.
+        A NACK from a full queue is not a failure: the PUT is sent again
+        after backing off from the server's hint, for up to ``timeout``
+        seconds. Raises ``ValueError`` at once if the server refuses the
+        request."""
         attempts = 3
-        for attempt in range(1, attempts + 1):
+        attempt = 1
+        refused: ValueError | None = None
+        nacks = 0
+        deadline = time.monotonic() + self._timeout
+        while True:
+            full: QueueFull | None = None
             with self._csock_lock:
                 sock = self._ensure_connected_locked()
                 if sock is not None:
                     try:
-                        _Frame.write(sock, _OP_PUT_PRODUCER, payload, self._secret_key)
-                        frame = _Frame.read(sock, self._secret_key)
+                        _Frame.write(sock, opcode, payload, self._cmac, self._crid)
+                        frame = self._read_response_locked(sock)
                         if frame is None:
                             raise ConnectionError("server closed connection before ACK")
-                        resp_opcode, _ = frame
-                        if resp_opcode != _OP_ACK:
+                        resp_opcode, ack = frame
+                        if resp_opcode == _OP_ERROR:
+                            refused = _refused(ack)
+                        elif resp_opcode == _OP_NACK:
+                            full = _nacked(ack)
+                        elif resp_opcode != _OP_ACK:
                             raise ConnectionError(
                                 "unexpected response opcode 0x%02x" % resp_opcode[0]
                             )
-                        return True
+                        elif ack != expect_ack:
+                            raise ConnectionError("ACK does not cover the whole batch")
+                        else:
+                            return True
                     except Exception as ex:
                         log.warning(
                             "Send failed (attempt %d/%d): %s",
@@ -1102,21 +5963,350 @@ class MyQueue:
                             ex,
                         )
                         self._drop_connection_locked()
-            if attempt < attempts:
-                sleep(random() * 2)
+            if refused is not None:
+                # Turned down rather than lost; retrying cannot help.
+                raise refused
+            if full is not None:
+                nacks += 1
+                remaining = deadline - time.monotonic()
+                if remaining < full.retry_after:
+                    log.error("Dropping message: %s for %d NACKs in a row", full, nacks)
+                    return False
+                sleep(min(_backoff(nacks, full.retry_after), remaining))
+                continue
+            if attempt == attempts:
+                break
+            sleep(_backoff(attempt, _RETRY_BASE_SECONDS))
+            attempt += 1
 
         log.error("Dropping message after %d failed send attempts", attempts)
         return False
 
-    def send_to_consumer(self, blob: Any) -> None:
+    def send_to_consumer(
+        self, blob: Any, priority: int = 0, delay_seconds: float = 0.0
+    ) -> None:
         """Push `blob` into the consumer queue (server side, direct DB
-        write). Requires ``db_path`` to be set.
-
-        Raises ``TypeError`` if `blob` is not JSON-serializable."""
+        write). Requires ``db_path`` to be set. ``priority`` and
+        ``delay_seconds`` work as in ``send_to_producer()``; a delayed item
+        becomes visible once the running server's maintenance thread sees
+        it is due. If the consumer queue is full and its overflow policy is
+        ``"block"``, waits for room like a PUT over the wire.
+
+        Raises ``TypeError`` if the codec cannot encode `blob`,
+        ``ValueError`` like ``send_to_producer()``, and ``QueueFull`` if
+        the queue is full and refuses it."""
         if self._db_path is None:
             raise RuntimeError("send_to_consumer requires db_path to be set")
-        payload = _serialize(blob)
-        self._enqueue("consumer", payload)
+        _put_options("consumer", priority, delay_seconds)  # validates them
+        payload = self._encode(blob)
+
+        def put() -> tuple[bytes, bytes]:
+            self._enqueue("consumer", payload, priority, delay_seconds)
+            return _OP_ACK, b""
+
+        response = self._until_room(self._queue("consumer"), put)
+        assert isinstance(response, tuple)
+        if response[0] == _OP_NACK:
+            raise _nacked(response[1])
+
+    # ------------------------------------------------------------------ #
+    # Named queues                                                       #
+    # ------------------------------------------------------------------ #
+
+    def get(self, queue: str, timeout: float | None = None) -> Any:
+        """Pop the next item from the named queue ``queue``, waiting up to
+        ``timeout`` seconds like ``get_consumer()``.
+
+        Raises ``queue.Empty`` if the queue is (still) empty, ``ValueError``
+        if there is no such queue, ``ConnectionError`` on socket / protocol
+        failure."""
+        return self._get_wait(
+            _OP_QGET, 0.0 if timeout is None else timeout, _pack_queue_name(queue)
+        )
+
+    def get_batch(self, queue: str, max_items: int) -> list[Any]:
+        """Pop up to ``max_items`` items from ``queue`` in one round trip.
+        Raises like ``get()``."""
+        return self._get_batch(_OP_QGET_BATCH, max_items, _pack_queue_name(queue))
+
+    def send(
+        self, queue: str, blob: Any, priority: int = 0, delay_seconds: float = 0.0
+    ) -> bool:
+        """Send `blob` to the named queue ``queue`` and wait for the ACK,
+        retrying like ``send_to_producer()``, whose ``priority`` and
+        ``delay_seconds`` it shares.
+
+        Raises ``ValueError`` if there is no such queue or an option is out
+        of range, and ``TypeError`` if the codec cannot encode `blob`."""
+        if priority or delay_seconds:
+            prefix = _put_options(queue, priority, delay_seconds)
+            return self._put_batch(_OP_QPUT_OPTIONS, prefix, [self._encode(blob)])
+        return self._put_with_retry(
+            _OP_QPUT, _pack_queue_name(queue) + self._encode(blob), b""
+        )
+
+    def send_many(
+        self,
+        queue: str,
+        blobs: list[Any],
+        priority: int = 0,
+        delay_seconds: float = 0.0,
+    ) -> bool:
+        """Send every item in `blobs` to ``queue`` in as few batch PUTs as
+        fit, like ``send_to_producer_many()``. Raises like ``send()``."""
+        if priority or delay_seconds:
+            prefix = _put_options(queue, priority, delay_seconds)
+            return self._send_many(_OP_QPUT_OPTIONS, prefix, blobs)
+        return self._send_many(_OP_QPUT_BATCH, _pack_queue_name(queue), blobs)
+
+    def lease(
+        self, queue: str, max_items: int = 1, lease_seconds: float = 30.0
+    ) -> list[tuple[bytes, Any]]:
+        """Lease up to ``max_items`` of the oldest items of ``queue`` (a
+        named or built-in queue) for ``lease_seconds``. Returns a non-empty
+        list of ``(receipt, item)`` pairs, oldest first.
+
+        Leased items stay on the server, hidden from other consumers, until
+        ``ack()`` is called with their receipts. Items not acknowledged
+        before their lease runs out are delivered again.
+
+        Raises ``queue.Empty`` if no item is available, ``ValueError`` if
+        there is no such queue or an argument is out of range,
+        ``ConnectionError`` on socket / protocol failure."""
+        _check_batch_size(max_items)
+        payload = (
+            _pack_queue_name(queue)
+            + _U32.pack(max_items)
+            + _U32.pack(_lease_ms(lease_seconds))
+        )
+        with self._csock_lock:
+            resp_opcode, resp = self._request_locked(_OP_QLEASE, payload)
+            if resp_opcode not in (_OP_EMPTY, _OP_ITEMS, _OP_ERROR):
+                self._drop_connection_locked()
+            if resp_opcode != _OP_ITEMS:
+                self._decode_items(resp_opcode, resp)  # raises
+            try:
+                return [
+                    (
+                        bytes(record[: _RECEIPT.size]),
+                        self._deserialize(record[_RECEIPT.size :]),
+                    )
+                    for record in _unpack_items(resp)
+                ]
+            except ValueError as ex:
+                raise ConnectionError(str(ex)) from ex
+
+    def ack(self, queue: str, receipts: list[bytes]) -> int:
+        """Delete leased items of ``queue`` by the receipts ``lease()``
+        returned with them. Returns how many were deleted; a receipt whose
+        lease ran out and whose item was leased again deletes nothing.
+
+        Raises ``ValueError`` for a malformed receipt or an unknown queue,
+        ``ConnectionError`` on socket / protocol failure."""
+        receipts = [bytes(r) for r in receipts]
+        if any(len(r) != _RECEIPT.size for r in receipts):
+            raise ValueError("receipts must be %d bytes each" % _RECEIPT.size)
+        if not receipts:
+            return 0
+        with self._csock_lock:
+            resp_opcode, resp = self._request_locked(
+                _OP_QACK, _pack_queue_name(queue) + b"".join(receipts)
+            )
+            if resp_opcode == _OP_ERROR:
+                raise _refused(resp)
+            if resp_opcode != _OP_ACK or len(resp) != _U32.size:
+                self._drop_connection_locked()
+                raise ConnectionError("unexpected response to lease ACK")
+            (deleted,) = _U32.unpack(resp)
+            return deleted
+
+    def send_stream(self, queue: str, data: BinaryIO, size: int | None = None) -> bool:
+        """Send the next ``size`` bytes of the binary file object ``data``
+        to ``queue`` as one message, without holding it in memory: it goes
+        out ``_STREAM_CHUNK`` bytes at a time and the server writes each
+        chunk straight into the message's row. Without ``size``, ``data``
+        must be seekable and is sent up to its end. The message is stored
+        as ``raw`` bytes whatever the client's codec, and consumers see it
+        only once all of it has arrived, in the place in the queue it took
+        when the upload began.
+
+        Other requests on this client may run between the chunks. A failed
+        upload is not retried; what the server already holds of it is
+        deleted once it has sat idle for ``_STREAM_IDLE_SECONDS``.
+
+        Returns True once the server has published the message. Raises
+        ``QueueFull`` if the queue is full and refuses PUTs, ``ValueError``
+        if there is no such queue, the queue's storage cannot stream, the
+        message is too big for SQLite or ``data`` ends early, and
+        ``ConnectionError`` on socket / protocol failure."""
+        if size is None:
+            if not data.seekable():
+                raise ValueError("size is required for an unseekable stream")
+            start = data.tell()
+            size = data.seek(0, io.SEEK_END) - start
+            data.seek(start)
+        if size < 0:
+            raise ValueError("size must be >= 0, got %r" % (size,))
+        prefix = _pack_queue_name(queue)
+        resp = self._stream_request(_OP_QSTREAM_PUT, prefix + _U64.pack(size))
+        if len(resp) != _U64.size:
+            raise ConnectionError("unexpected response to stream PUT")
+        stream_id = bytes(resp)
+        offset = 0
+        while offset < size:
+            chunk = data.read(min(_STREAM_CHUNK, size - offset))
+            if not chunk:
+                raise ValueError("stream ended after %d of %d bytes" % (offset, size))
+            self._stream_request(
+                _OP_QSTREAM_WRITE, prefix + stream_id + _U64.pack(offset) + chunk
+            )
+            offset += len(chunk)
+        self._stream_request(_OP_QSTREAM_END, prefix + stream_id)
+        return True
+
+    def open_stream(self, queue: str, lease_seconds: float = 30.0) -> MessageStream:
+        """Lease the oldest item of ``queue`` like ``lease()``, but return a
+        ``MessageStream`` that reads it from the server a chunk at a time
+        instead of the item itself. The item must have been sent as raw
+        bytes: with ``send_stream()``, or ``send()`` under the ``raw``
+        codec. Read it before the lease runs out, then ``ack()`` it.
+
+        Raises ``queue.Empty`` if no item is available, ``ValueError`` if
+        there is no such queue, an argument is out of range or the oldest
+        item is not raw bytes (it stays in the queue), ``ConnectionError``
+        on socket / protocol failure."""
+        payload = _pack_queue_name(queue) + _U32.pack(_lease_ms(lease_seconds))
+        resp = self._stream_request(_OP_QSTREAM_OPEN, payload)
+        if resp is None:
+            raise Empty()
+        if len(resp) != _RECEIPT.size + _U64.size:
+            raise ConnectionError("unexpected response to stream OPEN")
+        (size,) = _U64.unpack_from(resp, _RECEIPT.size)
+        return MessageStream(self, queue, bytes(resp[: _RECEIPT.size]), size)
+
+    def _read_stream(
+        self, queue: str, receipt: bytes, offset: int, buffer: memoryview
+    ) -> int:
+        """Read bytes of the message leased under ``receipt`` from
+        ``offset`` into ``buffer`` (at most ``_STREAM_CHUNK``). Returns how
+        many were read; 0 at the end of the message."""
+        payload = _pack_queue_name(queue) + _STREAM_READ.pack(
+            *_RECEIPT.unpack(receipt), offset, len(buffer)
+        )
+        with self._csock_lock:
+            resp = self._stream_request_locked(_OP_QSTREAM_READ, payload)
+            if resp is None or len(resp) > len(buffer):
+                self._drop_connection_locked()
+                raise ConnectionError("unexpected response to stream READ")
+            buffer[: len(resp)] = resp
+            return len(resp)
+
+    def _stream_request(self, opcode: bytes, payload: bytes) -> bytes | None:
+        with self._csock_lock:
+            resp = self._stream_request_locked(opcode, payload)
+            return None if resp is None else bytes(resp)
+
+    def _stream_request_locked(
+        self, opcode: bytes, payload: bytes
+    ) -> memoryview | None:
+        """Send one stream request and return the payload of its ACK or
+        ITEM response, or ``None`` for EMPTY. Caller MUST hold
+        self._csock_lock. Raises ``ValueError`` if the server refused the
+        request."""
+        resp_opcode, resp = self._request_locked(opcode, payload)
+        if resp_opcode == _OP_ERROR:
+            raise _refused(resp)
+        if resp_opcode == _OP_NACK:
+            raise _nacked(resp)
+        if resp_opcode == _OP_EMPTY and opcode == _OP_QSTREAM_OPEN:
+            return None
+        if resp_opcode not in (_OP_ACK, _OP_ITEM):
+            self._drop_connection_locked()
+            raise ConnectionError("unexpected response to %s" % _OPCODE_NAMES[opcode])
+        return resp
+
+    def declare_queue(
+        self,
+        name: str,
+        *,
+        max_queue_size: int = 10_000,
+        ttl_seconds: float | None = None,
+        overflow: str = "drop_oldest",
+    ) -> None:
+        """Create the named queue ``name``, or change its settings if it
+        already exists. ``overflow`` is what a PUT to the queue does once
+        it is full (see Backpressure). Server side only; the declaration is
+        stored in the DB and survives restarts.
+
+        Raises ``ValueError`` for an invalid name or setting, or for the
+        built-in ``consumer`` / ``producer`` queues, which take their
+        settings from the constructor."""
+        if self._db_path is None:
+            raise RuntimeError("declare_queue requires db_path to be set")
+        if name in _TABLES:
+            raise ValueError("%r is a built-in queue" % name)
+        table = _queue_table(name)
+        if (
+            isinstance(max_queue_size, bool)
+            or not isinstance(max_queue_size, int)
+            or max_queue_size < 1
+        ):
+            raise ValueError("max_queue_size must be an integer >= 1")
+        if ttl_seconds is not None and ttl_seconds <= 0:
+            raise ValueError("ttl_seconds must be > 0 or None")
+        _check_overflow(overflow)
+        # Every shard records the queue; shard 0, whose registry is the one
+        # read, goes last so the queue only appears once it exists everywhere.
+        for shard in reversed(range(self._shards)):
+            with self._db_txn(shard) as conn:
+                self._create_queue_table(conn, table, reseed=False)
+                conn.execute(
+                    "INSERT OR REPLACE INTO queues "
+                    "(name, max_queue_size, ttl_seconds, overflow) VALUES (?, ?, ?, ?)",
+                    (name, max_queue_size, ttl_seconds, overflow),
+                )
+        config = _QueueConfig(name, max_queue_size, ttl_seconds, overflow)
+        self._storage.revive(config)
+        with self._queues_lock:
+            self._queues[name] = config
+            self._sweep_queues = None
+
+    def drop_queue(self, name: str) -> None:
+        """Delete the named queue ``name`` and everything in it. Server side
+        only. Clients still using it get ``ValueError`` from then on.
+
+        Raises ``ValueError`` if there is no such queue or it is built in."""
+        if name in _TABLES:
+            raise ValueError("%r is a built-in queue" % name)
+        self._queue(name)  # registers a queue another process declared
+        # Marked dropped first, under the registry lock that _queue() takes
+        # to register a queue: from here on no new request gets this queue,
+        # and one already in flight reports ValueError when the table goes.
+        with self._queues_lock:
+            config = self._queues.pop(name, None)
+            if config is None:
+                raise ValueError("unknown queue: %r" % (name,))
+            config.dropped = True
+            self._sweep_queues = None
+            table = config.table
+            for shard in range(self._shards):
+                with self._db_txn(shard) as conn:
+                    # Dropping the table drops its index and triggers too.
+                    conn.execute(f"DROP TABLE IF EXISTS {table}")
+                    conn.execute("DELETE FROM queue_depth WHERE name = ?", (table,))
+                    conn.execute("DELETE FROM queues WHERE name = ?", (name,))
+        self._storage.drop(config)
+        # Waiting GETs and PUTs wake up to find the queue gone.
+        self._notifier.notify(name)
+        self._made_room(config)
+
+    def queue_names(self) -> list[str]:
+        """Names of every queue, built-ins first. Server side only."""
+        return [config.name for config in self._load_queues()]
+
+    def queue_size(self, name: str) -> int:
+        """Number of items in queue ``name``. Server side only."""
+        return self._table_size(name)
 
     # ------------------------------------------------------------------ #
     # Introspection (server side)                                        #
@@ -1124,9 +6314,8 @@ class MyQueue:
 
     def clear_queues(self) -> None:
         """Clear both queues. Server side only."""
-        with self._db_txn() as conn:
-            for table in _TABLES:
-                conn.execute(f"DELETE FROM {table}")
+        for queue in _TABLES:
+            self._table_clear(queue)
 
     def consumer_size(self) -> int:
         return self._table_size("consumer")
@@ -1140,13 +6329,57 @@ class MyQueue:
     def producer_empty(self) -> bool:
         return self._table_empty("producer")
 
+    def build_zdict(self, size: int = 4096, sample_rows: int = 1000) -> bytes:
+        """Build a preset dictionary of at most ``size`` bytes for the
+        ``json`` codec from the newest ``sample_rows`` JSON messages of
+        each queue (the oldest, with ``storage="segments"``). Server side
+        only.
+
+        zlib has no dictionary trainer, so this keeps the JSON strings
+        (keys with their colon) and literals that turn up in the most
+        messages, weighted by length, and places the most valuable last:
+        zlib codes matches against the end of the dictionary most
+        cheaply. Pass the result as ``zdict=`` to every client.
+
+        Raises ``ValueError`` if there are no JSON messages to learn from."""
+        if not 1 <= size <= _ZDICT_MAX_BYTES:
+            raise ValueError("size must be between 1 and %d" % _ZDICT_MAX_BYTES)
+        if sample_rows < 1:
+            raise ValueError("sample_rows must be >= 1")
+        json_tags = _CODECS["json"].tags
+        counts: Counter[str] = Counter()
+        for queue in _TABLES:
+            for payload in self._storage.sample(self._queue(queue), sample_rows):
+                if not payload or payload[0] not in json_tags:
+                    continue
+                try:
+                    text = _json_text(self._deserialize(payload)).decode("utf-8")
+                except ValueError:
+                    continue  # e.g. compressed with a dictionary we lack
+                counts.update(set(_ZDICT_TOKEN.findall(text)))
+        if not counts:
+            raise ValueError("no JSON messages to build a dictionary from")
+        # Tokens seen only once are noise, unless that is all there is.
+        tokens = [token for token, n in counts.items() if n > 1] or list(counts)
+        ranked = sorted(
+            tokens, key=lambda token: counts[token] * len(token), reverse=True
+        )
+        picked: list[bytes] = []
+        used = 0
+        for token in ranked:
+            data = token.encode("utf-8")
+            if used + len(data) <= size:
+                picked.append(data)
+                used += len(data)
+        return b"".join(reversed(picked))
+
     def peek_consumer(self) -> Any:
         """Return the next consumer item without removing it. Server side only.
         Raises ``queue.Empty`` if empty."""
         payload = self._table_peek("consumer")
         if payload is None:
             raise Empty()
-        return _deserialize(payload)
+        return self._deserialize(payload)
 
     def peek_producer(self) -> Any:
         """Return the next producer item without removing it. Server side only.
@@ -1154,13 +6387,288 @@ class MyQueue:
         payload = self._table_peek("producer")
         if payload is None:
             raise Empty()
-        return _deserialize(payload)
+        return self._deserialize(payload)
 
     def __repr__(self) -> str:
         host, port = self._addr
-        return "MyQueue(host=%r, port=%d, db_path=%r, secret_key=%s)" % (
+        return "MyQueue(host=%r, port=%d, db_path=%r, secret_key=%s, codec=%r)" % (
             host,
             port,
             self._db_path,
             "<set>" if self._secret_key else "None",
+            self._codec.name,
+        )
+
+
+# --------------------------------------------------------------------------- #
+# MessageStream                                                               #
+# --------------------------------------------------------------------------- #
+
+
+class MessageStream(io.RawIOBase):
+    """A leased message read from the server a chunk at a time, as returned
+    by ``MyQueue.open_stream()``. A readable, seekable binary file object:
+    wrap it in ``io.BufferedReader`` for small reads, or copy it out with
+    ``shutil.copyfileobj``. Each read of up to ``_STREAM_CHUNK`` bytes is
+    one request on the client that opened it.
+
+    ``ack()`` deletes the message once it has been handled. Used as a
+    context manager, the stream acknowledges its message when the ``with``
+    block ends without an exception; otherwise the message is delivered
+    again once its lease runs out."""
+
+    def __init__(self, client: MyQueue, queue: str, receipt: bytes, size: int) -> None:
+        # Called once on close(); MyQueuePool returns the client with it.
+        self._release: Callable[[], Any] | None = None
+        super().__init__()
+        self.queue = queue
+        self.receipt = receipt  # as lease() returns it, for ack()
+        self.size = size
+        self._client = client
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        self._checkClosed()
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self._checkClosed()
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        elif whence != io.SEEK_SET:
+            raise ValueError("invalid whence %r" % (whence,))
+        if offset < 0:
+            raise ValueError("negative seek position %d" % offset)
+        self._pos = offset
+        return offset
+
+    def readinto(self, buffer: Any) -> int:
+        self._checkClosed()
+        with memoryview(buffer) as view:
+            n = min(len(view), self.size - self._pos, _STREAM_CHUNK)
+            if n <= 0:
+                return 0
+            n = self._client._read_stream(
+                self.queue, self.receipt, self._pos, view.cast("B")[:n]
+            )
+        self._pos += n
+        return n
+
+    def readall(self) -> bytes:
+        # RawIOBase.readall() would read DEFAULT_BUFFER_SIZE at a time, one
+        # round trip each.
+        out = bytearray(max(0, self.size - self._pos))
+        with memoryview(out) as view:
+            got = 0
+            while got < len(out):
+                n = self.readinto(view[got:])
+                if not n:
+                    break
+                got += n
+        del out[got:]
+        return bytes(out)
+
+    def ack(self) -> bool:
+        """Delete the message. Returns False if it was already deleted, or
+        delivered again after its lease ran out."""
+        return self._client.ack(self.queue, [self.receipt]) == 1
+
+    def close(self) -> None:
+        release, self._release = self._release, None
+        try:
+            super().close()
+        finally:
+            if release is not None:
+                release()
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> None:
+        try:
+            if exc_type is None and not self.closed:
+                self.ack()
+        finally:
+            self.close()
+
+    def __repr__(self) -> str:
+        return "MessageStream(queue=%r, size=%d)" % (self.queue, self.size)
+
+
+# --------------------------------------------------------------------------- #
+# MyQueuePool                                                                 #
+# --------------------------------------------------------------------------- #
+
+
+class MyQueuePool:
+    """A fixed-size pool of ``MyQueue`` client connections.
+
+    A single ``MyQueue`` client serializes every thread onto one socket,
+    so a multi-threaded producer has at most one request in flight. The
+    pool keeps ``size`` independently authenticated connections and
+    lends one out per call; throughput then scales with ``size`` until
+    the server is the bottleneck.
+
+    Connections are opened lazily and reused most-recently-used first. A
+    connection that has sat idle for ``health_check_interval`` seconds is
+    pinged before being lent out, and one that fails (either the ping or
+    a real request) is dropped and reconnected on next use, exactly like
+    a plain ``MyQueue`` client."""
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 49152,
+        *,
+        size: int = 4,
+        secret_key: bytes | None = None,
+        timeout: float = 75.0,
+        health_check_interval: float = 30.0,
+        codec: str = "json",
+        zdict: bytes | None = None,
+    ) -> None:
+        if isinstance(size, bool) or not isinstance(size, int) or size < 1:
+            raise ValueError("size must be an integer >= 1, got %r" % (size,))
+        if health_check_interval < 0:
+            raise ValueError("health_check_interval must be >= 0")
+        self._addr: tuple[str, int] = (host, port)
+        self._timeout: float = timeout
+        self._health_check_interval: float = health_check_interval
+        self._closed = False
+        # (client, monotonic time it was last returned to the pool)
+        self._idle: LifoQueue[tuple[MyQueue, float]] = LifoQueue()
+        self._clients: list[MyQueue] = []
+        for _ in range(size):
+            client = MyQueue(
+                host,
+                port,
+                secret_key=secret_key,
+                timeout=timeout,
+                codec=codec,
+                zdict=zdict,
+            )
+            self._clients.append(client)
+            self._idle.put((client, time.monotonic()))
+
+    @contextmanager
+    def connection(self) -> Iterator[MyQueue]:
+        """Check a client out for the duration of the ``with`` block. Raises
+        ``ConnectionError`` if none frees up within ``timeout`` seconds."""
+        if self._closed:
+            raise ConnectionError("pool is closed")
+        try:
+            client, last_used = self._idle.get(timeout=self._timeout)
+        except Empty:
+            raise ConnectionError("no pooled connection available") from None
+        try:
+            if (
+                client._csock is not None
+                and time.monotonic() - last_used >= self._health_check_interval
+                and not client.ping()
+            ):
+                log.info("Pooled connection failed health check; reconnecting")
+            yield client
+        finally:
+            if self._closed:
+                client.close()
+            self._idle.put((client, time.monotonic()))
+
+    def close(self) -> None:
+        """Close every pooled connection. Clients checked out at the time
+        are closed as they are returned."""
+        self._closed = True
+        for client in self._clients:
+            client.close()
+
+    def ping(self) -> bool:
+        with self.connection() as client:
+            return client.ping()
+
+    def get_consumer(self, timeout: float | None = None) -> Any:
+        with self.connection() as client:
+            return client.get_consumer(timeout)
+
+    def get_producer(self, timeout: float | None = None) -> Any:
+        with self.connection() as client:
+            return client.get_producer(timeout)
+
+    def get_consumer_batch(self, max_items: int) -> list[Any]:
+        with self.connection() as client:
+            return client.get_consumer_batch(max_items)
+
+    def get_producer_batch(self, max_items: int) -> list[Any]:
+        with self.connection() as client:
+            return client.get_producer_batch(max_items)
+
+    def send_to_producer(
+        self, blob: Any, priority: int = 0, delay_seconds: float = 0.0
+    ) -> bool:
+        with self.connection() as client:
+            return client.send_to_producer(blob, priority, delay_seconds)
+
+    def send_to_producer_many(
+        self, blobs: list[Any], priority: int = 0, delay_seconds: float = 0.0
+    ) -> bool:
+        with self.connection() as client:
+            return client.send_to_producer_many(blobs, priority, delay_seconds)
+
+    def get(self, queue: str, timeout: float | None = None) -> Any:
+        with self.connection() as client:
+            return client.get(queue, timeout)
+
+    def get_batch(self, queue: str, max_items: int) -> list[Any]:
+        with self.connection() as client:
+            return client.get_batch(queue, max_items)
+
+    def send(
+        self, queue: str, blob: Any, priority: int = 0, delay_seconds: float = 0.0
+    ) -> bool:
+        with self.connection() as client:
+            return client.send(queue, blob, priority, delay_seconds)
+
+    def send_many(
+        self,
+        queue: str,
+        blobs: list[Any],
+        priority: int = 0,
+        delay_seconds: float = 0.0,
+    ) -> bool:
+        with self.connection() as client:
+            return client.send_many(queue, blobs, priority, delay_seconds)
+
+    def lease(
+        self, queue: str, max_items: int = 1, lease_seconds: float = 30.0
+    ) -> list[tuple[bytes, Any]]:
+        with self.connection() as client:
+            return client.lease(queue, max_items, lease_seconds)
+
+    def ack(self, queue: str, receipts: list[bytes]) -> int:
+        with self.connection() as client:
+            return client.ack(queue, receipts)
+
+    def send_stream(self, queue: str, data: BinaryIO, size: int | None = None) -> bool:
+        with self.connection() as client:
+            return client.send_stream(queue, data, size)
+
+    def open_stream(self, queue: str, lease_seconds: float = 30.0) -> MessageStream:
+        """Like ``MyQueue.open_stream()``. Every read goes through the
+        client that opened the stream, so it stays checked out until the
+        stream is closed."""
+        with ExitStack() as stack:
+            client = stack.enter_context(self.connection())
+            stream = client.open_stream(queue, lease_seconds)
+            stream._release = stack.pop_all().close
+        return stream
+
+    def __repr__(self) -> str:
+        host, port = self._addr
+        return "MyQueuePool(host=%r, port=%d, size=%d)" % (
+            host,
+            port,
+            len(self._clients),
         )
@@ -10,6 +10,30 @@
 - TTL reaper deletes old rows
 - Max queue size evicts oldest
 - Signal handler triggers shutdown
+- Batched GET pops several items in one round trip
+- Batched PUT stores several items with one ACK
+- Group commit shares transactions across concurrent workers
+- Selectors engine serves many connections from one loop
+- Long-poll GET wakes as soon as an item is committed
+- Buffered frame reader: coalesced, split and oversized frames
+- Back-to-back requests get their responses in one coalesced write
+- Queue depth counters track every insert/delete and migrate old DBs
+- Connection pool: concurrent producers, health check and reconnect
+- Pipelined protocol 2: many requests in flight, fallback to protocol 1
+- Codecs: json / raw / binary round trips, mixed-codec queues, timings
+- Adaptive JSON compression and a preset dictionary built from the DB
+- Named queues: isolation, per-queue limits and TTL, errors, persistence
+- Leases: hidden while in flight, ACK by receipt, redelivery on expiry
+- Priorities: urgent items overtake a bulk backlog on every GET path
+- Delayed delivery: hidden until due, then wakes a long-poll GET on time
+- Head cache: same order and no loss or duplicates; disk stays authoritative
+- Segment-log storage: FIFO round trips, restarts, torn tails, segment deletion
+- Sharding: FIFO and priorities across shard files, leases, capacity, no loss
+- Metrics: per-opcode counts, latency histograms, gauges and the HTTP endpoint
+- Session handshake: both session MACs, replayed frames rejected, old HELLOs
+- Streams: chunked PUT and seekable leased reads, non-raw heads, stale uploads
+- Incremental TTL reaping: bounded batches, backlog metric, PUTs keep flowing
+- Overflow policies: NACK with retry-after, parked blocking PUTs, nothing evicted
 """
 
 import logging
@@ -20,12 +44,13 @@ import signal
 import sys
 import tempfile
 import threading
+import time
 from pathlib import Path
 from queue import Empty
 from time import sleep
 
 sys.path.insert(0, "/home/claude")
-from tcpQueue import MyQueue
+from tcpQueue import MyQueue, MyQueuePool
 
 logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(name)s: %(message)s")
 
@@ -651,6 +676,1958 @@ def test_legacy_db_warns():
         db.cleanup()
 
 
+def test_batch_get():
+    print("\n--- test_batch_get ---")
+    db = _DbBox()
+    port = PORTS.get()
+    server = MyQueue("127.0.0.1", port, db_path=db.path(), secret_key=KEY)
+    server.start_server()
+    sleep(0.1)
+    try:
+        for i in range(7):
+            server.send_to_consumer({"i": i})
+
+        client = MyQueue("127.0.0.1", port, secret_key=KEY)
+        client.start_client()
+        first = client.get_consumer_batch(5)
+        rest = client.get_consumer_batch(5)
+        try:
+            client.get_consumer_batch(5)
+            assert False
+        except Empty:
+            pass
+        try:
+            client.get_consumer_batch(0)
+            assert False
+        except ValueError:
+            pass
+        client.close()
+
+        assert [r["i"] for r in first] == [0, 1, 2, 3, 4], first
+        assert [r["i"] for r in rest] == [5, 6], rest
+        assert server.consumer_size() == 0
+        print("  OK: 7 items drained as batches of 5 + 2, Empty when drained")
+    finally:
+        server.stop_server()
+        db.cleanup()
+
+
+def test_batch_put():
+    print("\n--- test_batch_put ---")
+    db = _DbBox()
+    port = PORTS.get()
+    server = MyQueue(
+        "127.0.0.1", port, db_path=db.path(), secret_key=KEY, max_queue_size=50
+    )
+    server.start_server()
+    sleep(0.1)
+    try:
+        client = MyQueue("127.0.0.1", port, secret_key=KEY)
+        client.start_client()
+        assert client.send_to_producer_many([{"i": i} for i in range(40)])
+        assert client.send_to_producer_many([])
+        assert server.producer_size() == 40
+
+        # A second batch overflows capacity: eviction runs once and keeps
+        # the newest 50 rows.
+        assert client.send_to_producer_many([{"i": i} for i in range(40, 60)])
+        assert server.producer_size() == 50
+        ids = [r["i"] for r in client.get_producer_batch(100)]
+        client.close()
+        assert ids == list(range(10, 60)), ids
+        print("  OK: batched puts stored in order, capacity enforced per batch")
+    finally:
+        server.stop_server()
+        db.cleanup()
+
+
+def test_group_commit():
+    print("\n--- test_group_commit ---")
+    db = _DbBox()
+    port = PORTS.get()
+    server = MyQueue(
+        "127.0.0.1",
+        port,
+        db_path=db.path(),
+        secret_key=KEY,
+        group_commit=True,
+        group_commit_window=0.002,
+    )
+    server.start_server()
+    sleep(0.1)
+    try:
+        N_THREADS, N_PER = 8, 25
+        errors: list[Exception] = []
+
+        def worker(tid: int):
+            c = MyQueue("127.0.0.1", port, secret_key=KEY)
+            c.start_client()
+            try:
+                for i in range(N_PER):
+                    assert c.send_to_producer([tid, i])
+            except Exception as ex:
+                errors.append(ex)
+            finally:
+                c.close()
+
+        threads = [threading.Thread(target=worker, args=(t,)) for t in range(N_THREADS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert not errors, f"errors: {errors}"
+        assert server.producer_size() == N_THREADS * N_PER
+
+        client = MyQueue("127.0.0.1", port, secret_key=KEY)
+        client.start_client()
+        got = []
+        try:
+            while True:
+                got.append(client.get_producer())
+        except Empty:
+            pass
+        client.close()
+        assert len(got) == N_THREADS * N_PER
+        # Per-producer FIFO order survives grouping.
+        for tid in range(N_THREADS):
+            assert [i for t, i in got if t == tid] == list(range(N_PER))
+        print(f"  OK: {len(got)} grouped puts/gets delivered in per-sender order")
+    finally:
+        server.stop_server()
+        db.cleanup()
+
+
+def test_selectors_engine():
+    print("\n--- test_selectors_engine ---")
+    db = _DbBox()
+    port = PORTS.get()
+    server = MyQueue(
+        "127.0.0.1",
+        port,
+        db_path=db.path(),
+        secret_key=KEY,
+        engine="selectors",
+        engine_workers=2,
+    )
+    server.start_server()
+    sleep(0.1)
+    clients = []
+    try:
+        # Plenty of idle connections, none of which gets its own thread.
+        for _ in range(50):
+            c = MyQueue("127.0.0.1", port, secret_key=KEY)
+            assert c.start_client()
+            clients.append(c)
+        workers = [t for t in threading.enumerate() if t.name == "tcpQueue-worker"]
+        assert not workers, workers
+
+        errors: list[Exception] = []
+
+        def worker(c: MyQueue, tid: int):
+            try:
+                for i in range(20):
+                    assert c.send_to_producer([tid, i])
+                assert c.send_to_producer_many([[tid, i] for i in range(20, 30)])
+            except Exception as ex:
+                errors.append(ex)
+
+        threads = [
+            threading.Thread(target=worker, args=(c, t))
+            for t, c in enumerate(clients[:10])
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert not errors, f"errors: {errors}"
+        assert server.producer_size() == 300
+
+        got = clients[-1].get_producer_batch(1000)
+        assert len(got) == 300
+        for tid in range(10):
+            assert [i for t, i in got if t == tid] == list(range(30))
+        try:
+            clients[-1].get_producer()
+            assert False
+        except Empty:
+            pass
+        print("  OK: 50 connections served; 300 puts and a batch get round-tripped")
+    finally:
+        for c in clients:
+            c.close()
+        server.stop_server()
+        db.cleanup()
+
+
+def test_long_poll_get():
+    print("\n--- test_long_poll_get ---")
+    for engine in ("threads", "selectors"):
+        db = _DbBox()
+        port = PORTS.get()
+        server = MyQueue(
+            "127.0.0.1", port, db_path=db.path(), secret_key=KEY, engine=engine
+        )
+        server.start_server()
+        sleep(0.1)
+        try:
+            client = MyQueue("127.0.0.1", port, secret_key=KEY)
+            client.start_client()
+
+            # Nothing arrives: Empty after (roughly) the timeout.
+            t0 = time.monotonic()
+            try:
+                client.get_consumer(timeout=0.3)
+                assert False
+            except Empty:
+                pass
+            waited = time.monotonic() - t0
+            assert 0.25 <= waited < 2.0, waited
+
+            # An item committed mid-wait is delivered long before the timeout.
+            def push():
+                sleep(0.2)
+                server.send_to_consumer({"late": True})
+
+            threading.Thread(target=push, daemon=True).start()
+            t0 = time.monotonic()
+            got = client.get_consumer(timeout=10.0)
+            waited = time.monotonic() - t0
+            client.close()
+            assert got == {"late": True}, got
+            assert waited < 2.0, waited
+            print(
+                f"  OK [{engine}]: Empty after timeout; woke {waited:.3f}s after wait"
+            )
+        finally:
+            server.stop_server()
+            db.cleanup()
+
+
+def test_frame_reader_buffering():
+    print("\n--- test_frame_reader_buffering ---")
+    import socket
+
+    from tcpQueue import _Frame, _FrameMac, _FrameReader
+
+    mac = _FrameMac(KEY)
+    a, b = socket.socketpair()
+    try:
+        reader = _FrameReader(mac, capacity=64)
+        big = os.urandom(1000)  # larger than the reader's buffer
+        wire = (
+            _Frame.encode(b"\x10", b"one", mac)
+            + _Frame.encode(b"\x11", big, mac)
+            + _Frame.encode(b"\x12", b"", mac)
+        )
+        # Three frames in one write, then a fourth trickled a byte at a time.
+        # Payload views are only valid until the next read, so copy each.
+        a.sendall(wire)
+        frames = []
+        for _ in range(3):
+            op, payload = reader.read(b)
+            frames.append((op, bytes(payload)))
+        assert frames == [(b"\x10", b"one"), (b"\x11", big), (b"\x12", b"")]
+
+        def trickle():
+            for i in range(len(last)):
+                a.send(last[i : i + 1])
+
+        last = _Frame.encode(b"\x13", b"slow", mac)
+        t = threading.Thread(target=trickle)
+        t.start()
+        op, payload = reader.read(b)
+        t.join()
+        assert (op, bytes(payload)) == (b"\x13", b"slow")
+
+        a.close()
+        assert reader.read(b) is None  # clean close between frames
+        print("  OK: coalesced, oversized and byte-at-a-time frames all parsed")
+    finally:
+        a.close()
+        b.close()
+
+
+def test_large_payload_roundtrip():
+    print("\n--- test_large_payload_roundtrip ---")
+    for engine in ("threads", "selectors"):
+        db = _DbBox()
+        port = PORTS.get()
+        server = MyQueue(
+            "127.0.0.1", port, db_path=db.path(), secret_key=KEY, engine=engine
+        )
+        server.start_server()
+        sleep(0.1)
+        try:
+            # Random hex doesn't compress below the read buffer size.
+            blobs = [{"i": i, "data": os.urandom(150_000).hex()} for i in range(3)]
+            client = MyQueue("127.0.0.1", port, secret_key=KEY)
+            client.start_client()
+            assert client.send_to_producer(blobs[0])
+            assert client.send_to_producer_many(blobs[1:])
+            got = [client.get_producer(), *client.get_producer_batch(10)]
+            client.close()
+            assert got == blobs
+            print(f"  OK [{engine}]: 3 x 300KB messages round-tripped")
+        finally:
+            server.stop_server()
+            db.cleanup()
+
+
+def test_coalesced_responses():
+    print("\n--- test_coalesced_responses ---")
+    import socket
+
+    from tcpQueue import _OP_GET_CONSUMER, _OP_ITEM, _Frame, _FrameMac, _FrameReader
+
+    for engine in ("threads", "selectors"):
+        db = _DbBox()
+        port = PORTS.get()
+        server = MyQueue(
+            "127.0.0.1", port, db_path=db.path(), secret_key=KEY, engine=engine
+        )
+        server.start_server()
+        sleep(0.1)
+        try:
+            for i in range(3):
+                server.send_to_consumer(i)
+            sock = socket.create_connection(("127.0.0.1", port), timeout=5.0)
+            try:
+                # Three GETs in one write; the server answers all of them.
+                mac = _FrameMac(KEY)
+                _Frame.write_many(sock, [(_OP_GET_CONSUMER, b"", b"")] * 3, mac)
+                reader = _FrameReader(mac)
+                ops = []
+                for _ in range(3):
+                    op, _payload = reader.read(sock)
+                    ops.append(op)
+            finally:
+                sock.close()
+            assert ops == [_OP_ITEM] * 3, ops
+            assert server.consumer_size() == 0
+            print(f"  OK [{engine}]: 3 back-to-back GETs answered")
+        finally:
+            server.stop_server()
+            db.cleanup()
+
+
+def test_depth_counters():
+    print("\n--- test_depth_counters ---")
+    import sqlite3
+
+    db = _DbBox()
+    db_path = db.path()
+    try:
+        # A version-1 DB (no counters) that already holds rows.
+        conn = sqlite3.connect(str(db_path))
+        for table in ("consumer", "producer"):
+            conn.execute(
+                f"CREATE TABLE {table} (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                f"payload BLOB NOT NULL, created_at REAL NOT NULL)"
+            )
+        conn.executemany(
+            "INSERT INTO consumer (payload, created_at) VALUES (?, 0)",
+            [(b"x",)] * 4,
+        )
+        conn.execute("PRAGMA user_version = 1")
+        conn.commit()
+        conn.close()
+
+        server = MyQueue(
+            "127.0.0.1",
+            PORTS.get(),
+            db_path=db_path,
+            secret_key=KEY,
+            max_queue_size=6,
+        )
+        assert server.consumer_size() == 4, server.consumer_size()
+        assert server.producer_size() == 0
+
+        server.clear_queues()
+        assert server.consumer_size() == 0
+        for i in range(10):
+            server.send_to_consumer(i)
+        assert server.consumer_size() == 6  # capacity still enforced
+        server._dequeue_batch("consumer", 4)
+        assert server.consumer_size() == 2
+        server._dequeue("consumer")
+        assert server.consumer_size() == 1
+
+        # Counters are kept by triggers, so even out-of-band edits count.
+        conn = sqlite3.connect(str(db_path))
+        conn.execute("DELETE FROM consumer")
+        conn.commit()
+        conn.close()
+        assert server.consumer_size() == 0
+        server.close_db()
+        print("  OK: counters seeded on migration and track every change")
+    finally:
+        db.cleanup()
+
+
+def test_connection_pool():
+    print("\n--- test_connection_pool ---")
+    db = _DbBox()
+    port = PORTS.get()
+    server = MyQueue("127.0.0.1", port, db_path=db.path(), secret_key=KEY)
+    server.start_server()
+    sleep(0.1)
+    pool = MyQueuePool(
+        "127.0.0.1", port, size=4, secret_key=KEY, health_check_interval=0.0
+    )
+    try:
+        N_THREADS, N_PER = 8, 25
+        errors: list[Exception] = []
+
+        def worker(tid: int):
+            try:
+                for i in range(N_PER):
+                    assert pool.send_to_producer([tid, i])
+            except Exception as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=worker, args=(t,)) for t in range(N_THREADS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert not errors, f"errors: {errors}"
+        assert server.producer_size() == N_THREADS * N_PER
+        assert pool.ping()
+
+        # Restart the server underneath the pool: the health check notices
+        # the dead connection and the call goes through on a fresh one.
+        server.stop_server()
+        sleep(0.1)
+        server = MyQueue("127.0.0.1", port, db_path=db.path(), secret_key=KEY)
+        server.start_server()
+        sleep(0.1)
+        got = pool.get_producer_batch(1000)
+        assert len(got) == N_THREADS * N_PER
+        print(f"  OK: {len(got)} pooled sends; pool survived a server restart")
+    finally:
+        pool.close()
+        server.stop_server()
+        db.cleanup()
+
+
+def test_pipelined_requests():
+    print("\n--- test_pipelined_requests ---")
+    for engine in ("threads", "selectors"):
+        db = _DbBox()
+        port = PORTS.get()
+        server = MyQueue(
+            "127.0.0.1", port, db_path=db.path(), secret_key=KEY, engine=engine
+        )
+        server.start_server()
+        sleep(0.1)
+        try:
+            client = MyQueue("127.0.0.1", port, secret_key=KEY)
+            N = 200
+            puts = [client.send_to_producer_async({"i": i}) for i in range(N)]
+            assert all(f.result(timeout=10) is True for f in puts)
+            assert server.producer_size() == N
+
+            # The blocking API keeps working beside the pipelined one.
+            assert client.get_producer() == {"i": 0}
+            gets = [client.get_producer_async() for _ in range(N - 11)]
+            batch = client.get_producer_batch_async(50)
+            got = [f.result(timeout=10)["i"] for f in gets]
+            assert got == list(range(1, N - 10)), got[:5]
+            assert [b["i"] for b in batch.result(timeout=10)] == list(range(N - 10, N))
+            try:
+                client.get_consumer_async().result(timeout=10)
+                assert False
+            except Empty:
+                pass
+            client.close()
+            print(f"  OK [{engine}]: {N} pipelined puts and gets matched by ID")
+        finally:
+            server.stop_server()
+            db.cleanup()
+
+    # A server that hangs up on HELLO (as servers predating it do) gets
+    # the same calls over protocol 1.
+    db = _DbBox()
+    port = PORTS.get()
+    server = MyQueue("127.0.0.1", port, db_path=db.path(), secret_key=KEY)
+    server._negotiate = lambda payload: None
+    server.start_server()
+    sleep(0.1)
+    try:
+        client = MyQueue("127.0.0.1", port, secret_key=KEY)
+        assert client.send_to_producer_async([1, 2]).result(timeout=10) is True
+        assert client.get_producer_async().result(timeout=10) == [1, 2]
+        client.close()
+        print("  OK: fell back to protocol 1 against a server without HELLO")
+
+        # require_session refuses that fallback instead.
+        strict = MyQueue("127.0.0.1", port, secret_key=KEY, require_session=True)
+        assert strict.start_client() is False
+        try:
+            strict.send_to_producer_async(1).result(timeout=10)
+            assert False
+        except ConnectionError:
+            pass
+        assert strict._server_version is None
+        strict.close()
+        print("  OK: require_session refused protocol 1")
+    finally:
+        server.stop_server()
+        db.cleanup()
+
+    # A protocol-2 server hangs up on the protocol-3 HELLO but answers the
+    # one-byte one, so the client still pipelines. The fallback is only
+    # remembered for a while: once it lapses the client tries protocol 3.
+    db = _DbBox()
+    port = PORTS.get()
+    server = MyQueue("127.0.0.1", port, db_path=db.path(), secret_key=KEY)
+    negotiate = server._negotiate
+    server._negotiate = lambda payload: (
+        negotiate(payload) if len(payload) == 1 else None
+    )
+    server.start_server()
+    sleep(0.1)
+    try:
+        client = MyQueue("127.0.0.1", port, secret_key=KEY)
+        assert client.send_to_producer_async([3]).result(timeout=10) is True
+        assert client._pipeline._mac is client._mac
+        assert client._server_version[0] == 2
+        assert client.get_producer() == [3]
+        assert client._crid and client._cmac is client._mac
+        del server._negotiate
+        client._pipeline.close()
+        client._server_version = 2, 0.0
+        assert client.send_to_producer_async([4]).result(timeout=10) is True
+        assert client._pipeline._mac is not client._mac
+        assert client._server_version is None
+        client.close()
+        print("  OK: fell back to protocol 2, then renegotiated protocol 3")
+    finally:
+        server.stop_server()
+        db.cleanup()
+
+
+def test_codecs():
+    print("\n--- test_codecs ---")
+    from tcpQueue import _CODECS, _deserialize
+
+    binary_sample = {
+        "n": [0, 1, -1, 127, -128, 2**70, -(2**70)],
+        "f": 3.25,
+        "s": "h\u00e9llo",
+        "b": b"\x00\xff",
+        "t": (1, (2, None)),
+        1: [True, False, {}],
+    }
+    for name, sample in (
+        ("json", {"k": [1, 2.5, "x", None, True]}),
+        ("raw", b"\x1f\x8b already compressed"),
+        ("binary", binary_sample),
+    ):
+        assert _deserialize(_CODECS[name].encode(sample)) == sample, name
+
+    try:
+        _CODECS["raw"].encode({"not": "bytes"})
+        assert False
+    except TypeError:
+        pass
+    try:
+        _CODECS["binary"].encode({1, 2})
+        assert False
+    except TypeError:
+        pass
+    for bad in (b"\x03i", b"\x03s\x05ab", b"\x03NN", b"\x03?", b"\x01"):
+        try:
+            _deserialize(bad)
+            assert False, bad
+        except ValueError:
+            pass
+    try:
+        MyQueue("127.0.0.1", 1, secret_key=KEY, codec="pickle")
+        assert False
+    except ValueError:
+        pass
+
+    # Mixed-codec rows in one queue: any client reads all of them.
+    db = _DbBox()
+    port = PORTS.get()
+    server = MyQueue("127.0.0.1", port, db_path=db.path(), secret_key=KEY)
+    server.start_server()
+    sleep(0.1)
+    try:
+        for name, sample in (
+            ("json", [1, "two"]),
+            ("raw", b"\x00raw"),
+            ("binary", binary_sample),
+        ):
+            client = MyQueue("127.0.0.1", port, secret_key=KEY, codec=name)
+            assert client.send_to_producer(sample)
+            client.close()
+        reader = MyQueue("127.0.0.1", port, secret_key=KEY)
+        got = reader.get_producer_batch(10)
+        reader.close()
+        assert got == [[1, "two"], b"\x00raw", binary_sample], got
+    finally:
+        server.stop_server()
+        db.cleanup()
+
+    # Quick per-codec comparison on a typical record.
+    record = {"id": 123456, "user": "alice", "tags": ["a", "b"], "score": 0.5}
+    timed = {"json": record, "binary": record, "raw": _CODECS["json"].encode(record)}
+    for name, sample in timed.items():
+        codec = _CODECS[name]
+        t0 = time.perf_counter()
+        for _ in range(1000):
+            encoded = codec.encode(sample)
+            _deserialize(encoded)
+        us = (time.perf_counter() - t0) * 1000
+        print(f"  {name:6}: {len(encoded):3d} bytes, {us:6.1f} us encode+decode")
+    print("  OK: all codecs round-trip; mixed-codec queue decodes")
+
+
+def test_adaptive_compression():
+    print("\n--- test_adaptive_compression ---")
+    import zlib
+
+    from tcpQueue import _CODECS, _deserialize
+
+    encode = _CODECS["json"].encode
+    small = {"a": 1}
+    assert encode(small)[:1] == b"\x04", encode(small)
+    assert _deserialize(encode(small)) == small
+    big = {"rows": [{"name": "x" * 10, "n": i} for i in range(200)]}
+    packed = encode(big)
+    # Still a standard zlib stream, readable by older clients.
+    assert packed[:1] == b"\x78"
+    assert zlib.decompress(packed)
+    assert _deserialize(packed) == big
+    # Incompressible text above the threshold is kept as plain JSON.
+    noise = os.urandom(300).hex()
+    assert encode(noise)[:1] in (b"\x04", b"\x78")
+    assert _deserialize(encode(noise)) == noise
+
+    db = _DbBox()
+    port = PORTS.get()
+    server = MyQueue("127.0.0.1", port, db_path=db.path(), secret_key=KEY)
+    try:
+        for i in range(200):
+            server.send_to_consumer(
+                {"event": "login", "user_id": i, "status": "ok", "region": "eu-west"}
+            )
+        zdict = server.build_zdict(size=1024)
+        assert 0 < len(zdict) <= 1024
+        assert b'"user_id":' in zdict, zdict
+
+        msg = {"event": "login", "user_id": 7, "status": "ok", "region": "eu-west"}
+        plain = encode(msg)
+        client = MyQueue("127.0.0.1", port, secret_key=KEY, zdict=zdict)
+        with_dict = client._encode(msg)
+        assert with_dict[:1] == b"\x06"
+        assert len(with_dict) < len(plain), (len(with_dict), len(plain))
+        assert client._deserialize(with_dict) == msg
+        # The dictionary belongs to that client alone, not the process.
+        for other in (None, zdict + b" "):
+            try:
+                MyQueue("127.0.0.1", port, zdict=other)._deserialize(with_dict)
+                assert False, other
+            except ValueError:
+                pass
+
+        try:
+            MyQueue("127.0.0.1", port, secret_key=KEY, codec="raw", zdict=zdict)
+            assert False
+        except ValueError:
+            pass
+        try:
+            server.build_zdict(size=0)
+            assert False
+        except ValueError:
+            pass
+        print(
+            f"  OK: {len(plain)}-byte message is {len(with_dict)} bytes "
+            f"with a {len(zdict)}-byte dictionary"
+        )
+    finally:
+        server.close_db()
+        db.cleanup()
+
+
+def test_named_queues():
+    print("\n--- test_named_queues ---")
+    for engine in ("threads", "selectors"):
+        db = _DbBox()
+        port = PORTS.get()
+        server = MyQueue(
+            "127.0.0.1", port, db_path=db.path(), secret_key=KEY, engine=engine
+        )
+        for i in range(100):
+            server.declare_queue(f"jobs_{i}")
+        server.declare_queue("tiny", max_queue_size=3)
+        server.declare_queue("short_lived", ttl_seconds=0.2)
+        server.start_server()
+        sleep(0.1)
+        try:
+            client = MyQueue("127.0.0.1", port, secret_key=KEY)
+            for i in range(100):
+                assert client.send(f"jobs_{i}", {"q": i})
+            assert client.send_many("jobs_7", [1, 2, 3])
+            assert client.get("jobs_42") == {"q": 42}
+            assert client.get_batch("jobs_7", 10) == [{"q": 7}, 1, 2, 3]
+            try:
+                client.get("jobs_42")
+                assert False
+            except Empty:
+                pass
+            assert server.queue_size("jobs_0") == 1
+            assert server.producer_size() == 0
+
+            # Per-queue max_queue_size evicts the oldest.
+            assert client.send_many("tiny", list(range(5)))
+            assert client.get_batch("tiny", 10) == [2, 3, 4]
+
+            # Unknown queues are refused without dropping the connection;
+            # bad names never leave the client.
+            for call in (
+                lambda: client.get("nope"),
+                lambda: client.send("nope", 1),
+                lambda: client.get_batch("nope", 1),
+            ):
+                t0 = time.monotonic()
+                try:
+                    call()
+                    assert False
+                except ValueError:
+                    pass
+                assert time.monotonic() - t0 < 1.0  # no retry back-off
+            for bad in ("", "Upper", "a__b", "x" * 65, "_x"):
+                try:
+                    client.send(bad, 1)
+                    assert False, bad
+                except ValueError:
+                    pass
+
+            # Long-poll wakes on a named queue too.
+            other = MyQueue("127.0.0.1", port, secret_key=KEY)
+            threading.Timer(0.2, lambda: other.send("jobs_3", "late")).start()
+            assert client.get("jobs_3") == {"q": 3}
+            t0 = time.monotonic()
+            assert client.get("jobs_3", timeout=10.0) == "late"
+            assert time.monotonic() - t0 < 2.0
+            other.close()
+
+            # Per-queue TTL.
+            assert client.send("short_lived", "old")
+            sleep(0.3)
+            assert server._reap_expired() == {"short_lived": 1}
+
+            # The sweeps reuse one registry snapshot until it changes.
+            swept = server._swept_queues()
+            server._release_due_rows()
+            server._reap_expired()
+            assert server._swept_queues() is swept
+            server.declare_queue("late_comer")
+            assert "late_comer" in [c.name for c in server._swept_queues()]
+
+            # A GET waiting on a queue being dropped, and one already past
+            # the lookup, are refused with ValueError, not left hanging.
+            assert client.get("jobs_99") == {"q": 99}
+            waiting = MyQueue("127.0.0.1", port, secret_key=KEY)
+            outcome: list[BaseException] = []
+
+            def wait_dropped() -> None:
+                try:
+                    waiting.get("jobs_99", timeout=10.0)
+                except BaseException as ex:
+                    outcome.append(ex)
+
+            waiter = threading.Thread(target=wait_dropped)
+            waiter.start()
+            sleep(0.2)
+            in_flight = server._queue("jobs_99")
+            t0 = time.monotonic()
+            server.drop_queue("jobs_99")
+            waiter.join(5.0)
+            assert [type(ex) for ex in outcome] == [ValueError], outcome
+            assert time.monotonic() - t0 < 2.0
+            waiting.close()
+            try:
+                with server._live(in_flight):
+                    server._open_db().execute("SELECT * FROM q_jobs_99")
+                assert False
+            except ValueError:
+                pass
+            try:
+                client.get("jobs_99")
+                assert False
+            except ValueError:
+                pass
+            client.close()
+            print(f"  OK [{engine}]: 102 named queues served on one port")
+        finally:
+            server.stop_server()
+
+        # Declarations persist across a restart.
+        server = MyQueue("127.0.0.1", port, db_path=db.path(), secret_key=KEY)
+        names = server.queue_names()
+        assert names[:2] == ["consumer", "producer"], names[:2]
+        assert "tiny" in names and "jobs_0" in names and "jobs_99" not in names
+        assert server.queue_size("jobs_0") == 1
+        server.close_db()
+        db.cleanup()
+
+
+def test_leases():
+    print("\n--- test_leases ---")
+    db = _DbBox()
+    port = PORTS.get()
+    server = MyQueue("127.0.0.1", port, db_path=db.path(), secret_key=KEY)
+    server.declare_queue("jobs")
+    server.start_server()
+    sleep(0.1)
+    try:
+        client = MyQueue("127.0.0.1", port, secret_key=KEY)
+        assert client.send_many("jobs", list(range(500)))
+
+        # Prefetch: leased items stay in the table but no one else sees them.
+        leased = client.lease("jobs", 300, lease_seconds=0.5)
+        assert [item for _, item in leased] == list(range(300))
+        assert server.queue_size("jobs") == 500
+        assert client.get("jobs") == 300
+        rest = client.lease("jobs", 500, lease_seconds=60.0)
+        assert [item for _, item in rest] == list(range(301, 500))
+        try:
+            client.lease("jobs")
+            assert False
+        except Empty:
+            pass
+
+        # ACK deletes by receipt, once.
+        receipts = [receipt for receipt, _ in leased]
+        assert client.ack("jobs", receipts[:250]) == 250
+        assert client.ack("jobs", receipts[:250]) == 0
+        assert server.queue_size("jobs") == 499 - 250
+
+        # The consumer "crashes" holding 50 leases: once the lease runs out
+        # the maintenance sweep hands them out again, with a new receipt.
+        sleep(2.0)
+        again = client.lease("jobs", 100, lease_seconds=60.0)
+        assert [item for _, item in again] == list(range(250, 300))
+        assert client.ack("jobs", receipts[250:]) == 0  # stale receipts
+        assert client.ack("jobs", [r for r, _ in again + rest]) == 249
+        assert server.queue_size("jobs") == 0
+
+        # Built-in queues lease too; bad arguments never leave the client.
+        server.send_to_consumer("c")
+        ((receipt, item),) = client.lease("consumer")
+        assert item == "c" and client.ack("consumer", [receipt]) == 1
+        for call in (
+            lambda: client.lease("nope"),
+            lambda: client.lease("jobs", 0),
+            lambda: client.lease("jobs", lease_seconds=0),
+            lambda: client.ack("jobs", [b"short"]),
+        ):
+            try:
+                call()
+                assert False
+            except ValueError:
+                pass
+
+        pool = MyQueuePool("127.0.0.1", port, secret_key=KEY, size=2)
+        assert pool.send("jobs", "pooled")
+        ((receipt, item),) = pool.lease("jobs", 10)
+        assert item == "pooled" and pool.ack("jobs", [receipt]) == 1
+        pool.close()
+        client.close()
+        print("  OK: 500 leased, 50 redelivered after expiry, stale ACKs ignored")
+    finally:
+        server.stop_server()
+        db.cleanup()
+
+
+def test_priorities():
+    print("\n--- test_priorities ---")
+    db = _DbBox()
+    port = PORTS.get()
+    server = MyQueue(
+        "127.0.0.1", port, db_path=db.path(), secret_key=KEY, max_queue_size=50_000
+    )
+    server.declare_queue("jobs")
+    server.start_server()
+    sleep(0.1)
+    try:
+        client = MyQueue("127.0.0.1", port, secret_key=KEY)
+        assert client.send_to_producer_many(list(range(20_000)))
+        assert client.send_to_producer("urgent", priority=10)
+        assert client.send_to_producer_many(["high-a", "high-b"], priority=5)
+        assert client.send_to_producer("low", priority=-1)
+        t0 = time.perf_counter()
+        assert client.get_producer() == "urgent"
+        elapsed = time.perf_counter() - t0
+        assert client.get_producer_batch(3) == ["high-a", "high-b", 0]
+        assert server.producer_size() == 20_000
+
+        # Server-side sends and peek follow the same order.
+        server.send_to_consumer("bulk")
+        server.send_to_consumer("first", priority=1)
+        assert server.peek_consumer() == "first"
+        assert client.get_consumer() == "first"
+
+        # Named queues and leases too.
+        assert client.send_many("jobs", ["a", "b"])
+        assert client.send("jobs", "c", priority=2)
+        assert [item for _, item in client.lease("jobs", 3)] == ["c", "a", "b"]
+
+        for bad in (2**31, -(2**31) - 1, 1.5, True):
+            try:
+                client.send_to_producer("x", priority=bad)
+                assert False, bad
+            except ValueError:
+                pass
+        client.close()
+        print(f"  OK: urgent item overtook 20000 queued in {elapsed * 1000:.2f} ms")
+    finally:
+        server.stop_server()
+        db.cleanup()
+
+
+def test_delayed_delivery():
+    print("\n--- test_delayed_delivery ---")
+    for engine in ("threads", "selectors"):
+        db = _DbBox()
+        port = PORTS.get()
+        server = MyQueue(
+            "127.0.0.1", port, db_path=db.path(), secret_key=KEY, engine=engine
+        )
+        server.declare_queue("jobs", max_queue_size=50_000)
+        # Until the maintenance thread plans a sweep, a delayed PUT wakes it.
+        server.send_to_consumer("early", delay_seconds=0.1)
+        assert server._sweep_wakeup.is_set()
+        server.start_server()
+        sleep(0.1)
+        try:
+            client = MyQueue("127.0.0.1", port, secret_key=KEY)
+            assert client.get_consumer(timeout=5.0) == "early"
+            assert client.send_to_producer("later", delay_seconds=0.5)
+            assert client.send_to_producer("now")
+            assert client.get_producer() == "now"
+            for call in (server.peek_producer, client.get_producer):
+                try:
+                    call()
+                    assert False
+                except Empty:
+                    pass
+
+            # A waiting consumer gets the item as soon as it is due, well
+            # inside the maintenance thread's fallback sweep interval.
+            t0 = time.monotonic()
+            assert client.get_producer(timeout=5.0) == "later"
+            elapsed = time.monotonic() - t0
+            assert 0.3 < elapsed < 0.9, elapsed
+
+            # Thousands of scheduled rows don't get in the way.
+            assert client.send_many("jobs", list(range(20_000)), delay_seconds=3600)
+            assert client.send("jobs", "ready")
+            assert client.get("jobs") == "ready"
+            try:
+                client.get_batch("jobs", 10)
+                assert False
+            except Empty:
+                pass
+            assert server.queue_size("jobs") == 20_000
+
+            server.send_to_consumer("c", delay_seconds=0.2)
+            assert client.get_consumer(timeout=5.0) == "c"
+
+            for bad in (-1, 2**32):
+                try:
+                    client.send_to_producer("x", delay_seconds=bad)
+                    assert False, bad
+                except ValueError:
+                    pass
+            client.close()
+            print(f"  OK [{engine}]: 0.5 s delay delivered after {elapsed:.2f} s")
+        finally:
+            server.stop_server()
+            db.cleanup()
+
+
+def test_head_cache():
+    print("\n--- test_head_cache ---")
+    import sqlite3
+
+    timings = {}
+    for cache_size in (0, 64):
+        db = _DbBox()
+        q = MyQueue(db_path=db.path(), secret_key=KEY, cache_size=cache_size)
+        for i in range(5000):
+            q.send_to_consumer(i)
+        t0 = time.perf_counter()
+        payloads = [q._dequeue("consumer") for _ in range(5000)]
+        timings[cache_size] = time.perf_counter() - t0
+        assert payloads == [q._encode(i) for i in range(5000)]
+        q.close_db()
+        db.cleanup()
+
+    for group_commit in (False, True):
+        db = _DbBox()
+        port = PORTS.get()
+        server = MyQueue(
+            "127.0.0.1",
+            port,
+            db_path=db.path(),
+            secret_key=KEY,
+            cache_size=16,
+            group_commit=group_commit,
+        )
+        server.start_server()
+        sleep(0.1)
+        try:
+            client = MyQueue("127.0.0.1", port, secret_key=KEY)
+            assert client.send_to_producer_many(list(range(100)))
+            assert client.get_producer() == 0
+            assert server.peek_producer() == 1
+            # Write-through: a new urgent row goes to the front of the head,
+            # oversized rows are read from disk in their turn.
+            assert client.send_to_producer("urgent", priority=1)
+            assert client.send_to_producer("x" * 100_000, priority=1)
+            assert client.get_producer_batch(3) == ["urgent", "x" * 100_000, 1]
+
+            # Leased and externally deleted rows are never handed out again.
+            leased = client.lease("producer", 5)
+            assert [item for _, item in leased] == [2, 3, 4, 5, 6]
+            conn = sqlite3.connect(db.path())
+            conn.execute("DELETE FROM producer WHERE id IN (8, 9)")  # items 7, 8
+            conn.commit()
+            conn.close()
+            assert client.get_producer_batch(4) == [9, 10, 11, 12]
+
+            # Concurrent producers and consumers: nothing lost or repeated.
+            got = []
+            lock = threading.Lock()
+
+            def consume():
+                c = MyQueue("127.0.0.1", port, secret_key=KEY)
+                while True:
+                    try:
+                        items = c.get_producer_batch(3)
+                    except Empty:
+                        break
+                    with lock:
+                        got.extend(items)
+                c.close()
+
+            producers = [
+                threading.Thread(
+                    target=lambda k=k: MyQueue(
+                        "127.0.0.1", port, secret_key=KEY
+                    ).send_to_producer_many([f"p{k}-{i}" for i in range(200)])
+                )
+                for k in range(4)
+            ]
+            for t in producers:
+                t.start()
+            for t in producers:
+                t.join()
+            consumers = [threading.Thread(target=consume) for _ in range(4)]
+            for t in consumers:
+                t.start()
+            for t in consumers:
+                t.join()
+            expected = set(range(13, 100)) | {
+                f"p{k}-{i}" for k in range(4) for i in range(200)
+            }
+            assert len(got) == len(expected) and set(got) == expected
+            assert server.producer_size() == 5  # the leased rows
+            client.close()
+        finally:
+            server.stop_server()
+            db.cleanup()
+
+    # Under the threads engine a single PUT's payload is a view into the
+    # reader's buffer, which the next frame overwrites: the head must keep
+    # a copy. A GET first, so the PUTs land in a filled head.
+    db = _DbBox()
+    port = PORTS.get()
+    server = MyQueue(
+        "127.0.0.1", port, db_path=db.path(), secret_key=KEY, cache_size=1000
+    )
+    server.start_server()
+    sleep(0.1)
+    try:
+        client = MyQueue("127.0.0.1", port, secret_key=KEY)
+        assert client.send_to_producer(-1) and client.get_producer() == -1
+        for i in range(1000):
+            assert client.send_to_producer({"single": i})
+        assert all(type(e[2]) is bytes for e in server._caches["producer"].entries)
+        got = [client.get_producer()["single"] for _ in range(1000)]
+        assert got == list(range(1000)), got[:20]
+        client.close()
+    finally:
+        server.stop_server()
+        db.cleanup()
+    print(
+        "  OK: 5000 local GETs in %.3f s uncached, %.3f s cached"
+        % (timings[0], timings[64])
+    )
+
+
+def test_segment_storage():
+    print("\n--- test_segment_storage ---")
+    import tcpQueue
+
+    timings = {}
+    for storage in ("sqlite", "segments"):
+        db = _DbBox()
+        q = MyQueue(db_path=db.path(), secret_key=KEY, storage=storage)
+        t0 = time.perf_counter()
+        for i in range(2000):
+            q.send_to_consumer(i)
+        timings[storage] = time.perf_counter() - t0
+        assert [q.peek_consumer(), q.consumer_size()] == [0, 2000]
+        q.close_db()
+        db.cleanup()
+
+    for engine in ("threads", "selectors"):
+        db = _DbBox()
+        port = PORTS.get()
+        server = MyQueue(
+            "127.0.0.1",
+            port,
+            db_path=db.path(),
+            secret_key=KEY,
+            engine=engine,
+            storage="segments",
+            segment_fsync="interval",
+        )
+        server.declare_queue("jobs", max_queue_size=5)
+        server.start_server()
+        sleep(0.1)
+        try:
+            client = MyQueue("127.0.0.1", port, secret_key=KEY)
+            assert client.send_to_producer_many(list(range(10)))
+            assert client.send_to_producer({"k": "v"})
+            assert server.producer_size() == 11
+            assert server.peek_producer() == 0
+            assert client.get_producer() == 0
+            assert client.get_producer_batch(4) == [1, 2, 3, 4]
+            assert client.send_many("jobs", list(range(8)))
+            assert server.queue_size("jobs") == 5  # capacity evicts the oldest
+            assert client.get_batch("jobs", 100) == [3, 4, 5, 6, 7]
+            try:
+                client.get("jobs")
+                assert False
+            except Empty:
+                pass
+            assert server.queue_size("jobs") == 0 and server.consumer_empty()
+
+            # A waiting consumer is woken by the append.
+            threading.Timer(0.2, server.send_to_consumer, ("late",)).start()
+            assert client.get_consumer(timeout=5.0) == "late"
+
+            # Priorities, delays and leases are refused, not ignored.
+            for call in (
+                lambda: client.send_to_producer("x", priority=1),
+                lambda: client.send("jobs", "x", delay_seconds=1),
+                lambda: client.lease("jobs"),
+                lambda: server.send_to_consumer("x", priority=1),
+            ):
+                try:
+                    call()
+                    assert False
+                except ValueError:
+                    pass
+            assert client.ping()
+            client.close()
+        finally:
+            server.stop_server()
+        # Restart: the read offset survives, the rest is still queued.
+        server = MyQueue(db_path=db.path(), secret_key=KEY, storage="segments")
+        assert server.producer_size() == 6
+        assert server.peek_producer() == 5
+        server.clear_queues()
+        assert server.producer_empty()
+        db.cleanup()
+
+    # Small segments: consumed ones are deleted whole, a torn tail is cut.
+    saved = tcpQueue._SEGMENT_BYTES
+    tcpQueue._SEGMENT_BYTES = 1024
+    db = _DbBox()
+    try:
+        q = MyQueue(db_path=db.path(), secret_key=KEY, storage="segments")
+        # One writer per segment directory: a second opener is refused.
+        try:
+            MyQueue(db_path=db.path(), secret_key=KEY, storage="segments")
+            assert False
+        except RuntimeError:
+            pass
+        # Without fcntl to lock it with, the engine is refused up front.
+        fcntl, tcpQueue.fcntl = tcpQueue.fcntl, None
+        try:
+            MyQueue(db_path=db.path("other.db"), secret_key=KEY, storage="segments")
+            assert False
+        except ValueError:
+            pass
+        finally:
+            tcpQueue.fcntl = fcntl
+        q.declare_queue("logs", ttl_seconds=60)
+        for i in range(200):
+            q.send_to_consumer("message %d" % i)
+        segdir = Path(str(db.path()) + ".segments") / "consumer"
+        before = len(list(segdir.glob("*.seg")))
+        assert before > 5, before
+        assert [q._dequeue("consumer") for _ in range(150)][-1] == q._encode(
+            "message 149"
+        )
+        after = len(list(segdir.glob("*.seg")))
+        assert after < before / 2, (before, after)
+
+        newest = max(segdir.glob("*.seg"))
+        with open(newest, "ab") as f:
+            f.write(b"\x00\x00\x01\x00torn")
+        q.stop_server()  # closes the logs
+        q = MyQueue(db_path=db.path(), secret_key=KEY, storage="segments")
+        assert q.consumer_size() == 50
+        q.send_to_consumer("after")
+        items = []
+        while not q.consumer_empty():
+            items.append(q._dequeue("consumer"))
+        assert items[-1] == q._encode("after") and len(items) == 51
+
+        # TTL reaping moves the offset past expired records.
+        q._enqueue("logs", q._encode("old"))
+        log_ = q._storage.log("q_logs")
+        assert q._reap_expired() == {}
+        q.declare_queue("logs", ttl_seconds=0.001)
+        sleep(0.01)
+        assert q._reap_expired() == {"logs": 1}
+        assert q.queue_size("logs") == 0 and len(log_) == 0
+        q.drop_queue("logs")
+        assert not (segdir.parent / "q_logs").exists()
+        for call in (
+            lambda: q._storage.log("q_logs"),
+            lambda: q._enqueue("logs", q._encode("late")),
+        ):
+            try:
+                call()
+                assert False
+            except ValueError:
+                pass
+        assert not (segdir.parent / "q_logs").exists()
+        q.declare_queue("logs")
+        q._enqueue("logs", q._encode("again"))
+        assert q.queue_size("logs") == 1
+        q.stop_server()
+    finally:
+        tcpQueue._SEGMENT_BYTES = saved
+        db.cleanup()
+    print(
+        "  OK: 2000 local PUTs in %.3f s with sqlite, %.3f s with segments"
+        % (timings["sqlite"], timings["segments"])
+    )
+
+
+def test_sharding():
+    print("\n--- test_sharding ---")
+    import sqlite3
+
+    for group_commit in (False, True):
+        db = _DbBox()
+        port = PORTS.get()
+        server = MyQueue(
+            "127.0.0.1",
+            port,
+            db_path=db.path("shards"),
+            secret_key=KEY,
+            shards=4,
+            group_commit=group_commit,
+        )
+        server.declare_queue("small", max_queue_size=8)
+        server.start_server()
+        sleep(0.1)
+        try:
+            client = MyQueue("127.0.0.1", port, secret_key=KEY)
+            for i in range(40):
+                assert client.send_to_producer(i)
+            files = sorted(p.name for p in db.path("shards").glob("*.db"))
+            assert files == ["shard-%02d.db" % i for i in range(4)], files
+            for name in files:
+                conn = sqlite3.connect(db.path("shards") / name)
+                (rows,) = conn.execute("SELECT COUNT(*) FROM producer").fetchone()
+                assert rows == 10, rows
+                assert conn.execute("SELECT name FROM queues").fetchall() == [
+                    ("small",)
+                ]
+                conn.close()
+            assert server.producer_size() == 40 and server.peek_producer() == 0
+
+            # GETs merge the shards back into FIFO order; priorities still win.
+            assert client.send_to_producer("urgent", priority=5)
+            assert client.get_producer() == "urgent"
+            assert client.get_producer_batch(15) == list(range(15))
+            assert [client.get_producer() for _ in range(5)] == list(range(15, 20))
+
+            # Leases span shards; receipts find their way back.
+            leased = client.lease("producer", 6, lease_seconds=30)
+            assert [item for _, item in leased] == list(range(20, 26))
+            assert client.ack("producer", [r for r, _ in leased] * 2) == 6
+            stranger = (63 << 56).to_bytes(8, "big") + bytes(4)
+            assert client.ack("producer", [stranger]) == 0
+            assert client.get_producer_batch(100) == list(range(26, 40))
+            assert server.producer_empty()
+
+            # Each of the 4 shards keeps its share of max_queue_size=8.
+            for i in range(20):
+                assert client.send("small", i)
+            assert server.queue_size("small") == 8
+            assert client.get_batch("small", 100) == list(range(12, 20))
+
+            # Concurrent producers and consumers: nothing lost or repeated.
+            got = []
+            lock = threading.Lock()
+
+            def produce(k):
+                c = MyQueue("127.0.0.1", port, secret_key=KEY)
+                for i in range(100):
+                    c.send_to_producer(f"p{k}-{i}")
+                c.close()
+
+            def consume():
+                c = MyQueue("127.0.0.1", port, secret_key=KEY)
+                while True:
+                    try:
+                        items = c.get_producer_batch(7)
+                    except Empty:
+                        break
+                    with lock:
+                        got.extend(items)
+                c.close()
+
+            threads = [threading.Thread(target=produce, args=(k,)) for k in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            threads = [threading.Thread(target=consume) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            expected = {f"p{k}-{i}" for k in range(4) for i in range(100)}
+            assert len(got) == len(expected) and set(got) == expected
+            client.close()
+        finally:
+            server.stop_server()
+
+        # Growing is fine, shrinking would hide rows.
+        MyQueue(db_path=db.path("shards"), secret_key=KEY, shards=6).close_db()
+        try:
+            MyQueue(db_path=db.path("shards"), secret_key=KEY, shards=2)
+            assert False
+        except ValueError:
+            pass
+        db.cleanup()
+    for bad in (0, 65, True):
+        try:
+            MyQueue(shards=bad)
+            assert False, bad
+        except ValueError:
+            pass
+    print("  OK: 4 shards deliver in FIFO order with and without group commit")
+
+
+def test_metrics():
+    """metrics() counts every request by opcode and times each stage of
+    it; the admin port serves the same numbers as Prometheus text."""
+    print("\n--- test_metrics ---")
+    from urllib.error import HTTPError
+    from urllib.request import urlopen
+
+    import tcpQueue
+
+    # Every opcode has a metrics label, and nothing else does.
+    opcodes = {v for k, v in vars(tcpQueue).items() if k.startswith("_OP_")}
+    assert set(tcpQueue._OPCODE_NAMES) == opcodes
+
+    for engine in ("threads", "selectors"):
+        db = _DbBox()
+        port, metrics_port = PORTS.get(), PORTS.get()
+        server = MyQueue(
+            "127.0.0.1",
+            port,
+            db_path=db.path(),
+            secret_key=KEY,
+            engine=engine,
+            reaper_interval=0.3,
+            metrics_port=metrics_port,
+        )
+        server.start_server()
+        sleep(0.1)
+        try:
+            server.declare_queue("short_lived", ttl_seconds=0.2)
+            server._enqueue("short_lived", server._encode("doomed"))
+            client = MyQueue("127.0.0.1", port, secret_key=KEY)
+            client.start_client()
+            try:
+                pads = [os.urandom(2000).hex() for _ in range(10)]
+                for i, pad in enumerate(pads):
+                    client.send_to_producer({"i": i, "pad": pad})
+                assert client.get_producer() == {"i": 0, "pad": pads[0]}
+                assert client.ping()
+                m = server.metrics()
+                assert m["connections"] == 1, m["connections"]
+            finally:
+                client.close()
+
+            m = server.metrics()
+            assert m["requests"]["put_producer"] == 10, m["requests"]
+            assert m["requests"]["get_producer"] == 1, m["requests"]
+            assert m["requests"]["ping"] == 1, m["requests"]
+            put = m["request_seconds"]["put_producer"]
+            assert put["buckets"][float("inf")] == put["count"] == 10
+            assert 0 < put["sum"]
+            for name in ("frame_read_seconds", "hmac_verify_seconds"):
+                assert m[name]["count"] >= 12, (name, m[name])
+            assert m["response_write_seconds"]["count"] > 0
+            assert m["sqlite_commit_seconds"]["count"] >= 11
+            assert m["sqlite_lock_wait_seconds"]["count"] >= 11
+            assert m["queue_depth"]["producer"] == 9, m["queue_depth"]
+            assert m["wal_bytes"] > 0
+
+            # Drained rows leave free pages the maintenance loop hands back.
+            server.clear_queues()
+            deadline = time.monotonic() + 5.0
+            while time.monotonic() < deadline:
+                m = server.metrics()
+                if (
+                    m["ttl_reaped"]
+                    and m["compact_reclaimed_pages"]
+                    and not m["connections"]
+                ):
+                    break
+                sleep(0.1)
+            assert m["ttl_reaped"] == {"short_lived": 1}, m["ttl_reaped"]
+            assert m["compact_reclaimed_pages"] > 0
+            assert m["connections"] == 0
+
+            url = "http://127.0.0.1:%d/metrics" % metrics_port
+            with urlopen(url, timeout=5.0) as resp:
+                assert resp.headers["Content-Type"].startswith("text/plain")
+                text = resp.read().decode()
+            for line in (
+                'tcpqueue_requests_total{opcode="put_producer"} 10',
+                "# TYPE tcpqueue_request_seconds histogram",
+                'tcpqueue_request_seconds_count{opcode="put_producer"} 10',
+                'tcpqueue_sqlite_commit_seconds_bucket{le="+Inf"}',
+                "tcpqueue_hmac_verify_seconds_sum",
+                'tcpqueue_ttl_reaped_total{queue="short_lived"} 1',
+                "tcpqueue_compact_reclaimed_pages_total",
+                'tcpqueue_queue_depth{queue="producer"} 0',
+                "tcpqueue_wal_bytes",
+                "tcpqueue_connections 0",
+            ):
+                assert line in text, (line, text)
+            try:
+                urlopen("http://127.0.0.1:%d/nope" % metrics_port, timeout=5.0)
+                assert False, "expected a 404"
+            except HTTPError as ex:
+                assert ex.code == 404
+        finally:
+            server.stop_server()
+            db.cleanup()
+
+    for bad in (0, 70000, True, "9100"):
+        try:
+            MyQueue(metrics_port=bad)
+            assert False, bad
+        except ValueError:
+            pass
+    print("  OK: opcodes counted, stages timed, endpoint scraped on both engines")
+
+
+def test_session_handshake():
+    """Protocol 3 signs every frame with a per-connection session key and
+    sequence number, so a frame replayed on its connection is refused."""
+    print("\n--- test_session_handshake ---")
+    import socket
+
+    from tcpQueue import (
+        _OP_ACK,
+        _OP_HELLO,
+        _OP_PING,
+        _Frame,
+        _FrameMac,
+        _FrameReader,
+        _SessionMac,
+        _session_mac,
+    )
+
+    for engine in ("threads", "selectors"):
+        db = _DbBox()
+        port = PORTS.get()
+        server = MyQueue(
+            "127.0.0.1", port, db_path=db.path(), secret_key=KEY, engine=engine
+        )
+        server.start_server()
+        sleep(0.1)
+        try:
+            for session_mac in ("blake2b", "hmac-sha256"):
+                client = MyQueue(
+                    "127.0.0.1", port, secret_key=KEY, session_mac=session_mac
+                )
+                client.start_client()
+                assert isinstance(client._cmac, _SessionMac)
+                assert client._cmac._send.name.startswith(
+                    "blake2b" if session_mac == "blake2b" else "hmac"
+                ), client._cmac._send.name
+                for i in range(20):
+                    assert client.send_to_producer({"i": i})
+                assert client.send_to_producer_async({"i": 20}).result(timeout=10)
+                got = [client.get_producer()["i"] for _ in range(11)]
+                got += [b["i"] for b in client.get_producer_batch(100)]
+                assert got == list(range(21)), got
+                client.close()
+
+            # Handshake by hand, then send one frame twice.
+            nonce = os.urandom(16)
+            static = _FrameMac(KEY)
+            sock = socket.create_connection(("127.0.0.1", port), timeout=5.0)
+            try:
+                reader = _FrameReader(static)
+                _Frame.write(sock, _OP_HELLO, b"\x03" + nonce + b"\x02", static)
+                op, ack = reader.read(sock)
+                assert op == _OP_ACK and ack[0] == 3 and ack[-1] == 2, bytes(ack)
+                mac = _session_mac(KEY, nonce, bytes(ack[1:17]), 2, client=True)
+                reader.mac = mac
+                ping = _Frame.encode(_OP_PING, b"\x00\x00\x00\x07", mac)
+                sock.sendall(ping)
+                op, body = reader.read(sock)
+                assert (op, bytes(body)) == (_OP_ACK, b"\x00\x00\x00\x07")
+                sock.sendall(ping)  # replayed: the sequence number moved on
+                try:
+                    assert reader.read(sock) is None
+                except ConnectionError:
+                    pass
+            finally:
+                sock.close()
+
+            # A protocol-2 client's one-byte HELLO still gets protocol 2
+            # with the static HMAC.
+            sock = socket.create_connection(("127.0.0.1", port), timeout=5.0)
+            try:
+                reader = _FrameReader(static)
+                _Frame.write(sock, _OP_HELLO, b"\x02", static)
+                assert [bytes(x) for x in reader.read(sock)] == [_OP_ACK, b"\x02"]
+                _Frame.write(sock, _OP_PING, b"", static, b"\x00\x00\x00\x01")
+                op, body = reader.read(sock)
+                assert (op, bytes(body)) == (_OP_ACK, b"\x00\x00\x00\x01")
+            finally:
+                sock.close()
+            print(f"  OK [{engine}]: both session MACs, replay refused, v2 HELLO")
+        finally:
+            server.stop_server()
+            db.cleanup()
+
+    # Without keys on either side protocol 3 carries no MAC at all.
+    db = _DbBox()
+    port = PORTS.get()
+    server = MyQueue("127.0.0.1", port, db_path=db.path())
+    server.start_server()
+    sleep(0.1)
+    try:
+        client = MyQueue("127.0.0.1", port)
+        assert client.send_to_producer_async("plain").result(timeout=10)
+        assert client.get_producer_async().result(timeout=10) == "plain"
+        client.close()
+    finally:
+        server.stop_server()
+        db.cleanup()
+
+    # require_session: the server closes on a one-byte HELLO or on a
+    # request sent without any HELLO.
+    for engine in ("threads", "selectors"):
+        db = _DbBox()
+        port = PORTS.get()
+        server = MyQueue(
+            "127.0.0.1",
+            port,
+            db_path=db.path(),
+            secret_key=KEY,
+            engine=engine,
+            require_session=True,
+        )
+        server.start_server()
+        sleep(0.1)
+        try:
+            client = MyQueue("127.0.0.1", port, secret_key=KEY, require_session=True)
+            assert client.send_to_producer("strict")
+            assert client.get_producer_async().result(timeout=10) == "strict"
+            client.close()
+            static = _FrameMac(KEY)
+            for hello in (True, False):
+                sock = socket.create_connection(("127.0.0.1", port), timeout=5.0)
+                try:
+                    if hello:
+                        _Frame.write(sock, _OP_HELLO, b"\x02", static)
+                    else:
+                        _Frame.write(sock, _OP_PING, b"", static)
+                    try:
+                        assert _FrameReader(static).read(sock) is None
+                    except ConnectionError:
+                        pass
+                finally:
+                    sock.close()
+            print(f"  OK [{engine}]: require_session refused protocols 1 and 2")
+        finally:
+            server.stop_server()
+            db.cleanup()
+
+    for bad in ({"session_mac": "md5"}, {"require_session": True}):
+        try:
+            MyQueue(**bad)
+            assert False, bad
+        except ValueError:
+            pass
+    print("  OK: keyless protocol 3, unknown session_mac refused")
+
+
+def test_streaming():
+    print("\n--- test_streaming ---")
+    import io
+
+    import tcpQueue
+
+    blob = os.urandom(3 * 1024 * 1024 + 12345)  # three full chunks and a bit
+    for engine, shards in (("threads", 1), ("selectors", 1), ("threads", 2)):
+        db = _DbBox()
+        port = PORTS.get()
+        server = MyQueue(
+            "127.0.0.1",
+            port,
+            db_path=db.path("shards") if shards > 1 else db.path(),
+            secret_key=KEY,
+            engine=engine,
+            shards=shards,
+        )
+        server.declare_queue("files")
+        server.start_server()
+        sleep(0.1)
+        try:
+            client = MyQueue("127.0.0.1", port, secret_key=KEY)
+            # Uploads from a seekable file and from a pipe-like one with a
+            # size; both are ordinary raw messages once published.
+            assert client.send_stream("files", io.BytesIO(blob))
+            assert client.send_stream("files", io.BytesIO(b"tiny"), size=4)
+            assert client.send_stream("files", io.BytesIO(b""))
+            assert server.queue_size("files") == 3
+            assert client.get("files") == blob
+
+            with client.open_stream("files", lease_seconds=60) as stream:
+                assert stream.size == 4 and stream.read() == b"tiny"
+            with client.open_stream("files") as stream:
+                assert stream.size == 0 and stream.read() == b""
+            assert server.queue_size("files") == 0
+
+            # Seek around a leased message; it stays until acknowledged.
+            assert client.send_stream("files", io.BytesIO(blob))
+            stream = client.open_stream("files", lease_seconds=0.5)
+            stream.seek(-10, io.SEEK_END)
+            assert stream.read() == blob[-10:]
+            stream.seek(1024 * 1024 - 3)
+            assert stream.read(6) == blob[1024 * 1024 - 3 : 1024 * 1024 + 3]
+            assert (
+                io.BufferedReader(stream).read(100)
+                == blob[1024 * 1024 + 3 : 1024 * 1024 + 103]
+            )
+            try:
+                client.lease("files")
+                assert False
+            except Empty:
+                pass
+            # The lease runs out: reads fail, and the message comes back.
+            sleep(2.0)
+            try:
+                stream.read(1)
+                assert False
+            except ValueError:
+                pass
+            with client.open_stream("files") as again:
+                assert not stream.ack()  # delivered again since
+                stream.close()
+                assert again.readall() == blob
+            assert server.queue_size("files") == 0
+
+            # Only raw messages stream; a JSON one is refused and not leased.
+            assert client.send("files", {"a": 1})
+            try:
+                client.open_stream("files")
+                assert False
+            except ValueError:
+                pass
+            assert client.get("files") == {"a": 1}
+            try:
+                client.open_stream("files")
+                assert False
+            except Empty:
+                pass
+
+            # A short file fails the upload; the maintenance thread deletes
+            # it once idle, and it was never visible meanwhile.
+            old_idle = tcpQueue._STREAM_IDLE_SECONDS
+            tcpQueue._STREAM_IDLE_SECONDS = 0.5
+            try:
+                client.send_stream("files", io.BytesIO(b"short"), size=100)
+                assert False
+            except ValueError:
+                pass
+            finally:
+                tcpQueue._STREAM_IDLE_SECONDS = old_idle
+            assert server.queue_size("files") == 1
+            try:
+                client.get("files")
+                assert False
+            except Empty:
+                pass
+            sleep(2.0)
+            assert server.queue_size("files") == 0
+
+            # A pooled stream keeps its client checked out until closed.
+            pool = MyQueuePool("127.0.0.1", port, secret_key=KEY, size=1)
+            assert pool.send_stream("files", io.BytesIO(b"pooled"))
+            with pool.open_stream("files") as stream:
+                assert pool._idle.empty()
+                assert stream.read() == b"pooled"
+            assert not pool._idle.empty()
+            assert pool.ping()
+            pool.close()
+            client.close()
+        finally:
+            server.stop_server()
+            db.cleanup()
+
+    db = _DbBox()
+    segments = MyQueue(db_path=db.path(), secret_key=KEY, storage="segments")
+    try:
+        segments._stream_begin("consumer", 10)
+        assert False
+    except ValueError:
+        pass
+    segments.close_db()
+    db.cleanup()
+    print("  OK: 3 MB streamed in and out on both engines and over 2 shards")
+
+
+def test_incremental_reaping():
+    """A large expired backlog is reaped over several bounded passes, and
+    writers get the lock in between instead of waiting for all of it."""
+    print("\n--- test_incremental_reaping ---")
+    import sqlite3
+
+    import tcpQueue
+
+    db = _DbBox()
+    server = MyQueue(
+        db_path=db.path(), secret_key=KEY, ttl_seconds=60.0, max_queue_size=10**6
+    )
+    server.send_to_consumer("fresh")
+    conn = sqlite3.connect(db.path())
+    old = time.time() - 3600
+    payload = server._encode("x" * 100)
+    conn.executemany(
+        "INSERT INTO consumer (payload, created_at) VALUES (?, ?)",
+        [(payload, old + i / 1000) for i in range(200_000)],
+    )
+    conn.commit()
+    conn.close()
+
+    old_pass = tcpQueue._REAP_PASS_SECONDS
+    tcpQueue._REAP_PASS_SECONDS = 0.05
+    latencies = []
+    stop = threading.Event()
+
+    def writer():
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            server.send_to_consumer("during")
+            latencies.append(time.perf_counter() - t0)
+            sleep(0.001)
+        server.close_db()
+
+    t = threading.Thread(target=writer)
+    t.start()
+    try:
+        passes = reaped = 0
+        while True:
+            reaped += server._reap_expired().get("consumer", 0)
+            passes += 1
+            backlog = server.metrics()["ttl_reap_backlog"]
+            if not backlog:
+                break
+            assert 0 < backlog["consumer"] == 200_000 - reaped, backlog
+    finally:
+        stop.set()
+        t.join()
+        tcpQueue._REAP_PASS_SECONDS = old_pass
+    assert reaped == 200_000 and passes > 1, (reaped, passes)
+    assert server.consumer_size() == 1 + len(latencies)
+    assert server.peek_consumer() == "fresh"
+    assert tcpQueue._REAP_MIN_BATCH <= server._reap_batch <= tcpQueue._REAP_MAX_BATCH
+    assert latencies and max(latencies) < 1.0, max(latencies)
+    assert "tcpqueue_ttl_reap_backlog" in tcpQueue._prometheus_text(server.metrics())
+    server.close_db()
+    db.cleanup()
+    print(
+        "  OK: 200000 expired rows over %d passes, %d concurrent PUTs, "
+        "slowest %.1f ms" % (passes, len(latencies), max(latencies) * 1000)
+    )
+
+
+def test_overflow_policies():
+    print("\n--- test_overflow_policies ---")
+    import tcpQueue
+    from tcpQueue import QueueFull
+
+    for storage in ("sqlite", "segments"):
+        db = _DbBox()
+        port = PORTS.get()
+        server = MyQueue(
+            "127.0.0.1",
+            port,
+            db_path=db.path(),
+            secret_key=KEY,
+            storage=storage,
+            overflow="reject",
+            max_queue_size=3,
+        )
+        server.declare_queue("held", max_queue_size=2, overflow="block")
+        server.declare_queue("lossy", max_queue_size=2)
+        server.start_server()
+        sleep(0.1)
+        try:
+            client = MyQueue("127.0.0.1", port, secret_key=KEY, timeout=1.0)
+            for i in range(3):
+                assert client.send_to_producer(i)
+
+            # reject: the server NACKs; the client backs off and gives up
+            # after its timeout, and nothing queued was evicted.
+            t0 = time.monotonic()
+            assert not client.send_to_producer("overflow")
+            assert 0.5 < time.monotonic() - t0 < 2.0
+            assert server.producer_size() == 3 and server.peek_producer() == 0
+            try:
+                client.send_to_producer_async("overflow").result(5)
+                assert False
+            except QueueFull as ex:
+                assert 0 < ex.retry_after <= 1.0
+            for _ in range(3):
+                server.send_to_consumer("x")
+            try:
+                server.send_to_consumer("x")
+                assert False
+            except QueueFull:
+                pass
+            try:
+                client.send_to_producer_many(list(range(4)))  # can never fit
+                assert False
+            except ValueError as ex:
+                assert not isinstance(ex, QueueFull)
+
+            # A consumer making room lets the backed-off PUT through.
+            threading.Timer(0.3, client.get_producer).start()
+            assert client.send_to_producer("retried")
+            assert client.get_producer_batch(10) == [1, 2, "retried"]
+
+            # block: the PUT is held until a GET makes room.
+            assert client.send_many("held", ["a", "b"])
+            other = MyQueue("127.0.0.1", port, secret_key=KEY)
+            threading.Timer(0.3, lambda: other.get("held")).start()
+            t0 = time.monotonic()
+            assert client.send("held", "c")
+            assert time.monotonic() - t0 >= 0.25
+            assert client.get_batch("held", 10) == ["b", "c"]
+            other.close()
+
+            # drop_oldest is still the default for declared queues.
+            assert client.send_many("lossy", [1, 2, 3])
+            assert client.get_batch("lossy", 10) == [2, 3]
+            client.close()
+        finally:
+            server.stop_server()
+            db.cleanup()
+
+    # The selectors engine parks blocked PUTs instead of holding a worker
+    # each, so more blocked producers than workers still let a consumer in.
+    db = _DbBox()
+    port = PORTS.get()
+    server = MyQueue(
+        "127.0.0.1",
+        port,
+        db_path=db.path(),
+        secret_key=KEY,
+        engine="selectors",
+        engine_workers=2,
+    )
+    server.declare_queue("held", max_queue_size=1, overflow="block")
+    server.start_server()
+    sleep(0.1)
+    try:
+        consumer = MyQueue("127.0.0.1", port, secret_key=KEY)
+        assert consumer.send("held", -1)
+        producers = [MyQueue("127.0.0.1", port, secret_key=KEY) for _ in range(6)]
+        sent: list[bool] = []
+        threads = [
+            threading.Thread(target=lambda p=p, i=i: sent.append(p.send("held", i)))
+            for i, p in enumerate(producers)
+        ]
+        t0 = time.monotonic()
+        for t in threads:
+            t.start()
+        sleep(0.2)
+        got = [consumer.get("held", timeout=5) for _ in range(7)]
+        for t in threads:
+            t.join(10)
+        assert time.monotonic() - t0 < tcpQueue._BLOCK_PUT_SECONDS
+        assert sent == [True] * 6 and sorted(got) == list(range(-1, 6)), got
+        for p in [consumer, *producers]:
+            p.close()
+        print("  OK: 6 blocked PUTs parked on 2 selectors workers")
+    finally:
+        server.stop_server()
+        db.cleanup()
+
+    # The policy is stored with the queue, and DBs from before it get the
+    # column on open.
+    import sqlite3
+
+    db = _DbBox()
+    q = MyQueue(db_path=db.path(), secret_key=KEY)
+    q.declare_queue("held", overflow="block")
+    q.close_db()
+    q = MyQueue(db_path=db.path(), secret_key=KEY)
+    assert q._queue("held").overflow == "block"
+    assert q._queue("consumer").overflow == "drop_oldest"
+    q.close_db()
+    conn = sqlite3.connect(db.path())
+    conn.execute("ALTER TABLE queues DROP COLUMN overflow")
+    conn.execute("PRAGMA user_version = 5")
+    conn.close()
+    q = MyQueue(db_path=db.path(), secret_key=KEY)
+    assert q._queue("held").overflow == "drop_oldest"
+    for call in (
+        lambda: q.declare_queue("x", overflow="spill"),
+        lambda: MyQueue(overflow="spill"),
+    ):
+        try:
+            call()
+            assert False
+        except ValueError:
+            pass
+    q.close_db()
+    db.cleanup()
+    assert tcpQueue._backoff(1, 0.25) >= 0.25
+    assert tcpQueue._backoff(30, 0.25) <= 1.5 * tcpQueue._MAX_BACKOFF_SECONDS
+    print("  OK: reject NACKs and backs off, block waits for room, both storages")
+
+
 if __name__ == "__main__":
     test_basic_roundtrip()
     test_sentinel_collision_fix()
@@ -671,4 +2648,29 @@ if __name__ == "__main__":
     test_compaction_shrinks_db_file()
     test_wal_truncate()
     test_legacy_db_warns()
+    test_batch_get()
+    test_batch_put()
+    test_group_commit()
+    test_selectors_engine()
+    test_long_poll_get()
+    test_frame_reader_buffering()
+    test_large_payload_roundtrip()
+    test_coalesced_responses()
+    test_depth_counters()
+    test_connection_pool()
+    test_pipelined_requests()
+    test_codecs()
+    test_adaptive_compression()
+    test_named_queues()
+    test_leases()
+    test_priorities()
+    test_delayed_delivery()
+    test_head_cache()
+    test_segment_storage()
+    test_sharding()
+    test_metrics()
+    test_session_handshake()
+    test_streaming()
+    test_incremental_reaping()
+    test_overflow_policies()
     print("\nAll smoke tests passed.")